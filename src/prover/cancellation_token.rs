@@ -0,0 +1,43 @@
+use std::sync::atomic::AtomicBool;
+use std::sync::atomic::Ordering::Relaxed;
+use std::sync::Arc;
+
+use pyo3::prelude::*;
+
+/// A flag which can be set from any thread to stop a running proof search.
+/// Clones share the same flag, so the search can hold a clone while Python keeps the original
+#[pyclass(name = "RsCancellationToken")]
+#[derive(Clone, Default, Debug)]
+pub struct CancellationToken {
+    cancelled: Arc<AtomicBool>,
+}
+#[pymethods]
+impl CancellationToken {
+    #[new]
+    pub fn new() -> Self {
+        Self::default()
+    }
+
+    pub fn cancel(&self) {
+        self.cancelled.store(true, Relaxed);
+    }
+
+    #[getter]
+    pub fn is_cancelled(&self) -> bool {
+        self.cancelled.load(Relaxed)
+    }
+}
+
+#[cfg(test)]
+mod test {
+    use super::CancellationToken;
+
+    #[test]
+    fn test_cancelling_a_token_cancels_its_clones() {
+        let token = CancellationToken::new();
+        let clone = token.clone();
+        assert!(!clone.is_cancelled());
+        token.cancel();
+        assert!(clone.is_cancelled());
+    }
+}
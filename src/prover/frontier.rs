@@ -0,0 +1,151 @@
+use std::collections::BinaryHeap;
+use std::ops::Deref;
+use std::sync::{Condvar, Mutex, MutexGuard};
+
+/// A priority queue shared between worker threads, which always hands out the highest priority item first.
+/// Workers take an item with pop(), and hand back any new items it produced with complete().
+/// The queue is only exhausted once it's empty and no worker is still working on an item.
+pub struct Frontier<T: Ord> {
+    state: Mutex<FrontierState<T>>,
+    changed: Condvar,
+}
+struct FrontierState<T: Ord> {
+    heap: BinaryHeap<T>,
+    active_workers: usize,
+}
+impl<T: Ord> Frontier<T> {
+    pub fn new<I>(items: I) -> Self
+    where
+        I: IntoIterator<Item = T>,
+    {
+        Self {
+            state: Mutex::new(FrontierState {
+                heap: items.into_iter().collect(),
+                active_workers: 0,
+            }),
+            changed: Condvar::new(),
+        }
+    }
+
+    /// Take the highest priority item, waiting while other workers may still add more items.
+    /// Returns None once the frontier is exhausted.
+    /// The item is marked as done when the returned FrontierItem is completed or dropped,
+    /// so a worker which panics can't leave the other workers waiting forever
+    pub fn pop(&self) -> Option<FrontierItem<'_, T>> {
+        let mut state = self.lock();
+        loop {
+            if let Some(item) = state.heap.pop() {
+                state.active_workers += 1;
+                return Some(FrontierItem {
+                    frontier: self,
+                    item: Some(item),
+                });
+            }
+            if state.active_workers == 0 {
+                return None;
+            }
+            state = self
+                .changed
+                .wait(state)
+                .unwrap_or_else(|poisoned| poisoned.into_inner());
+        }
+    }
+
+    fn finish<I>(&self, items: I)
+    where
+        I: IntoIterator<Item = T>,
+    {
+        let mut state = self.lock();
+        state.heap.extend(items);
+        state.active_workers -= 1;
+        self.changed.notify_all();
+    }
+
+    // the state is always left consistent, so it's still usable if another worker panicked while holding the lock
+    fn lock(&self) -> MutexGuard<'_, FrontierState<T>> {
+        self.state
+            .lock()
+            .unwrap_or_else(|poisoned| poisoned.into_inner())
+    }
+}
+
+/// An item taken from a Frontier, which a worker is working on
+pub struct FrontierItem<'a, T: Ord> {
+    frontier: &'a Frontier<T>,
+    // only None once the item has been completed
+    item: Option<T>,
+}
+impl<'a, T: Ord> FrontierItem<'a, T> {
+    /// Take the item out, so its contents can be moved. It's still marked as done when this is dropped or completed
+    pub fn take(&mut self) -> T {
+        self.item.take().expect("frontier item was already taken")
+    }
+
+    /// Mark the item as done, adding any new items it produced to the frontier
+    pub fn complete<I>(mut self, items: I)
+    where
+        I: IntoIterator<Item = T>,
+    {
+        self.item = None;
+        self.frontier.finish(items);
+        std::mem::forget(self);
+    }
+}
+impl<'a, T: Ord> Deref for FrontierItem<'a, T> {
+    type Target = T;
+    fn deref(&self) -> &T {
+        self.item.as_ref().expect("frontier item was already taken")
+    }
+}
+impl<'a, T: Ord> Drop for FrontierItem<'a, T> {
+    fn drop(&mut self) {
+        self.frontier.finish(std::iter::empty());
+    }
+}
+
+#[cfg(test)]
+mod test {
+    use super::Frontier;
+
+    #[test]
+    fn test_pop_returns_highest_priority_items_first() {
+        let frontier = Frontier::new(vec![1, 3, 2]);
+        let item = frontier.pop().unwrap();
+        assert_eq!(*item, 3);
+        item.complete(vec![5, 0]);
+        for expected in [5, 2, 1, 0] {
+            let item = frontier.pop().unwrap();
+            assert_eq!(*item, expected);
+            item.complete(vec![]);
+        }
+        assert!(frontier.pop().is_none());
+    }
+
+    #[test]
+    fn test_pop_waits_for_active_workers_before_finishing() {
+        let frontier = Frontier::new(vec![1]);
+        let item = frontier.pop().unwrap();
+        std::thread::scope(|scope| {
+            let waiting_worker = scope.spawn(|| frontier.pop().map(|mut item| item.take()));
+            let next_item = *item + 1;
+            item.complete(vec![next_item]);
+            assert_eq!(waiting_worker.join().unwrap(), Some(2));
+        });
+        assert!(frontier.pop().is_none());
+    }
+
+    #[test]
+    fn test_items_dropped_by_a_panicking_worker_are_completed() {
+        let frontier = Frontier::new(vec![1]);
+        let item = frontier.pop().unwrap();
+        std::thread::scope(|scope| {
+            let waiting_worker = scope.spawn(|| frontier.pop().map(|mut item| item.take()));
+            let panicking_worker = scope.spawn(move || {
+                let _item = item;
+                panic!("worker failed");
+            });
+            assert!(panicking_worker.join().is_err());
+            assert_eq!(waiting_worker.join().unwrap(), None);
+        });
+    }
+}
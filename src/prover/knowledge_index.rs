@@ -0,0 +1,317 @@
+use std::borrow::Cow;
+use std::sync::Arc;
+
+use rustc_hash::FxHashMap;
+
+use crate::types::{CNFDisjunction, CNFLiteral};
+use crate::util::{PyArcItem, Symbol};
+
+/// How predicates are allowed to unify with each other, given the similarity function in use.
+/// This determines how aggressively the knowledge index can filter out candidate clauses.
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum PredicateMatching {
+    /// Predicates only unify if their symbols are identical
+    Symbol,
+    /// Predicates with embeddings can unify with any other predicate with an embedding,
+    /// otherwise predicates only unify if their symbols are identical
+    Embedding,
+    /// Any predicate can potentially unify with any other predicate
+    Any,
+}
+impl PredicateMatching {
+    pub fn parse(value: &str) -> Option<Self> {
+        match value {
+            "symbol" => Some(PredicateMatching::Symbol),
+            "embedding" => Some(PredicateMatching::Embedding),
+            "any" => Some(PredicateMatching::Any),
+            _ => None,
+        }
+    }
+}
+
+// (polarity, arity)
+type LiteralShape = (bool, usize);
+
+/// Index over the clauses in the knowledge base, keyed by the polarity, arity and predicate of each literal.
+/// Used to look up only the clauses which can possibly resolve with a goal, rather than scanning the whole knowledge.
+#[derive(Clone)]
+pub struct KnowledgeIndex {
+    predicate_matching: PredicateMatching,
+    clauses: Vec<PyArcItem<CNFDisjunction>>,
+    by_shape: FxHashMap<LiteralShape, Vec<usize>>,
+    by_symbol: FxHashMap<LiteralShape, FxHashMap<Symbol, Vec<usize>>>,
+    // fallback bucket for literals whose predicate has an embedding, and can fuzzy-match other symbols
+    with_embedding: FxHashMap<LiteralShape, Vec<usize>>,
+}
+impl KnowledgeIndex {
+    pub fn new<I>(knowledge: I, predicate_matching: PredicateMatching) -> Self
+    where
+        I: IntoIterator<Item = PyArcItem<CNFDisjunction>>,
+    {
+        let mut index = Self {
+            predicate_matching,
+            clauses: Vec::new(),
+            by_shape: FxHashMap::default(),
+            by_symbol: FxHashMap::default(),
+            with_embedding: FxHashMap::default(),
+        };
+        for clause in knowledge {
+            index.insert(clause);
+        }
+        index
+    }
+
+    /// Add a clause to the index. The caller is responsible for not inserting the same clause twice
+    pub fn insert(&mut self, clause: PyArcItem<CNFDisjunction>) {
+        let clause_index = self.clauses.len();
+        for literal in clause.item.literals.iter() {
+            let shape = (literal.item.polarity, literal.item.atom.terms.len());
+            let predicate = &literal.item.atom.predicate;
+            push_unique(self.by_shape.entry(shape).or_default(), clause_index);
+            push_unique(
+                self.by_symbol
+                    .entry(shape)
+                    .or_default()
+                    .entry(predicate.symbol)
+                    .or_default(),
+                clause_index,
+            );
+            if predicate.embedding.is_some() {
+                push_unique(self.with_embedding.entry(shape).or_default(), clause_index);
+            }
+        }
+        self.clauses.push(clause);
+    }
+
+    pub fn len(&self) -> usize {
+        self.clauses.len()
+    }
+
+    pub fn clause(&self, clause_index: usize) -> &PyArcItem<CNFDisjunction> {
+        &self.clauses[clause_index]
+    }
+
+    /// Find the indices of all clauses containing a literal which could potentially resolve with the given literal.
+    /// Indices are returned in ascending order, which matches the order the clauses were inserted in.
+    pub fn candidates(&self, literal: &CNFLiteral) -> Cow<[usize]> {
+        // we can only resolve literals with the opposite polarity
+        let shape = (!literal.polarity, literal.atom.terms.len());
+        let predicate = &literal.atom.predicate;
+        match self.predicate_matching {
+            PredicateMatching::Any => Cow::Borrowed(lookup(self.by_shape.get(&shape))),
+            PredicateMatching::Symbol => Cow::Borrowed(self.lookup_symbol(shape, predicate.symbol)),
+            PredicateMatching::Embedding => {
+                let symbol_matches = self.lookup_symbol(shape, predicate.symbol);
+                if predicate.embedding.is_none() {
+                    return Cow::Borrowed(symbol_matches);
+                }
+                let embedding_matches = lookup(self.with_embedding.get(&shape));
+                if symbol_matches.is_empty() {
+                    return Cow::Borrowed(embedding_matches);
+                }
+                Cow::Owned(merge_sorted(symbol_matches, embedding_matches))
+            }
+        }
+    }
+
+    fn lookup_symbol(&self, shape: LiteralShape, symbol: Symbol) -> &[usize] {
+        lookup(
+            self.by_symbol
+                .get(&shape)
+                .and_then(|symbols| symbols.get(&symbol)),
+        )
+    }
+}
+
+/// The base knowledge index, which is shared between queries, layered with a small index
+/// of the clauses which are only used in a single query (extra knowledge and inverted goals).
+/// Clauses in the overlay are numbered after all the clauses in the base.
+pub struct LayeredKnowledgeIndex {
+    base: Arc<KnowledgeIndex>,
+    overlay: KnowledgeIndex,
+}
+impl LayeredKnowledgeIndex {
+    pub fn new(base: Arc<KnowledgeIndex>, overlay: KnowledgeIndex) -> Self {
+        Self { base, overlay }
+    }
+
+    pub fn len(&self) -> usize {
+        self.base.len() + self.overlay.len()
+    }
+
+    pub fn clause(&self, clause_index: usize) -> &PyArcItem<CNFDisjunction> {
+        if clause_index < self.base.len() {
+            self.base.clause(clause_index)
+        } else {
+            self.overlay.clause(clause_index - self.base.len())
+        }
+    }
+
+    /// Find the indices of all clauses in either layer which could potentially resolve with the given literal
+    pub fn candidates(&self, literal: &CNFLiteral) -> Candidates {
+        Candidates {
+            base: self.base.candidates(literal),
+            overlay: self.overlay.candidates(literal),
+            overlay_offset: self.base.len(),
+        }
+    }
+}
+
+/// Candidate clause indices from both layers of a LayeredKnowledgeIndex, without copying them into a single list
+pub struct Candidates<'a> {
+    base: Cow<'a, [usize]>,
+    overlay: Cow<'a, [usize]>,
+    overlay_offset: usize,
+}
+impl<'a> Candidates<'a> {
+    pub fn len(&self) -> usize {
+        self.base.len() + self.overlay.len()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.len() == 0
+    }
+
+    pub fn iter(&self) -> impl Iterator<Item = usize> + '_ {
+        let overlay_offset = self.overlay_offset;
+        self.base.iter().copied().chain(
+            self.overlay
+                .iter()
+                .map(move |clause_index| clause_index + overlay_offset),
+        )
+    }
+}
+
+fn lookup(clause_indices: Option<&Vec<usize>>) -> &[usize] {
+    clause_indices
+        .map(|indices| indices.as_slice())
+        .unwrap_or(&[])
+}
+
+// clauses are inserted in ascending order, so a duplicate can only ever be the last element
+fn push_unique(clause_indices: &mut Vec<usize>, clause_index: usize) {
+    if clause_indices.last() != Some(&clause_index) {
+        clause_indices.push(clause_index);
+    }
+}
+
+fn merge_sorted(left: &[usize], right: &[usize]) -> Vec<usize> {
+    let mut merged = Vec::with_capacity(left.len() + right.len());
+    let (mut i, mut j) = (0, 0);
+    while i < left.len() && j < right.len() {
+        if left[i] < right[j] {
+            merged.push(left[i]);
+            i += 1;
+        } else if left[i] > right[j] {
+            merged.push(right[j]);
+            j += 1;
+        } else {
+            merged.push(left[i]);
+            i += 1;
+            j += 1;
+        }
+    }
+    merged.extend_from_slice(&left[i..]);
+    merged.extend_from_slice(&right[j..]);
+    merged
+}
+
+#[cfg(test)]
+mod test {
+    use super::*;
+    use crate::test_utils::test::{const1, pred1, pred2, to_numpy_array, x};
+    use crate::types::Predicate;
+
+    fn disj(literals: Vec<CNFLiteral>) -> PyArcItem<CNFDisjunction> {
+        PyArcItem::new(CNFDisjunction::new(
+            literals.into_iter().map(PyArcItem::new).collect(),
+        ))
+    }
+
+    fn knowledge() -> Vec<PyArcItem<CNFDisjunction>> {
+        vec![
+            disj(vec![CNFLiteral::new(
+                pred1().atom(vec![const1().into()]),
+                true,
+            )]),
+            disj(vec![CNFLiteral::new(
+                pred1().atom(vec![const1().into()]),
+                false,
+            )]),
+            disj(vec![CNFLiteral::new(
+                pred1().atom(vec![const1().into(), x().into()]),
+                true,
+            )]),
+            disj(vec![
+                CNFLiteral::new(pred2().atom(vec![x().into()]), true),
+                CNFLiteral::new(pred1().atom(vec![x().into()]), true),
+            ]),
+            disj(vec![CNFLiteral::new(
+                pred2().atom(vec![const1().into()]),
+                true,
+            )]),
+        ]
+    }
+
+    #[test]
+    fn test_symbol_matching_only_returns_clauses_with_same_predicate_opposite_polarity_and_arity() {
+        let index = KnowledgeIndex::new(knowledge(), PredicateMatching::Symbol);
+        let goal = CNFLiteral::new(pred1().atom(vec![x().into()]), false);
+        assert_eq!(index.candidates(&goal).into_owned(), vec![0, 3]);
+    }
+
+    #[test]
+    fn test_any_matching_returns_all_clauses_with_opposite_polarity_and_arity() {
+        let index = KnowledgeIndex::new(knowledge(), PredicateMatching::Any);
+        let goal = CNFLiteral::new(pred1().atom(vec![x().into()]), false);
+        assert_eq!(index.candidates(&goal).into_owned(), vec![0, 3, 4]);
+    }
+
+    #[test]
+    fn test_candidates_is_empty_if_nothing_matches() {
+        let index = KnowledgeIndex::new(knowledge(), PredicateMatching::Symbol);
+        let goal = CNFLiteral::new(Predicate::new("missing", None).atom(vec![]), false);
+        assert!(index.candidates(&goal).is_empty());
+        assert_eq!(index.len(), 5);
+    }
+
+    #[test]
+    fn test_embedding_matching_includes_all_predicates_with_embeddings() {
+        let embedded1 = Predicate::new("embedded1", Some(to_numpy_array(vec![1.0, 0.0])));
+        let embedded2 = Predicate::new("embedded2", Some(to_numpy_array(vec![0.0, 1.0])));
+        let mut clauses = knowledge();
+        clauses.push(disj(vec![CNFLiteral::new(
+            embedded2.atom(vec![const1().into()]),
+            true,
+        )]));
+        let index = KnowledgeIndex::new(clauses, PredicateMatching::Embedding);
+
+        let embedded_goal = CNFLiteral::new(embedded1.atom(vec![x().into()]), false);
+        assert_eq!(index.candidates(&embedded_goal).into_owned(), vec![5]);
+
+        let plain_goal = CNFLiteral::new(pred1().atom(vec![x().into()]), false);
+        assert_eq!(index.candidates(&plain_goal).into_owned(), vec![0, 3]);
+    }
+
+    #[test]
+    fn test_layered_index_numbers_overlay_clauses_after_base_clauses() {
+        let mut clauses = knowledge();
+        let overlay_clauses = clauses.split_off(3);
+        let base = Arc::new(KnowledgeIndex::new(clauses, PredicateMatching::Symbol));
+        let overlay = KnowledgeIndex::new(overlay_clauses, PredicateMatching::Symbol);
+        let index = LayeredKnowledgeIndex::new(base, overlay);
+
+        let goal = CNFLiteral::new(pred1().atom(vec![x().into()]), false);
+        let candidates = index.candidates(&goal);
+        assert_eq!(candidates.iter().collect::<Vec<_>>(), vec![0, 3]);
+        assert_eq!(candidates.len(), 2);
+        assert_eq!(index.len(), 5);
+        assert_eq!(index.clause(3), &knowledge()[3]);
+    }
+
+    #[test]
+    fn test_merge_sorted_removes_duplicates() {
+        assert_eq!(merge_sorted(&[0, 2, 5], &[1, 2, 6]), vec![0, 1, 2, 5, 6]);
+        assert_eq!(merge_sorted(&[], &[1, 2]), vec![1, 2]);
+    }
+}
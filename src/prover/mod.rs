@@ -1,23 +1,39 @@
 use pyo3::prelude::*;
 
+mod cancellation_token;
+mod frontier;
+mod knowledge_index;
 mod operations;
+mod persistent_similarity_cache;
 mod proof;
 mod proof_context;
 mod proof_stats;
 mod proof_step;
+mod proof_stream;
 mod resolution_prover;
+mod search_strategy;
+mod similarity;
 mod similarity_cache;
+mod thread_pool;
 
+pub use cancellation_token::CancellationToken;
 pub use proof::Proof;
 pub use proof_context::{LocalProofContext, SharedProofContext};
 pub use proof_stats::{LocalProofStats, SharedProofStats};
 pub use proof_step::{ProofStep, ProofStepNode, SubstitutionsMap};
+pub use proof_stream::ProofStream;
 pub use resolution_prover::ResolutionProverBackend;
+pub use similarity::{NativeSimilarity, SimilarityFn};
+pub use similarity_cache::SimilarityCacheStats;
 
 pub fn register_python_symbols(_py: Python<'_>, module: &PyModule) -> PyResult<()> {
     module.add_class::<ProofStep>()?;
     module.add_class::<LocalProofStats>()?;
     module.add_class::<Proof>()?;
     module.add_class::<ResolutionProverBackend>()?;
+    module.add_class::<NativeSimilarity>()?;
+    module.add_class::<CancellationToken>()?;
+    module.add_class::<ProofStream>()?;
+    module.add_class::<SimilarityCacheStats>()?;
     Ok(())
 }
@@ -161,7 +161,7 @@ fn find_non_overlapping_var_names(
     let overlapping_variables = source_vars.intersection(target_vars);
     let mut renamed_vars = FxHashMap::default();
     for var in overlapping_variables {
-        let base_name = VAR_NAME_REGEX.replace(&var.name, "");
+        let base_name = VAR_NAME_REGEX.replace(var.name.as_str(), "");
         let mut counter = 0;
         loop {
             counter += 1;
@@ -268,12 +268,18 @@ mod test {
         const1, const2, func1, func2, get_py_similarity_fn, pred1, pred2, to_numpy_array, x, y, z,
     };
     use crate::{
-        prover::SharedProofContext,
+        prover::{SharedProofContext, SimilarityFn},
         types::{Constant, Predicate},
     };
 
     fn ctx() -> SharedProofContext {
-        SharedProofContext::new(0.5, None, true, None, Some(get_py_similarity_fn()))
+        SharedProofContext::new(
+            0.5,
+            None,
+            true,
+            None,
+            SimilarityFn::Python(get_py_similarity_fn()),
+        )
     }
 
     #[test]
@@ -0,0 +1,230 @@
+use std::cmp::Ordering;
+
+use pyo3::buffer::PyBuffer;
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+
+use crate::types::SimilarityComparable;
+
+// File layout, with every number stored little-endian:
+//   magic: 8 bytes
+//   flags: u64, where bit 0 is set if the similarity function is symmetric
+//   similarity fingerprint: u64, identifying the similarity function which calculated the similarities
+//   count: u64
+//   count records of (source: u64, target: u64, similarity: f64), sorted by (source, target)
+const MAGIC: &[u8; 8] = b"TTPSIMC2";
+const SYMMETRIC_FLAG: u64 = 1;
+const HEADER_SIZE: usize = 32;
+const RECORD_SIZE: usize = 24;
+
+/// Key for a similarity which is the same in every process, based on the stable ids of the source and target
+#[derive(Clone, Copy, Hash, PartialEq, Eq, PartialOrd, Ord, Debug)]
+pub struct StableSimilarityKey {
+    source: u64,
+    target: u64,
+}
+impl StableSimilarityKey {
+    /// Returns None if either item's embedding can't be read, since its contents can't be identified
+    pub fn new<T>(source: &T, target: &T, symmetric: bool) -> Option<Self>
+    where
+        T: SimilarityComparable,
+    {
+        Some(Self::from_ids(
+            source.stable_similarity_id()?,
+            target.stable_similarity_id()?,
+            symmetric,
+        ))
+    }
+
+    pub fn from_ids(source: u64, target: u64, symmetric: bool) -> Self {
+        if symmetric && target < source {
+            Self {
+                source: target,
+                target: source,
+            }
+        } else {
+            Self { source, target }
+        }
+    }
+
+    fn normalized(self, symmetric: bool) -> Self {
+        Self::from_ids(self.source, self.target, symmetric)
+    }
+}
+
+/// Similarities saved to disk by a previous prover, shared read-only between every query.
+/// The data is borrowed from a Python buffer, usually a read-only mmap of the file,
+/// so many processes loading the same file share a single copy of it in the OS page cache.
+pub struct PersistentSimilarityCache {
+    buffer: PyBuffer<u8>,
+    symmetric: bool,
+    len: usize,
+}
+impl PersistentSimilarityCache {
+    /// Load similarities saved by a prover with the same similarity fingerprint
+    pub fn load(data: &PyAny, similarity_fingerprint: u64) -> PyResult<Self> {
+        let buffer = PyBuffer::<u8>::get(data)?;
+        // the data is read without holding the GIL, so it must not be modified from Python while it's loaded
+        if !buffer.readonly() || !buffer.is_c_contiguous() {
+            return Err(PyValueError::new_err(
+                "Similarity cache data must be a read-only contiguous buffer",
+            ));
+        }
+        if buffer.len_bytes() < HEADER_SIZE {
+            return Err(PyValueError::new_err("Not a similarity cache file"));
+        }
+        let mut cache = Self {
+            buffer,
+            symmetric: false,
+            len: 0,
+        };
+        let (symmetric, file_similarity_fingerprint, len) =
+            read_header(cache.bytes()).map_err(PyValueError::new_err)?;
+        if file_similarity_fingerprint != similarity_fingerprint {
+            return Err(PyValueError::new_err(
+                "Similarity cache file was saved by a prover with a different similarity function",
+            ));
+        }
+        cache.symmetric = symmetric;
+        cache.len = len;
+        Ok(cache)
+    }
+
+    pub fn get(&self, key: StableSimilarityKey) -> Option<f64> {
+        find_record(self.records(), key.normalized(self.symmetric))
+    }
+
+    pub fn iter(&self) -> impl Iterator<Item = (StableSimilarityKey, f64)> + '_ {
+        self.records().chunks_exact(RECORD_SIZE).map(read_record)
+    }
+
+    fn records(&self) -> &[u8] {
+        &self.bytes()[HEADER_SIZE..HEADER_SIZE + self.len * RECORD_SIZE]
+    }
+
+    fn bytes(&self) -> &[u8] {
+        // safe since the buffer is contiguous and read-only, and stays valid until it's released on drop
+        unsafe {
+            std::slice::from_raw_parts(self.buffer.buf_ptr() as *const u8, self.buffer.len_bytes())
+        }
+    }
+}
+
+/// Serialize similarities into the file format read by PersistentSimilarityCache.
+/// If there are duplicate keys, the first similarity for each key is kept
+pub fn serialize_similarities(
+    similarities: impl IntoIterator<Item = (StableSimilarityKey, f64)>,
+    symmetric: bool,
+    similarity_fingerprint: u64,
+) -> Vec<u8> {
+    let mut records = similarities
+        .into_iter()
+        .map(|(key, similarity)| (key.normalized(symmetric), similarity))
+        .collect::<Vec<_>>();
+    // stable sort, so deduplicating keeps the first similarity for each key
+    records.sort_by_key(|(key, _)| *key);
+    records.dedup_by_key(|(key, _)| *key);
+
+    let mut bytes = Vec::with_capacity(HEADER_SIZE + records.len() * RECORD_SIZE);
+    bytes.extend_from_slice(MAGIC);
+    let flags = if symmetric { SYMMETRIC_FLAG } else { 0 };
+    bytes.extend_from_slice(&flags.to_le_bytes());
+    bytes.extend_from_slice(&similarity_fingerprint.to_le_bytes());
+    bytes.extend_from_slice(&(records.len() as u64).to_le_bytes());
+    for (key, similarity) in records {
+        bytes.extend_from_slice(&key.source.to_le_bytes());
+        bytes.extend_from_slice(&key.target.to_le_bytes());
+        bytes.extend_from_slice(&similarity.to_le_bytes());
+    }
+    bytes
+}
+
+/// Returns whether the similarity function is symmetric, the similarity fingerprint, and the number of records
+fn read_header(bytes: &[u8]) -> Result<(bool, u64, usize), String> {
+    if bytes.len() < HEADER_SIZE || &bytes[..8] != MAGIC {
+        return Err("Not a similarity cache file".to_string());
+    }
+    let flags = read_u64(&bytes[8..16]);
+    let similarity_fingerprint = read_u64(&bytes[16..24]);
+    let len = read_u64(&bytes[24..32]) as usize;
+    let expected_size = len
+        .checked_mul(RECORD_SIZE)
+        .and_then(|records_size| records_size.checked_add(HEADER_SIZE));
+    if expected_size != Some(bytes.len()) {
+        return Err(format!(
+            "Similarity cache file is truncated or corrupt: expected {} records in {} bytes",
+            len,
+            bytes.len()
+        ));
+    }
+    Ok((flags & SYMMETRIC_FLAG != 0, similarity_fingerprint, len))
+}
+
+// binary search over the sorted records
+fn find_record(records: &[u8], key: StableSimilarityKey) -> Option<f64> {
+    let (mut low, mut high) = (0, records.len() / RECORD_SIZE);
+    while low < high {
+        let mid = low + (high - low) / 2;
+        let (mid_key, similarity) =
+            read_record(&records[mid * RECORD_SIZE..(mid + 1) * RECORD_SIZE]);
+        match mid_key.cmp(&key) {
+            Ordering::Less => low = mid + 1,
+            Ordering::Greater => high = mid,
+            Ordering::Equal => return Some(similarity),
+        }
+    }
+    None
+}
+
+fn read_record(record: &[u8]) -> (StableSimilarityKey, f64) {
+    let key = StableSimilarityKey {
+        source: read_u64(&record[0..8]),
+        target: read_u64(&record[8..16]),
+    };
+    (key, f64::from_bits(read_u64(&record[16..24])))
+}
+
+fn read_u64(bytes: &[u8]) -> u64 {
+    u64::from_le_bytes(bytes.try_into().unwrap())
+}
+
+#[cfg(test)]
+mod test {
+    use super::*;
+
+    fn key(source: u64, target: u64) -> StableSimilarityKey {
+        StableSimilarityKey::from_ids(source, target, false)
+    }
+
+    #[test]
+    fn test_serialized_similarities_can_be_found() {
+        let bytes = serialize_similarities(
+            vec![(key(3, 1), 0.25), (key(1, 2), 0.5), (key(2, 1), 0.75)],
+            false,
+            42,
+        );
+        assert_eq!(read_header(&bytes), Ok((false, 42, 3)));
+        let records = &bytes[HEADER_SIZE..];
+        assert_eq!(find_record(records, key(1, 2)), Some(0.5));
+        assert_eq!(find_record(records, key(2, 1)), Some(0.75));
+        assert_eq!(find_record(records, key(3, 1)), Some(0.25));
+        assert_eq!(find_record(records, key(1, 3)), None);
+        assert_eq!(find_record(&[], key(1, 2)), None);
+    }
+
+    #[test]
+    fn test_symmetric_similarities_are_stored_once_per_pair() {
+        let bytes = serialize_similarities(vec![(key(2, 1), 0.5), (key(1, 2), 0.75)], true, 42);
+        assert_eq!(read_header(&bytes), Ok((true, 42, 1)));
+        let records = &bytes[HEADER_SIZE..];
+        assert_eq!(find_record(records, key(2, 1).normalized(true)), Some(0.5));
+    }
+
+    #[test]
+    fn test_read_header_rejects_corrupt_files() {
+        let bytes = serialize_similarities(vec![(key(1, 2), 0.5)], false, 42);
+        assert!(read_header(&bytes[..bytes.len() - 1]).is_err());
+        assert!(read_header(b"not a cache file at all!").is_err());
+        assert!(read_header(&[]).is_err());
+    }
+}
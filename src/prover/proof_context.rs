@@ -1,19 +1,81 @@
 use atomic_float::AtomicF64;
 use dashmap::DashMap;
 use pyo3::prelude::*;
-use rustc_hash::FxHasher;
-use std::hash::{BuildHasherDefault, Hash, Hasher};
+use rustc_hash::{FxHashMap, FxHashSet, FxHasher};
+use std::cmp::Ordering;
+use std::collections::BinaryHeap;
+use std::hash::BuildHasherDefault;
+use std::sync::atomic::AtomicUsize;
 use std::sync::atomic::Ordering::Relaxed;
-use std::sync::RwLock;
+use std::sync::{Arc, Mutex, RwLock};
+use std::time::Instant;
 
 use crate::types::SimilarityComparable;
 
+use super::cancellation_token::CancellationToken;
+use super::persistent_similarity_cache::{PersistentSimilarityCache, StableSimilarityKey};
 use super::proof_step::ProofStepNode;
-use super::similarity_cache::{FallthroughSimilarityCache, SimilarityCache};
-use super::ProofStep;
+use super::proof_stream::ProofSender;
+use super::similarity::SimilarityFn;
+use super::similarity_cache::{FallthroughSimilarityCache, SimilarityCache, SimilarityKey};
 use super::{LocalProofStats, SharedProofStats};
+use super::{Proof, ProofStep};
 
 type SeenResolventsMap = DashMap<u64, (usize, f64), BuildHasherDefault<FxHasher>>;
+type PrefetchedSimilaritiesMap = DashMap<SimilarityKey, (), BuildHasherDefault<FxHasher>>;
+
+// LocalProofContext's front tables are cleared once they hold this many entries, to keep their memory bounded
+const MAX_LOCAL_SEEN_RESOLVENTS: usize = 1 << 14;
+const MAX_LOCAL_SIMILARITIES: usize = 1 << 14;
+
+/// The leaf proofs kept so far. The heap has the worst proof on top,
+/// so once max_proofs proofs are kept, checking and replacing the worst one is O(log max_proofs)
+#[derive(Default)]
+struct LeafProofs {
+    heap: BinaryHeap<ScoredLeafProof>,
+    total_recorded: usize,
+}
+
+/// A recorded leaf proof step. Worse proofs compare as greater: lower similarity first,
+/// then deeper proofs, then proofs which were recorded later
+struct ScoredLeafProof {
+    similarity: f64,
+    depth: usize,
+    recorded_index: usize,
+    proof_step: ProofStepNode,
+    stats: LocalProofStats,
+}
+impl ScoredLeafProof {
+    fn new(proof_step: ProofStepNode, stats: LocalProofStats, recorded_index: usize) -> Self {
+        Self {
+            similarity: proof_step.inner.running_similarity,
+            depth: proof_step.inner.depth,
+            recorded_index,
+            proof_step,
+            stats,
+        }
+    }
+}
+impl PartialEq for ScoredLeafProof {
+    fn eq(&self, other: &Self) -> bool {
+        self.cmp(other) == Ordering::Equal
+    }
+}
+impl Eq for ScoredLeafProof {}
+impl PartialOrd for ScoredLeafProof {
+    fn partial_cmp(&self, other: &Self) -> Option<Ordering> {
+        Some(self.cmp(other))
+    }
+}
+impl Ord for ScoredLeafProof {
+    fn cmp(&self, other: &Self) -> Ordering {
+        other
+            .similarity
+            .total_cmp(&self.similarity)
+            .then_with(|| self.depth.cmp(&other.depth))
+            .then_with(|| self.recorded_index.cmp(&other.recorded_index))
+    }
+}
 
 /// Helper class which accumulates successful proof steps and keeps track of stats during the proof process
 pub struct SharedProofContext {
@@ -21,101 +83,307 @@ pub struct SharedProofContext {
     // pub min_similarity_threshold: f64,
     pub min_similarity_threshold: AtomicF64,
     pub max_proofs: Option<usize>,
-    scored_leaf_proof_steps: RwLock<Vec<(f64, usize, ProofStepNode, LocalProofStats)>>,
+    leaf_proofs: RwLock<LeafProofs>,
     skip_seen_resolvents: bool,
     seen_resolvents: SeenResolventsMap,
-    similarity_cache: Option<SimilarityCache>,
-    py_similarity_fn: Option<PyObject>,
+    // the DashMap's len() locks every shard, so the number of seen resolvents is tracked separately
+    num_seen_resolvents: AtomicUsize,
+    max_seen_resolvents: Option<usize>,
+    // held by whichever worker is evicting seen resolvents, so other workers don't evict at the same time
+    seen_resolvents_eviction: Mutex<()>,
+    similarity_cache: Option<Arc<SimilarityCache>>,
+    // similarities saved to disk, which are checked whenever the in-memory cache misses
+    persistent_similarity_cache: Option<Arc<PersistentSimilarityCache>>,
+    similarity_fn: SimilarityFn,
+    // similarities this search prefetched but hasn't looked up yet. The first lookup of each counts as the miss,
+    // so a prefetched pair isn't counted as both a miss and a hit
+    prefetched_similarities: PrefetchedSimilaritiesMap,
+    // if true, the similarity of (a, b) is assumed to equal (b, a), so both share a cache entry
+    symmetric_similarity: bool,
+    deadline: Option<Instant>,
+    cancellation_tokens: Vec<CancellationToken>,
+    proof_sender: Option<ProofSender>,
 }
 impl SharedProofContext {
     pub fn new(
         initial_min_similarity_threshold: f64,
         max_proofs: Option<usize>,
         skip_seen_resolvents: bool,
-        similarity_cache: Option<SimilarityCache>,
-        py_similarity_fn: Option<PyObject>,
+        similarity_cache: Option<Arc<SimilarityCache>>,
+        similarity_fn: SimilarityFn,
     ) -> Self {
         Self {
             stats: SharedProofStats::new(),
             min_similarity_threshold: AtomicF64::new(initial_min_similarity_threshold),
             max_proofs,
-            scored_leaf_proof_steps: RwLock::new(Vec::new()),
+            leaf_proofs: RwLock::new(LeafProofs::default()),
             seen_resolvents: SeenResolventsMap::default(),
+            num_seen_resolvents: AtomicUsize::new(0),
+            max_seen_resolvents: None,
+            seen_resolvents_eviction: Mutex::new(()),
             skip_seen_resolvents,
             similarity_cache,
-            py_similarity_fn,
+            persistent_similarity_cache: None,
+            similarity_fn,
+            prefetched_similarities: PrefetchedSimilaritiesMap::default(),
+            symmetric_similarity: false,
+            deadline: None,
+            cancellation_tokens: Vec::new(),
+            proof_sender: None,
+        }
+    }
+
+    /// Declare that the similarity function gives the same result for (a, b) and (b, a),
+    /// so both orders can share a single cache entry
+    pub fn with_symmetric_similarity(mut self, symmetric_similarity: bool) -> Self {
+        self.symmetric_similarity = symmetric_similarity;
+        self
+    }
+
+    /// Look up similarities which aren't in the similarity cache in similarities loaded from disk,
+    /// before calculating them
+    pub fn with_persistent_similarity_cache(
+        mut self,
+        persistent_similarity_cache: Option<Arc<PersistentSimilarityCache>>,
+    ) -> Self {
+        self.persistent_similarity_cache = persistent_similarity_cache;
+        self
+    }
+
+    /// Stop the search once the given time has passed
+    pub fn with_deadline(mut self, deadline: Option<Instant>) -> Self {
+        self.deadline = deadline;
+        self
+    }
+
+    /// Stop the search as soon as the given token is cancelled.
+    /// Can be called more than once, to stop the search when any of the tokens is cancelled
+    pub fn with_cancellation_token(
+        mut self,
+        cancellation_token: Option<CancellationToken>,
+    ) -> Self {
+        self.cancellation_tokens.extend(cancellation_token);
+        self
+    }
+
+    /// Limit how many seen resolvents are remembered when skipping seen resolvents.
+    /// Once the limit is passed, the least useful resolvents are forgotten, which can only cause repeated work
+    pub fn with_max_seen_resolvents(mut self, max_seen_resolvents: Option<usize>) -> Self {
+        self.max_seen_resolvents = max_seen_resolvents;
+        self
+    }
+
+    /// Send every leaf proof to the given sender as soon as it's recorded.
+    /// The search stops if the receiving end is dropped
+    pub fn with_proof_sender(mut self, proof_sender: Option<ProofSender>) -> Self {
+        self.proof_sender = proof_sender;
+        self
+    }
+
+    /// Check if the search should stop early, because the deadline has passed or the search was cancelled.
+    /// Once this returns true, the search is marked as truncated and this will keep returning true
+    pub fn should_stop(&self) -> bool {
+        if self.stats.truncated.load(Relaxed) {
+            return true;
+        }
+        let cancelled = self
+            .cancellation_tokens
+            .iter()
+            .any(|token| token.is_cancelled());
+        let past_deadline = self
+            .deadline
+            .map_or(false, |deadline| Instant::now() >= deadline);
+        if cancelled || past_deadline {
+            self.stats.truncated.store(true, Relaxed);
+            return true;
         }
+        false
     }
 
     pub fn record_leaf_proof(&self, proof_step: ProofStepNode) {
         // make sure to clone the stats before appending, since the stats will continue to get mutated after this
-        let scored_leaf_proof_steps_guard = self.scored_leaf_proof_steps.write();
-        let mut scored_leaf_proof_steps = scored_leaf_proof_steps_guard.unwrap();
-        scored_leaf_proof_steps.push((
-            proof_step.inner.running_similarity,
-            proof_step.inner.depth,
-            proof_step,
-            self.stats.copy_and_freeze(),
-        ));
-        scored_leaf_proof_steps.sort_by(|a, b| {
-            if a.0 == b.0 {
-                a.1.cmp(&b.1)
-            } else {
-                b.0.partial_cmp(&a.0).unwrap()
-            }
+        let stats = self.stats.copy_and_freeze();
+        let streamed_proof = self.proof_sender.as_ref().map(|sender| {
+            let proof = Proof::new(
+                proof_step.inner.running_similarity,
+                stats.clone(),
+                (*proof_step.inner).clone(),
+            );
+            (sender, proof)
         });
-        if let Some(max_proofs) = self.max_proofs {
-            if scored_leaf_proof_steps.len() > max_proofs {
-                // Remove the proof step with the lowest similarity
-                scored_leaf_proof_steps.pop();
-                self.stats.discarded_proofs.fetch_add(1, Relaxed);
-                self.min_similarity_threshold
-                    .swap(scored_leaf_proof_steps.last().unwrap().0, Relaxed);
+        self.push_leaf_proof(proof_step, stats);
+        // send after releasing the lock, since this blocks while the receiver's buffer is full
+        if let Some((sender, proof)) = streamed_proof {
+            if sender.send(Ok(proof)).is_err() {
+                // nobody is reading the proofs anymore
+                self.stats.truncated.store(true, Relaxed);
+            }
+        }
+    }
+
+    fn push_leaf_proof(&self, proof_step: ProofStepNode, stats: LocalProofStats) {
+        let mut leaf_proofs = self.leaf_proofs.write().unwrap();
+        let leaf_proof = ScoredLeafProof::new(proof_step, stats, leaf_proofs.total_recorded);
+        leaf_proofs.total_recorded += 1;
+        let is_full = self
+            .max_proofs
+            .map_or(false, |max_proofs| leaf_proofs.heap.len() >= max_proofs);
+        if !is_full {
+            leaf_proofs.heap.push(leaf_proof);
+            return;
+        }
+        // only the best max_proofs proofs are kept, so the new proof either replaces the worst one or is dropped
+        self.stats.discarded_proofs.fetch_add(1, Relaxed);
+        if let Some(mut worst_leaf_proof) = leaf_proofs.heap.peek_mut() {
+            if leaf_proof < *worst_leaf_proof {
+                *worst_leaf_proof = leaf_proof;
             }
         }
+        if let Some(worst_leaf_proof) = leaf_proofs.heap.peek() {
+            self.min_similarity_threshold
+                .swap(worst_leaf_proof.similarity, Relaxed);
+        }
     }
 
+    /// All the leaf proof steps kept so far, from best to worst
     pub fn leaf_proof_steps_with_stats(&self) -> Vec<(ProofStep, LocalProofStats)> {
-        let scored_leaf_proof_steps_guard = self.scored_leaf_proof_steps.read();
-        scored_leaf_proof_steps_guard
-            .unwrap()
-            .iter()
-            .map(|(_, _, proof_step, stats)| ((*proof_step.inner).clone(), stats.clone()))
-            .collect::<Vec<(ProofStep, LocalProofStats)>>()
+        let leaf_proofs = self.leaf_proofs.read().unwrap();
+        let mut sorted_leaf_proofs = leaf_proofs.heap.iter().collect::<Vec<_>>();
+        sorted_leaf_proofs.sort_unstable();
+        sorted_leaf_proofs
+            .into_iter()
+            .map(|leaf_proof| {
+                (
+                    (*leaf_proof.proof_step.inner).clone(),
+                    leaf_proof.stats.clone(),
+                )
+            })
+            .collect()
+    }
+
+    /// Check if a proof step with the given running similarity and depth could still lead to a proof
+    /// that would be kept, given the proofs found so far. Running similarity never increases deeper in a proof,
+    /// so once max_proofs proofs at least this good have been found, there's no point searching further.
+    pub fn could_improve_proofs(&self, running_similarity: f64, depth: usize) -> bool {
+        if running_similarity <= self.min_similarity_threshold.load(Relaxed) {
+            return false;
+        }
+        let max_proofs = match self.max_proofs {
+            Some(max_proofs) => max_proofs,
+            None => return true,
+        };
+        let leaf_proofs = self.leaf_proofs.read().unwrap();
+        if leaf_proofs.heap.len() < max_proofs {
+            return true;
+        }
+        match leaf_proofs.heap.peek() {
+            Some(worst_leaf_proof) => {
+                running_similarity > worst_leaf_proof.similarity
+                    || (running_similarity == worst_leaf_proof.similarity
+                        && depth < worst_leaf_proof.depth)
+            }
+            None => false,
+        }
     }
 
     pub fn total_leaf_proofs(&self) -> usize {
-        self.scored_leaf_proof_steps.read().unwrap().len()
+        self.leaf_proofs.read().unwrap().heap.len()
     }
 
-    /// Check if the resolvent has already been seen at the current depth or below and if so, return False.
-    /// Otherwise, add it to the seen set and return True
-    pub fn check_resolvent(&self, proof_step: &ProofStep) -> bool {
+    /// Check if the resolvent has already been seen with at least as much search depth remaining
+    /// (at the current depth or below, for a fixed max_proof_depth) and at least as high a similarity,
+    /// and if so, return False. Otherwise, add it to the seen set and return True
+    pub fn check_resolvent(&self, proof_step: &ProofStep, max_proof_depth: usize) -> bool {
         if !self.skip_seen_resolvents {
             return true;
         }
-        let mut hasher = FxHasher::default();
-        proof_step.resolvent.hash(&mut hasher);
-        let resolvent_hash = hasher.finish();
-        let (is_new, _) = self.check_seen_resolvent_info(resolvent_hash, proof_step);
+        let remaining_depth = max_proof_depth.saturating_sub(proof_step.depth);
+        let (is_new, _) = self.check_seen_resolvent_info(
+            proof_step.resolvent.item.precomputed_hash(),
+            remaining_depth,
+            proof_step.running_similarity,
+        );
         is_new
     }
 
+    /// Check and update the seen resolvents map under a single shard lock.
+    /// Returns whether the resolvent is new, and the (remaining depth, similarity) now stored for it
     fn check_seen_resolvent_info(
         &self,
         resolvent_hash: u64,
-        proof_step: &ProofStep,
+        remaining_depth: usize,
+        running_similarity: f64,
     ) -> (bool, (usize, f64)) {
-        if let Some(seen_resolvent_data) = self.seen_resolvents.get(&resolvent_hash) {
-            let (prev_depth, prev_similarity) = *seen_resolvent_data;
-            if prev_depth <= proof_step.depth && prev_similarity >= proof_step.running_similarity {
-                return (false, (prev_depth, prev_similarity));
+        let seen_resolvent_data = (remaining_depth, running_similarity);
+        let mut is_new_entry = false;
+        {
+            let mut seen_resolvent_entry = self
+                .seen_resolvents
+                .entry(resolvent_hash)
+                .or_insert_with(|| {
+                    is_new_entry = true;
+                    seen_resolvent_data
+                });
+            if !is_new_entry {
+                let (prev_remaining_depth, prev_similarity) = *seen_resolvent_entry;
+                if prev_remaining_depth >= remaining_depth && prev_similarity >= running_similarity
+                {
+                    return (false, (prev_remaining_depth, prev_similarity));
+                }
+                *seen_resolvent_entry = seen_resolvent_data;
             }
         }
-        let seen_resolvent_data = (proof_step.depth, proof_step.running_similarity);
-        self.seen_resolvents
-            .insert(resolvent_hash, seen_resolvent_data);
-        return (true, seen_resolvent_data);
+        // the entry's shard lock has to be released before evicting
+        if is_new_entry {
+            let num_seen_resolvents = self.num_seen_resolvents.fetch_add(1, Relaxed) + 1;
+            if let Some(max_seen_resolvents) = self.max_seen_resolvents {
+                if num_seen_resolvents > max_seen_resolvents {
+                    self.evict_seen_resolvents(max_seen_resolvents);
+                }
+            }
+        }
+        (true, seen_resolvent_data)
+    }
+
+    /// Forget the least useful seen resolvents, down to 3/4 of max_seen_resolvents so evictions are infrequent.
+    /// Resolvents seen deepest in the search are forgotten first, since they prune the smallest subtrees,
+    /// and ties are broken by forgetting the lowest similarity resolvents first
+    fn evict_seen_resolvents(&self, max_seen_resolvents: usize) {
+        // if another worker is already evicting, there's no need to wait for it
+        let _eviction_guard = match self.seen_resolvents_eviction.try_lock() {
+            Ok(eviction_guard) => eviction_guard,
+            Err(_) => return,
+        };
+        let mut seen_resolvents = self
+            .seen_resolvents
+            .iter()
+            .map(|entry| (*entry.key(), *entry.value()))
+            .collect::<Vec<_>>();
+        let num_to_keep = max_seen_resolvents - max_seen_resolvents / 4;
+        if seen_resolvents.len() <= num_to_keep {
+            return;
+        }
+        let num_to_evict = seen_resolvents.len() - num_to_keep;
+        seen_resolvents.select_nth_unstable_by(num_to_evict - 1, |(_, a), (_, b)| {
+            a.0.cmp(&b.0).then_with(|| a.1.total_cmp(&b.1))
+        });
+        let mut num_evicted = 0;
+        for (resolvent_hash, _) in &seen_resolvents[..num_to_evict] {
+            if self.seen_resolvents.remove(resolvent_hash).is_some() {
+                num_evicted += 1;
+            }
+        }
+        self.num_seen_resolvents.fetch_sub(num_evicted, Relaxed);
+        self.stats
+            .evicted_resolvents
+            .fetch_add(num_evicted, Relaxed);
+    }
+
+    /// Forget every seen resolvent. Used between iterative deepening passes, since entries recorded
+    /// with a smaller max_proof_depth have less depth remaining than the next pass needs, so they rarely prune anything
+    pub fn clear_seen_resolvents(&self) {
+        self.seen_resolvents.clear();
+        self.num_seen_resolvents.store(0, Relaxed);
     }
 
     pub fn calc_similarity<T>(&self, source: &T, target: &T) -> f64
@@ -124,36 +392,153 @@ impl SharedProofContext {
     {
         match &self.similarity_cache {
             Some(_) => {
-                let src_key = source.similarity_key();
-                let tgt_key = target.similarity_key();
-                let key = src_key ^ tgt_key;
-                self.calc_similarity_cached(source, target, key)
+                let key = self.similarity_key(source, target);
+                let (similarity, lookup) = self.calc_similarity_cached(source, target, key);
+                match lookup {
+                    CacheLookup::Hit => {
+                        self.stats.similarity_cache_hits.fetch_add(1, Relaxed);
+                    }
+                    CacheLookup::Miss { evictions } => {
+                        self.stats.similarity_cache_misses.fetch_add(1, Relaxed);
+                        self.stats
+                            .similarity_cache_evictions
+                            .fetch_add(evictions, Relaxed);
+                    }
+                }
+                similarity
+            }
+            None => self.similarity_fn.calc(source, target),
+        }
+    }
+
+    /// Look up a similarity in the cache, without calculating it if it's missing
+    pub fn cached_similarity<T>(&self, source: &T, target: &T) -> Option<f64>
+    where
+        T: SimilarityComparable,
+    {
+        let key = self.similarity_key(source, target);
+        self.similarity_cache
+            .as_ref()
+            .and_then(|cache| cache.get(key))
+            .or_else(|| self.persisted_similarity(source, target))
+    }
+
+    /// Whether similarities should be prefetched using prefetch_similarities before they're needed
+    pub fn prefetches_similarities(&self) -> bool {
+        self.similarity_cache.is_some() && self.similarity_fn.is_batched()
+    }
+
+    /// Calculate and cache the similarities of all the pairs which aren't cached yet, in bulk.
+    /// These only count as cache misses once they're looked up
+    pub fn prefetch_similarities<T>(&self, pairs: &[(&T, &T)])
+    where
+        T: SimilarityComparable + IntoPy<PyObject> + Clone,
+    {
+        let cache = match &self.similarity_cache {
+            Some(cache) => cache,
+            None => return,
+        };
+        let mut pending_keys = FxHashSet::default();
+        let mut pending_pairs = Vec::new();
+        for &(source, target) in pairs {
+            let key = self.similarity_key(source, target);
+            if cache.contains_key(key) || !pending_keys.insert(key) {
+                continue;
+            }
+            if self.persisted_similarity(source, target).is_none() {
+                pending_pairs.push((source, target));
             }
-            None => raw_calc_similarity(&self.py_similarity_fn, source, target),
         }
+        if pending_pairs.is_empty() {
+            return;
+        }
+        let similarities = self.similarity_fn.calc_batch(&pending_pairs);
+        let mut evictions = 0;
+        for (&(source, target), similarity) in pending_pairs.iter().zip(similarities) {
+            let key = self.similarity_key(source, target);
+            evictions += cache.insert(key, source, target, similarity);
+            self.prefetched_similarities.insert(key, ());
+        }
+        self.stats
+            .similarity_cache_evictions
+            .fetch_add(evictions, Relaxed);
+    }
+
+    fn similarity_key<T>(&self, source: &T, target: &T) -> SimilarityKey
+    where
+        T: SimilarityComparable,
+    {
+        SimilarityKey::new(source, target, self.symmetric_similarity)
     }
 
-    fn calc_similarity_cached<T>(&self, source: &T, target: &T, key: u64) -> f64
+    fn calc_similarity_cached<T>(
+        &self,
+        source: &T,
+        target: &T,
+        key: SimilarityKey,
+    ) -> (f64, CacheLookup)
     where
         T: SimilarityComparable + IntoPy<PyObject> + Clone,
     {
         let cache = self.similarity_cache.as_ref().unwrap();
-        if let Some(similarity) = cache.get(&key) {
-            return *similarity;
+        if let Some(similarity) = cache.get(key) {
+            if self.similarity_fn.is_batched()
+                && self.prefetched_similarities.remove(&key).is_some()
+            {
+                return (similarity, CacheLookup::Miss { evictions: 0 });
+            }
+            return (similarity, CacheLookup::Hit);
+        }
+        if let Some(similarity) = self.persisted_similarity(source, target) {
+            return (similarity, CacheLookup::Hit);
+        }
+        let similarity = self.similarity_fn.calc(source, target);
+        let evictions = cache.insert(key, source, target, similarity);
+        (similarity, CacheLookup::Miss { evictions })
+    }
+
+    /// Look up a similarity in the similarities loaded from disk.
+    /// The stable key is only worked out if similarities were loaded, since it can take the GIL
+    fn persisted_similarity<T>(&self, source: &T, target: &T) -> Option<f64>
+    where
+        T: SimilarityComparable,
+    {
+        let persistent = self.persistent_similarity_cache.as_ref()?;
+        persistent.get(StableSimilarityKey::new(
+            source,
+            target,
+            self.symmetric_similarity,
+        )?)
+    }
+}
+impl Drop for SharedProofContext {
+    fn drop(&mut self) {
+        // add this search's lookups to the totals for the cache, which outlives the search
+        if let Some(cache) = &self.similarity_cache {
+            cache.record_lookups(
+                self.stats.similarity_cache_hits.load(Relaxed),
+                self.stats.similarity_cache_misses.load(Relaxed),
+            );
+            // so the cache doesn't keep the embeddings of this search's items alive
+            cache.resolve_stable_ids();
         }
-        // avoiding if/else here to avoid deadlocks around the read and write locks held at the same time
-        let similarity = raw_calc_similarity(&self.py_similarity_fn, source, target);
-        cache.insert(key.clone(), similarity);
-        similarity
     }
 }
 
+/// Whether a similarity was found in the cache, or had to be calculated and inserted
+enum CacheLookup {
+    Hit,
+    Miss { evictions: usize },
+}
+
 /// A wrapper context for each thread to avoid needing to always load from the shared context
 /// to reduce contention
 pub struct LocalProofContext<'a> {
     pub shared: &'a SharedProofContext,
     pub stats: LocalProofStats,
     fallthrough_similarity_cache: Option<FallthroughSimilarityCache>,
+    // front table for the shared seen resolvents map, so repeated lookups on this thread skip the shared map
+    seen_resolvents: FxHashMap<u64, (usize, f64)>,
 }
 
 impl<'a> LocalProofContext<'a> {
@@ -166,6 +551,7 @@ impl<'a> LocalProofContext<'a> {
             shared,
             fallthrough_similarity_cache,
             stats: LocalProofStats::new(),
+            seen_resolvents: FxHashMap::default(),
         }
     }
 
@@ -177,24 +563,63 @@ impl<'a> LocalProofContext<'a> {
     {
         match self.fallthrough_similarity_cache.as_mut() {
             Some(cache) => {
-                let src_key = source.similarity_key();
-                let tgt_key = target.similarity_key();
-                let key = src_key ^ tgt_key;
+                let key = self.shared.similarity_key(source, target);
                 if let Some(similarity) = cache.get(&key) {
+                    self.stats.similarity_cache_hits += 1;
                     return *similarity;
                 }
-                let similarity = self.shared.calc_similarity_cached(source, target, key);
-                cache.insert(key.clone(), similarity);
+                let (similarity, lookup) = self.shared.calc_similarity_cached(source, target, key);
+                match lookup {
+                    CacheLookup::Hit => self.stats.similarity_cache_hits += 1,
+                    CacheLookup::Miss { evictions } => {
+                        self.stats.similarity_cache_misses += 1;
+                        self.stats.similarity_cache_evictions += evictions;
+                    }
+                }
+                if cache.len() >= MAX_LOCAL_SIMILARITIES {
+                    cache.clear();
+                }
+                cache.insert(key, similarity);
                 similarity
             }
             None => self.shared.calc_similarity(source, target),
         }
     }
 
-    /// Check if the resolvent has already been seen at the current depth or below and if so, return False.
-    /// Otherwise, add it to the seen set and return True
-    pub fn check_resolvent(&mut self, proof_step: &ProofStep) -> bool {
-        self.shared.check_resolvent(proof_step)
+    /// Check if the resolvent has already been seen with at least as much search depth remaining
+    /// and at least as high a similarity, and if so, return False. Otherwise, add it to the seen set and return True
+    pub fn check_resolvent(&mut self, proof_step: &ProofStep, max_proof_depth: usize) -> bool {
+        if !self.shared.skip_seen_resolvents {
+            return true;
+        }
+        let resolvent_hash = proof_step.resolvent.item.precomputed_hash();
+        let remaining_depth = max_proof_depth.saturating_sub(proof_step.depth);
+        // anything this context has already seen was also recorded in the shared map, so it can be skipped locally
+        if let Some(&(prev_remaining_depth, prev_similarity)) =
+            self.seen_resolvents.get(&resolvent_hash)
+        {
+            if prev_remaining_depth >= remaining_depth
+                && prev_similarity >= proof_step.running_similarity
+            {
+                return false;
+            }
+        }
+        let (is_new, seen_resolvent_data) = self.shared.check_seen_resolvent_info(
+            resolvent_hash,
+            remaining_depth,
+            proof_step.running_similarity,
+        );
+        if self.seen_resolvents.len() >= MAX_LOCAL_SEEN_RESOLVENTS {
+            self.seen_resolvents.clear();
+        }
+        self.seen_resolvents
+            .insert(resolvent_hash, seen_resolvent_data);
+        is_new
+    }
+
+    /// Forget the resolvents this context has seen, after the shared seen resolvents are cleared
+    pub fn clear_seen_resolvents(&mut self) {
+        self.seen_resolvents.clear();
     }
 
     pub fn min_similarity_threshold(&self) -> f64 {
@@ -219,40 +644,28 @@ impl<'a> LocalProofContext<'a> {
         main_stats
             .discarded_proofs
             .fetch_add(self.stats.discarded_proofs, Relaxed);
+        main_stats
+            .similarity_cache_hits
+            .fetch_add(self.stats.similarity_cache_hits, Relaxed);
+        main_stats
+            .similarity_cache_misses
+            .fetch_add(self.stats.similarity_cache_misses, Relaxed);
+        main_stats
+            .similarity_cache_evictions
+            .fetch_add(self.stats.similarity_cache_evictions, Relaxed);
         self.stats = LocalProofStats::new();
     }
 }
 
-// perform the actual similarity calculation, ignoring caching
-fn raw_calc_similarity<T>(py_similarity_fn: &Option<PyObject>, src: &T, tgt: &T) -> f64
-where
-    T: SimilarityComparable + IntoPy<PyObject> + Clone,
-{
-    match py_similarity_fn {
-        Some(py_similarity_fn) => {
-            Python::with_gil(|py| {
-                // TODO: make sure similarity_func is callable, and handle errors better
-                let py_res = py_similarity_fn
-                    .call1(py, (src.clone(), tgt.clone()))
-                    .unwrap();
-                py_res.extract::<f64>(py).unwrap()
-            })
-        }
-        None => {
-            // if no similarity function is provided, just do plain string equality on symbols
-            if src.symbol() == tgt.symbol() {
-                1.0
-            } else {
-                0.0
-            }
-        }
-    }
-}
-
 #[cfg(test)]
 mod test {
     use rustc_hash::FxHashMap;
 
+    use pyo3::prelude::*;
+    use std::sync::atomic::Ordering::Relaxed;
+    use std::sync::Arc;
+
+    use super::{SimilarityCache, SimilarityFn};
     use crate::prover::{ProofStep, ProofStepNode};
     use crate::types::{Atom, CNFDisjunction, CNFLiteral, Predicate};
     use crate::util::PyArcItem;
@@ -280,67 +693,268 @@ mod test {
 
     #[test]
     fn test_new() {
-        let ctx = super::SharedProofContext::new(0.0, Some(2), false, None, None);
+        let ctx =
+            super::SharedProofContext::new(0.0, Some(2), false, None, SimilarityFn::SymbolCompare);
         assert_eq!(ctx.max_proofs, Some(2));
     }
 
+    fn leaf_proof_steps(ctx: &super::SharedProofContext) -> Vec<ProofStep> {
+        ctx.leaf_proof_steps_with_stats()
+            .into_iter()
+            .map(|(proof_step, _)| proof_step)
+            .collect()
+    }
+
     #[test]
     fn test_record_leaf_proof_keeps_step_with_highest_similarity() {
-        let ctx = super::SharedProofContext::new(0.0, Some(1), false, None, None);
+        let ctx =
+            super::SharedProofContext::new(0.0, Some(1), false, None, SimilarityFn::SymbolCompare);
         let proof_step1 = create_proof_step_node(2, 0.5);
         ctx.record_leaf_proof(proof_step1.clone());
-        assert_eq!(ctx.scored_leaf_proof_steps.read().unwrap().len(), 1);
-        assert_eq!(
-            ctx.scored_leaf_proof_steps.read().unwrap()[0].2,
-            proof_step1
-        );
+        assert_eq!(leaf_proof_steps(&ctx), vec![(*proof_step1.inner).clone()]);
         // higher similarity, so it should kick out step 1
         let proof_step2 = create_proof_step_node(4, 0.6);
         ctx.record_leaf_proof(proof_step2.clone());
-        assert_eq!(ctx.scored_leaf_proof_steps.read().unwrap().len(), 1);
-        assert_eq!(
-            ctx.scored_leaf_proof_steps.read().unwrap()[0].2,
-            proof_step2
-        );
+        assert_eq!(leaf_proof_steps(&ctx), vec![(*proof_step2.inner).clone()]);
     }
 
     #[test]
     fn test_record_leaf_proof_keeps_step_with_lowest_depth_if_similarity_is_equal() {
-        let ctx = super::SharedProofContext::new(0.0, Some(1), false, None, None);
+        let ctx =
+            super::SharedProofContext::new(0.0, Some(1), false, None, SimilarityFn::SymbolCompare);
         let proof_step1 = create_proof_step_node(4, 0.5);
         ctx.record_leaf_proof(proof_step1.clone());
-        assert_eq!(ctx.scored_leaf_proof_steps.read().unwrap().len(), 1);
-        assert_eq!(
-            ctx.scored_leaf_proof_steps.read().unwrap()[0].2,
-            proof_step1
-        );
-        // higher similarity, so it should kick out step 1
+        assert_eq!(leaf_proof_steps(&ctx), vec![(*proof_step1.inner).clone()]);
+        // same similarity but shallower, so it should kick out step 1
         let proof_step2 = create_proof_step_node(3, 0.5);
         ctx.record_leaf_proof(proof_step2.clone());
-        assert_eq!(ctx.scored_leaf_proof_steps.read().unwrap().len(), 1);
-        assert_eq!(
-            ctx.scored_leaf_proof_steps.read().unwrap()[0].2,
-            proof_step2
-        );
+        assert_eq!(leaf_proof_steps(&ctx), vec![(*proof_step2.inner).clone()]);
+        // same similarity and depth as step 2, so step 2 was found first and is kept
+        ctx.record_leaf_proof(create_proof_step_node(3, 0.5));
+        assert_eq!(leaf_proof_steps(&ctx), vec![(*proof_step2.inner).clone()]);
+    }
+
+    #[test]
+    fn test_record_leaf_proof_keeps_the_best_max_proofs_steps_sorted() {
+        let ctx =
+            super::SharedProofContext::new(0.0, Some(2), false, None, SimilarityFn::SymbolCompare);
+        for (depth, similarity) in [(1, 0.2), (1, 0.7), (2, 0.4), (1, 0.9), (1, 0.1)] {
+            ctx.record_leaf_proof(create_proof_step_node(depth, similarity));
+        }
+        let similarities = leaf_proof_steps(&ctx)
+            .iter()
+            .map(|proof_step| proof_step.running_similarity)
+            .collect::<Vec<_>>();
+        assert_eq!(similarities, vec![0.9, 0.7]);
+        assert_eq!(ctx.total_leaf_proofs(), 2);
+        assert_eq!(ctx.stats.discarded_proofs.load(Relaxed), 3);
+        assert_eq!(ctx.min_similarity_threshold.load(Relaxed), 0.7);
+        assert!(!ctx.could_improve_proofs(0.5, 1));
+        assert!(ctx.could_improve_proofs(0.8, 5));
+    }
+
+    #[test]
+    fn test_should_stop_once_the_deadline_has_passed() {
+        let ctx =
+            super::SharedProofContext::new(0.0, None, false, None, SimilarityFn::SymbolCompare);
+        assert!(!ctx.should_stop());
+
+        let ctx = ctx.with_deadline(Some(std::time::Instant::now()));
+        assert!(ctx.should_stop());
+        assert!(ctx.stats.copy_and_freeze().truncated);
+    }
+
+    #[test]
+    fn test_should_stop_once_cancelled() {
+        let token = super::CancellationToken::new();
+        let ctx =
+            super::SharedProofContext::new(0.0, None, false, None, SimilarityFn::SymbolCompare)
+                .with_cancellation_token(Some(token.clone()));
+        assert!(!ctx.should_stop());
+
+        token.cancel();
+        assert!(ctx.should_stop());
+        assert!(ctx.stats.copy_and_freeze().truncated);
+    }
+
+    #[test]
+    fn test_should_stop_once_any_token_is_cancelled() {
+        let token1 = super::CancellationToken::new();
+        let token2 = super::CancellationToken::new();
+        let ctx =
+            super::SharedProofContext::new(0.0, None, false, None, SimilarityFn::SymbolCompare)
+                .with_cancellation_token(Some(token1.clone()))
+                .with_cancellation_token(Some(token2.clone()));
+        assert!(!ctx.should_stop());
+
+        token2.cancel();
+        assert!(ctx.should_stop());
+        assert!(!token1.is_cancelled());
     }
 
     #[test]
     fn test_check_resolvent() {
         let ctx: super::SharedProofContext =
-            super::SharedProofContext::new(0.0, Some(1), true, None, None);
+            super::SharedProofContext::new(0.0, Some(1), true, None, SimilarityFn::SymbolCompare);
         let proof_step = create_proof_step_node(4, 0.5);
-        assert!(ctx.check_resolvent(&proof_step.inner));
+        assert!(ctx.check_resolvent(&proof_step.inner, 10));
 
         let worse_sim_step = create_proof_step_node(4, 0.4);
-        assert!(!ctx.check_resolvent(&worse_sim_step.inner));
+        assert!(!ctx.check_resolvent(&worse_sim_step.inner, 10));
 
         let worse_depth_step = create_proof_step_node(5, 0.5);
-        assert!(!ctx.check_resolvent(&worse_depth_step.inner));
+        assert!(!ctx.check_resolvent(&worse_depth_step.inner, 10));
 
         let better_sim_step = create_proof_step_node(4, 0.6);
-        assert!(ctx.check_resolvent(&better_sim_step.inner));
+        assert!(ctx.check_resolvent(&better_sim_step.inner, 10));
 
         let better_depth_step = create_proof_step_node(3, 0.5);
-        assert!(ctx.check_resolvent(&better_depth_step.inner));
+        assert!(ctx.check_resolvent(&better_depth_step.inner, 10));
+    }
+
+    #[test]
+    fn test_check_resolvent_allows_revisiting_with_a_higher_max_proof_depth() {
+        let ctx: super::SharedProofContext =
+            super::SharedProofContext::new(0.0, Some(1), true, None, SimilarityFn::SymbolCompare);
+        let proof_step = create_proof_step_node(4, 0.5);
+        assert!(ctx.check_resolvent(&proof_step.inner, 5));
+        assert!(!ctx.check_resolvent(&proof_step.inner, 5));
+        assert!(ctx.check_resolvent(&proof_step.inner, 6));
+
+        let deeper_step = create_proof_step_node(5, 0.5);
+        assert!(!ctx.check_resolvent(&deeper_step.inner, 7));
+    }
+
+    #[test]
+    fn test_local_check_resolvent_shares_seen_resolvents_between_local_contexts() {
+        let shared_ctx =
+            super::SharedProofContext::new(0.0, Some(1), true, None, SimilarityFn::SymbolCompare);
+        let mut ctx1 = super::LocalProofContext::new(&shared_ctx);
+        let mut ctx2 = super::LocalProofContext::new(&shared_ctx);
+        let proof_step = create_proof_step_node(4, 0.5);
+        assert!(ctx1.check_resolvent(&proof_step.inner, 10));
+        assert!(!ctx1.check_resolvent(&proof_step.inner, 10));
+        assert!(!ctx2.check_resolvent(&proof_step.inner, 10));
+
+        // ctx1's local entry doesn't cover the better step, so it falls through to the shared map
+        let better_sim_step = create_proof_step_node(4, 0.6);
+        assert!(ctx2.check_resolvent(&better_sim_step.inner, 10));
+        assert!(!ctx1.check_resolvent(&better_sim_step.inner, 10));
+    }
+
+    #[test]
+    fn test_clear_seen_resolvents_forgets_every_resolvent() {
+        let shared_ctx =
+            super::SharedProofContext::new(0.0, Some(1), true, None, SimilarityFn::SymbolCompare);
+        let mut ctx = super::LocalProofContext::new(&shared_ctx);
+        let proof_step = create_proof_step_node(4, 0.5);
+        assert!(ctx.check_resolvent(&proof_step.inner, 10));
+        assert!(!ctx.check_resolvent(&proof_step.inner, 10));
+        shared_ctx.clear_seen_resolvents();
+        ctx.clear_seen_resolvents();
+        assert!(ctx.check_resolvent(&proof_step.inner, 10));
+        assert_eq!(shared_ctx.num_seen_resolvents.load(Relaxed), 1);
+    }
+
+    #[test]
+    fn test_seen_resolvents_evicts_the_deepest_resolvents_once_full() {
+        let ctx =
+            super::SharedProofContext::new(0.0, None, true, None, SimilarityFn::SymbolCompare)
+                .with_max_seen_resolvents(Some(4));
+        for (resolvent_hash, remaining_depth) in [(1, 5), (2, 1), (3, 4), (4, 2), (5, 3)] {
+            let (is_new, _) = ctx.check_seen_resolvent_info(resolvent_hash, remaining_depth, 0.5);
+            assert!(is_new);
+        }
+        // going over the limit evicts down to 3 resolvents, dropping the ones with the least depth remaining
+        assert_eq!(ctx.stats.evicted_resolvents.load(Relaxed), 2);
+        assert_eq!(ctx.num_seen_resolvents.load(Relaxed), 3);
+        for resolvent_hash in [1, 3, 5] {
+            assert!(ctx.seen_resolvents.contains_key(&resolvent_hash));
+        }
+        // forgotten resolvents are treated as new again
+        let (is_new, _) = ctx.check_seen_resolvent_info(2, 1, 0.5);
+        assert!(is_new);
+    }
+
+    #[test]
+    fn test_prefetch_similarities_calls_batch_fn_once_for_uncached_pairs() {
+        pyo3::prepare_freethreaded_python();
+        let batch_similarity_fn: PyObject = Python::with_gil(|py| {
+            let module = PyModule::from_code(
+                py,
+                r#"
+calls = []
+
+def batch_similarity(items_a, items_b):
+    calls.append(len(items_a))
+    return [0.75 for _ in items_a]
+                "#,
+                "",
+                "",
+            )
+            .unwrap();
+            module.getattr("batch_similarity").unwrap().into()
+        });
+        let ctx = super::SharedProofContext::new(
+            0.0,
+            None,
+            false,
+            Some(Arc::new(SimilarityCache::default())),
+            SimilarityFn::PythonBatch(batch_similarity_fn.clone()),
+        );
+        assert!(ctx.prefetches_similarities());
+        let pred1 = Predicate::new("pred1", None);
+        let pred2 = Predicate::new("pred2", None);
+        let pred3 = Predicate::new("pred3", None);
+        ctx.prefetch_similarities(&[(&pred1, &pred2), (&pred2, &pred1), (&pred1, &pred3)]);
+        // all pairs are already cached, so this shouldn't call the batch fn again
+        ctx.prefetch_similarities(&[(&pred1, &pred2)]);
+
+        assert_eq!(ctx.cached_similarity(&pred2, &pred1), Some(0.75));
+        assert_eq!(ctx.cached_similarity(&pred2, &pred3), None);
+        let calls: Vec<usize> = Python::with_gil(|py| {
+            let module = batch_similarity_fn.getattr(py, "__globals__").unwrap();
+            module
+                .as_ref(py)
+                .get_item("calls")
+                .unwrap()
+                .extract()
+                .unwrap()
+        });
+        assert_eq!(calls, vec![2]);
+    }
+
+    #[test]
+    fn test_prefetched_similarities_count_as_one_miss_when_looked_up() {
+        pyo3::prepare_freethreaded_python();
+        let batch_similarity_fn: PyObject = Python::with_gil(|py| {
+            let module = PyModule::from_code(
+                py,
+                r#"
+def batch_similarity(items_a, items_b):
+    return [0.75 for _ in items_a]
+                "#,
+                "",
+                "",
+            )
+            .unwrap();
+            module.getattr("batch_similarity").unwrap().into()
+        });
+        let ctx = super::SharedProofContext::new(
+            0.0,
+            None,
+            false,
+            Some(Arc::new(SimilarityCache::default())),
+            SimilarityFn::PythonBatch(batch_similarity_fn),
+        );
+        let pred1 = Predicate::new("pred1", None);
+        let pred2 = Predicate::new("pred2", None);
+        ctx.prefetch_similarities(&[(&pred1, &pred2)]);
+        assert_eq!(ctx.stats.similarity_cache_misses.load(Relaxed), 0);
+
+        assert_eq!(ctx.calc_similarity(&pred1, &pred2), 0.75);
+        assert_eq!(ctx.calc_similarity(&pred1, &pred2), 0.75);
+        assert_eq!(ctx.stats.similarity_cache_misses.load(Relaxed), 1);
+        assert_eq!(ctx.stats.similarity_cache_hits.load(Relaxed), 1);
     }
 }
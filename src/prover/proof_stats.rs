@@ -1,5 +1,5 @@
-use std::sync::atomic::AtomicUsize;
 use std::sync::atomic::Ordering::Relaxed;
+use std::sync::atomic::{AtomicBool, AtomicUsize};
 
 use pyo3::prelude::*;
 
@@ -10,6 +10,14 @@ pub struct SharedProofStats {
     pub max_resolvent_width_seen: AtomicUsize,
     pub max_depth_seen: AtomicUsize,
     pub discarded_proofs: AtomicUsize,
+    // seen resolvents which were forgotten to stay within max_seen_resolvents
+    pub evicted_resolvents: AtomicUsize,
+    pub similarity_cache_hits: AtomicUsize,
+    pub similarity_cache_misses: AtomicUsize,
+    // similarities evicted from the similarity cache to make room for this search's similarities
+    pub similarity_cache_evictions: AtomicUsize,
+    // set if the search was stopped before it finished, e.g. because it ran out of time
+    pub truncated: AtomicBool,
 }
 impl SharedProofStats {
     pub fn new() -> Self {
@@ -19,6 +27,11 @@ impl SharedProofStats {
             max_resolvent_width_seen: AtomicUsize::new(0),
             max_depth_seen: AtomicUsize::new(0),
             discarded_proofs: AtomicUsize::new(0),
+            evicted_resolvents: AtomicUsize::new(0),
+            similarity_cache_hits: AtomicUsize::new(0),
+            similarity_cache_misses: AtomicUsize::new(0),
+            similarity_cache_evictions: AtomicUsize::new(0),
+            truncated: AtomicBool::new(false),
         }
     }
 }
@@ -30,6 +43,11 @@ impl SharedProofStats {
             max_resolvent_width_seen: self.max_resolvent_width_seen.load(Relaxed),
             max_depth_seen: self.max_depth_seen.load(Relaxed),
             discarded_proofs: self.discarded_proofs.load(Relaxed),
+            evicted_resolvents: self.evicted_resolvents.load(Relaxed),
+            similarity_cache_hits: self.similarity_cache_hits.load(Relaxed),
+            similarity_cache_misses: self.similarity_cache_misses.load(Relaxed),
+            similarity_cache_evictions: self.similarity_cache_evictions.load(Relaxed),
+            truncated: self.truncated.load(Relaxed),
         }
     }
 }
@@ -47,6 +65,16 @@ pub struct LocalProofStats {
     pub max_depth_seen: usize,
     #[pyo3(get)]
     pub discarded_proofs: usize,
+    #[pyo3(get)]
+    pub evicted_resolvents: usize,
+    #[pyo3(get)]
+    pub similarity_cache_hits: usize,
+    #[pyo3(get)]
+    pub similarity_cache_misses: usize,
+    #[pyo3(get)]
+    pub similarity_cache_evictions: usize,
+    #[pyo3(get)]
+    pub truncated: bool,
 }
 impl LocalProofStats {
     pub fn new() -> Self {
@@ -56,6 +84,11 @@ impl LocalProofStats {
             max_resolvent_width_seen: 0,
             max_depth_seen: 0,
             discarded_proofs: 0,
+            evicted_resolvents: 0,
+            similarity_cache_hits: 0,
+            similarity_cache_misses: 0,
+            similarity_cache_evictions: 0,
+            truncated: false,
         }
     }
 }
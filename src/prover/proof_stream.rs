@@ -0,0 +1,94 @@
+use std::sync::mpsc::{sync_channel, Receiver, SyncSender};
+use std::sync::Mutex;
+
+use pyo3::exceptions::PyRuntimeError;
+use pyo3::prelude::*;
+
+use super::cancellation_token::CancellationToken;
+use super::Proof;
+
+/// Sending half of a ProofStream. The search sends each proof as soon as it's found,
+/// or an error message if the search failed
+pub type ProofSender = SyncSender<Result<Proof, String>>;
+
+/// Iterator over the proofs of a search running in the background, in the order they're found.
+/// Proofs are passed through a bounded channel, so the search waits once buffer_size proofs are waiting to be read.
+/// Cancelling or dropping the stream cancels the rest of the search. The stream has its own cancellation token,
+/// which the search checks alongside the caller's, so the caller's token is never cancelled by the stream
+#[pyclass(name = "RsProofStream")]
+pub struct ProofStream {
+    receiver: Mutex<Option<Receiver<Result<Proof, String>>>>,
+    cancellation_token: CancellationToken,
+}
+impl ProofStream {
+    pub fn new(buffer_size: usize) -> (Self, ProofSender) {
+        let (sender, receiver) = sync_channel(buffer_size);
+        let stream = Self {
+            receiver: Mutex::new(Some(receiver)),
+            cancellation_token: CancellationToken::new(),
+        };
+        (stream, sender)
+    }
+
+    /// The token cancelled when the stream is cancelled or dropped, for the search to check
+    pub fn cancellation_token(&self) -> CancellationToken {
+        self.cancellation_token.clone()
+    }
+}
+#[pymethods]
+impl ProofStream {
+    pub fn __iter__(slf: PyRef<'_, Self>) -> PyRef<'_, Self> {
+        slf
+    }
+
+    pub fn __next__(&self, py: Python<'_>) -> PyResult<Option<Proof>> {
+        let receiver = match self.receiver.lock().unwrap().take() {
+            Some(receiver) => receiver,
+            None => return Ok(None),
+        };
+        // the receiver can't be shared between threads, so move it out while waiting without the GIL
+        let (next, receiver) = py.allow_threads(move || (receiver.recv(), receiver));
+        match next {
+            Ok(Ok(proof)) => {
+                *self.receiver.lock().unwrap() = Some(receiver);
+                Ok(Some(proof))
+            }
+            Ok(Err(message)) => Err(PyRuntimeError::new_err(message)),
+            // every sender has been dropped, so the search is done
+            Err(_) => Ok(None),
+        }
+    }
+
+    /// Stop the search, and drop any proofs which haven't been read yet
+    pub fn cancel(&self) {
+        self.cancellation_token.cancel();
+        self.receiver.lock().unwrap().take();
+    }
+}
+impl Drop for ProofStream {
+    fn drop(&mut self) {
+        self.cancellation_token.cancel();
+    }
+}
+
+#[cfg(test)]
+mod test {
+    use super::*;
+
+    #[test]
+    fn test_cancelling_the_stream_disconnects_the_sender() {
+        let (stream, sender) = ProofStream::new(1);
+        let token = stream.cancellation_token();
+        stream.cancel();
+        assert!(token.is_cancelled());
+        assert!(sender.send(Err("unread".to_string())).is_err());
+    }
+
+    #[test]
+    fn test_dropping_the_stream_cancels_the_search() {
+        let (stream, _sender) = ProofStream::new(1);
+        let token = stream.cancellation_token();
+        drop(stream);
+        assert!(token.is_cancelled());
+    }
+}
@@ -1,13 +1,30 @@
+use std::any::Any;
+use std::cmp::Ordering;
 use std::collections::{BTreeSet, VecDeque};
+use std::panic::{self, AssertUnwindSafe};
 use std::sync::atomic::Ordering::Relaxed;
+use std::sync::{Arc, Mutex};
+use std::time::{Duration, Instant};
 
+use pyo3::exceptions::PyValueError;
 use pyo3::prelude::*;
+use pyo3::types::PyBytes;
 
-use crate::types::CNFDisjunction;
+use crate::types::{CNFDisjunction, Constant, EmbeddingIdentity, Predicate, Term};
 use crate::util::PyArcItem;
 
+use super::cancellation_token::CancellationToken;
+use super::frontier::Frontier;
+use super::knowledge_index::{KnowledgeIndex, LayeredKnowledgeIndex, PredicateMatching};
 use super::operations::resolve;
-use super::similarity_cache::SimilarityCache;
+use super::persistent_similarity_cache::{serialize_similarities, PersistentSimilarityCache};
+use super::proof_stream::{ProofSender, ProofStream};
+use super::search_strategy::SearchStrategy;
+use super::similarity::{
+    similarity_fingerprint, EmbeddingLookup, EmbeddingTable, NativeSimilarity, SimilarityFn,
+};
+use super::similarity_cache::{cache_similarity_matrix, SimilarityCache, SimilarityCacheStats};
+use super::thread_pool::get_thread_pool;
 use super::{LocalProofContext, LocalProofStats, Proof, ProofStepNode, SharedProofContext};
 
 #[derive(Clone, Debug)]
@@ -16,23 +33,47 @@ struct ResolutionProverConfig {
     max_resolution_attempts: Option<usize>,
     max_resolvent_width: Option<usize>,
     skip_seen_resolvents: bool,
+    max_seen_resolvents: Option<usize>,
+    symmetric_similarity: bool,
     find_highest_similarity_proofs: bool,
     eval_batch_size: usize,
+    search_strategy: SearchStrategy,
+    // leaf proofs shallower than this aren't recorded, since an earlier iterative deepening pass already found them
+    min_leaf_proof_depth: usize,
 }
 
 #[pyclass(name = "RsResolutionProverBackend")]
 pub struct ResolutionProverBackend {
     min_similarity_threshold: f64,
     py_similarity_fn: Option<PyObject>,
-    similarity_cache: Option<SimilarityCache>,
+    py_batch_similarity_fn: Option<PyObject>,
+    native_similarity: Option<NativeSimilarity>,
+    embedding_identity: EmbeddingIdentity,
+    // native views of the embeddings in the base knowledge, only populated when using a native similarity
+    embeddings: Arc<EmbeddingTable>,
+    // shared between queries, so similarities only need to be calculated once
+    similarity_cache: Option<Arc<SimilarityCache>>,
+    // if true, the similarity cache tracks the stable ids needed to save it to disk
+    persist_similarity_cache: bool,
+    // similarities loaded from disk, layered underneath the similarity cache
+    persistent_similarity_cache: Option<Arc<PersistentSimilarityCache>>,
+    // identifies the similarity function in saved similarities, so they're only loaded by provers using the same one
+    similarity_fingerprint: u64,
     base_knowledge: BTreeSet<PyArcItem<CNFDisjunction>>,
+    // index over the base knowledge, shared with every query rather than rebuilt for each one
+    knowledge_index: Arc<KnowledgeIndex>,
+    predicate_matching: PredicateMatching,
     num_workers: usize,
+    share_thread_pool: bool,
+    // kept alive between queries, so each query doesn't pay to spawn and tear down its worker threads
+    threadpool: Arc<rayon::ThreadPool>,
     config: ResolutionProverConfig,
 }
 #[pymethods]
 impl ResolutionProverBackend {
     #[new]
     pub fn new(
+        py: Python<'_>,
         max_proof_depth: usize,
         max_resolvent_width: Option<usize>,
         max_resolution_attempts: Option<usize>,
@@ -44,31 +85,134 @@ impl ResolutionProverBackend {
         base_knowledge: BTreeSet<PyArcItem<CNFDisjunction>>,
         num_workers: usize,
         eval_batch_size: usize,
-    ) -> Self {
+        predicate_matching: &str,
+        native_similarity: Option<NativeSimilarity>,
+        py_batch_similarity_fn: Option<PyObject>,
+        share_thread_pool: bool,
+        search_strategy: &str,
+        beam_width: Option<usize>,
+        max_seen_resolvents: Option<usize>,
+        similarity_cache_size: Option<usize>,
+        symmetric_similarity: bool,
+        embedding_identity: &str,
+        persist_similarity_cache: bool,
+    ) -> PyResult<Self> {
+        let embedding_identity = EmbeddingIdentity::parse(embedding_identity).ok_or_else(|| {
+            PyValueError::new_err(format!(
+                "Unknown embedding identity: {}",
+                embedding_identity
+            ))
+        })?;
+        let predicate_matching = PredicateMatching::parse(predicate_matching).ok_or_else(|| {
+            PyValueError::new_err(format!(
+                "Unknown predicate matching: {}",
+                predicate_matching
+            ))
+        })?;
+        let search_strategy = SearchStrategy::parse(search_strategy).ok_or_else(|| {
+            PyValueError::new_err(format!("Unknown search strategy: {}", search_strategy))
+        })?;
+        let search_strategy = match (search_strategy, beam_width) {
+            (search_strategy, None) => search_strategy,
+            (_, Some(0)) => return Err(PyValueError::new_err("beam_width must be at least 1")),
+            (SearchStrategy::BreadthFirst, Some(beam_width)) => SearchStrategy::Beam(beam_width),
+            _ => {
+                return Err(PyValueError::new_err(
+                    "beam_width can only be used with breadth_first search",
+                ))
+            }
+        };
+        if similarity_cache_size == Some(0) {
+            return Err(PyValueError::new_err(
+                "similarity_cache_size must be at least 1",
+            ));
+        }
+        if max_seen_resolvents == Some(0) {
+            return Err(PyValueError::new_err(
+                "max_seen_resolvents must be at least 1",
+            ));
+        }
         let config = ResolutionProverConfig {
             max_proof_depth,
             max_resolvent_width,
             max_resolution_attempts,
             skip_seen_resolvents,
+            max_seen_resolvents,
+            symmetric_similarity,
             find_highest_similarity_proofs,
             eval_batch_size,
+            search_strategy,
+            min_leaf_proof_depth: 0,
         };
-        Self {
+        let similarity_fingerprint = similarity_fingerprint(
+            py,
+            py_similarity_fn.as_ref(),
+            py_batch_similarity_fn.as_ref(),
+            native_similarity.as_ref(),
+        );
+        let mut backend = Self {
             py_similarity_fn,
+            py_batch_similarity_fn,
+            native_similarity,
+            embedding_identity,
+            embeddings: Arc::new(EmbeddingTable::default()),
             min_similarity_threshold,
             similarity_cache: if cache_similarity {
-                Some(SimilarityCache::default())
+                Some(Arc::new(
+                    SimilarityCache::new(similarity_cache_size)
+                        .with_stable_ids(persist_similarity_cache),
+                ))
             } else {
                 None
             },
-            base_knowledge,
+            persist_similarity_cache,
+            persistent_similarity_cache: None,
+            similarity_fingerprint,
+            knowledge_index: Arc::new(KnowledgeIndex::new(vec![], predicate_matching)),
+            base_knowledge: BTreeSet::new(),
+            predicate_matching,
             num_workers,
+            share_thread_pool,
+            threadpool: get_thread_pool(num_workers, share_thread_pool)?,
             config,
+        };
+        backend.extend_knowledge(
+            py,
+            base_knowledge
+                .into_iter()
+                .map(|clause| clause.item.as_ref().clone())
+                .collect(),
+        )?;
+        Ok(backend)
+    }
+
+    pub fn extend_knowledge(
+        &mut self,
+        py: Python<'_>,
+        knowledge: BTreeSet<CNFDisjunction>,
+    ) -> PyResult<()> {
+        let knowledge = self.identify_embeddings(py, knowledge);
+        if self.uses_native_embeddings() {
+            // copy embeddings out of Python now, while we hold the GIL anyway
+            Arc::make_mut(&mut self.embeddings).ingest(py, knowledge.iter(), None)?;
         }
+        let knowledge_index = Arc::make_mut(&mut self.knowledge_index);
+        for clause in knowledge_to_arc(knowledge) {
+            if self.base_knowledge.insert(clause.clone()) {
+                knowledge_index.insert(clause);
+            }
+        }
+        Ok(())
     }
 
-    pub fn extend_knowledge(&mut self, knowledge: BTreeSet<CNFDisjunction>) {
-        self.base_knowledge.extend(knowledge_to_arc(knowledge));
+    /// Change the number of worker threads used for proof search.
+    /// The thread pool is only rebuilt if the number of workers actually changes.
+    pub fn set_num_workers(&mut self, num_workers: usize) -> PyResult<()> {
+        if num_workers != self.num_workers {
+            self.threadpool = get_thread_pool(num_workers, self.share_thread_pool)?;
+            self.num_workers = num_workers;
+        }
+        Ok(())
     }
 
     /// Find all possible proofs for the given goal, sorted by similarity score.
@@ -80,39 +224,488 @@ impl ResolutionProverBackend {
         extra_knowledge: Option<BTreeSet<CNFDisjunction>>,
         max_proofs: Option<usize>,
         skip_seen_resolvents: Option<bool>,
-    ) -> (Vec<Proof>, LocalProofStats) {
-        let parsed_extra_knowledge = extra_knowledge.unwrap_or_default();
-        let mut proofs = vec![];
-        let mut knowledge = self.base_knowledge.clone();
-        let arc_inverted_goals = knowledge_to_arc(inverted_goals.clone());
-        knowledge.extend(knowledge_to_arc(parsed_extra_knowledge));
-        knowledge.extend(arc_inverted_goals.clone());
+        timeout: Option<f64>,
+        cancellation_token: Option<CancellationToken>,
+    ) -> PyResult<(Vec<Proof>, LocalProofStats)> {
+        let options = QueryOptions {
+            max_proofs,
+            skip_seen_resolvents,
+            deadline: deadline_from_timeout(timeout)?,
+            cancellation_token,
+            internal_cancellation_token: None,
+            proof_sender: None,
+        };
+        let query = self.prepare_query(
+            py,
+            inverted_goals,
+            extra_knowledge.unwrap_or_default(),
+            &options,
+        )?;
+        self.run_queries(py, std::slice::from_ref(&query));
+        Ok(query.into_proofs_with_stats())
+    }
+
+    /// Start searching for all possible proofs for the given goal in the background, without blocking.
+    /// Once the search finishes, callback is called from a worker thread with (proofs_with_stats, None),
+    /// or with (None, error_message) if the search failed.
+    /// Returns a token which stops only this search, leaving the caller's cancellation token alone
+    pub fn prove_all_with_stats_async(
+        &self,
+        py: Python<'_>,
+        inverted_goals: BTreeSet<CNFDisjunction>,
+        extra_knowledge: Option<BTreeSet<CNFDisjunction>>,
+        max_proofs: Option<usize>,
+        skip_seen_resolvents: Option<bool>,
+        timeout: Option<f64>,
+        cancellation_token: Option<CancellationToken>,
+        callback: PyObject,
+    ) -> PyResult<CancellationToken> {
+        let search_cancellation_token = CancellationToken::new();
+        let options = QueryOptions {
+            max_proofs,
+            skip_seen_resolvents,
+            deadline: deadline_from_timeout(timeout)?,
+            cancellation_token,
+            internal_cancellation_token: Some(search_cancellation_token.clone()),
+            proof_sender: None,
+        };
+        let query = self.prepare_query(
+            py,
+            inverted_goals,
+            extra_knowledge.unwrap_or_default(),
+            &options,
+        )?;
+        let threadpool = self.threadpool.clone();
+        let config = self.config.clone();
+        self.threadpool.spawn(move || {
+            // a panic here would abort the whole process, so catch it and hand it back to Python instead
+            let result = panic::catch_unwind(AssertUnwindSafe(|| {
+                search_queries(&threadpool, &config, std::slice::from_ref(&query));
+                query.into_proofs_with_stats()
+            }));
+            Python::with_gil(|py| {
+                let args = match result {
+                    Ok(proofs_with_stats) => (Some(proofs_with_stats), None),
+                    Err(err) => (None, Some(panic_message(&err))),
+                };
+                if let Err(err) = callback.call1(py, args) {
+                    err.print(py);
+                }
+            });
+        });
+        Ok(search_cancellation_token)
+    }
+
+    /// Start searching for proofs of the given goal in the background, and return a stream which yields
+    /// each proof as soon as it's found. Proofs come out in the order they're found, not sorted by similarity
+    pub fn iter_proofs(
+        &self,
+        py: Python<'_>,
+        inverted_goals: BTreeSet<CNFDisjunction>,
+        extra_knowledge: Option<BTreeSet<CNFDisjunction>>,
+        skip_seen_resolvents: Option<bool>,
+        timeout: Option<f64>,
+        cancellation_token: Option<CancellationToken>,
+        buffer_size: usize,
+    ) -> PyResult<ProofStream> {
+        let (stream, proof_sender) = ProofStream::new(buffer_size);
+        let options = QueryOptions {
+            max_proofs: None,
+            skip_seen_resolvents,
+            deadline: deadline_from_timeout(timeout)?,
+            cancellation_token,
+            internal_cancellation_token: Some(stream.cancellation_token()),
+            proof_sender: Some(proof_sender.clone()),
+        };
+        let query = self.prepare_query(
+            py,
+            inverted_goals,
+            extra_knowledge.unwrap_or_default(),
+            &options,
+        )?;
+        let threadpool = self.threadpool.clone();
+        let config = self.config.clone();
+        self.threadpool.spawn(move || {
+            let result = panic::catch_unwind(AssertUnwindSafe(|| {
+                search_queries(&threadpool, &config, std::slice::from_ref(&query));
+            }));
+            if let Err(err) = result {
+                // the stream may have been dropped already, in which case nobody needs the error
+                let _ = proof_sender.send(Err(panic_message(&err)));
+            }
+        });
+        Ok(stream)
+    }
+
+    /// Find all possible proofs for each of the given goals, sorted by similarity score.
+    /// All the goals are searched concurrently on the same thread pool, sharing the similarity cache.
+    /// Return the proofs and the stats for each goal, in the same order as the goals.
+    pub fn prove_all_batch_with_stats(
+        &self,
+        py: Python<'_>,
+        inverted_goals_batch: Vec<BTreeSet<CNFDisjunction>>,
+        extra_knowledge: Option<BTreeSet<CNFDisjunction>>,
+        max_proofs: Option<usize>,
+        skip_seen_resolvents: Option<bool>,
+        timeout: Option<f64>,
+        cancellation_token: Option<CancellationToken>,
+    ) -> PyResult<Vec<(Vec<Proof>, LocalProofStats)>> {
+        // all the goals share a single deadline and cancellation token, since they're searched at the same time
+        let options = QueryOptions {
+            max_proofs,
+            skip_seen_resolvents,
+            deadline: deadline_from_timeout(timeout)?,
+            cancellation_token,
+            internal_cancellation_token: None,
+            proof_sender: None,
+        };
+        let extra_knowledge = extra_knowledge.unwrap_or_default();
+        let queries = inverted_goals_batch
+            .into_iter()
+            .map(|inverted_goals| {
+                self.prepare_query(py, inverted_goals, extra_knowledge.clone(), &options)
+            })
+            .collect::<PyResult<Vec<_>>>()?;
+        self.run_queries(py, &queries);
+        Ok(queries
+            .into_iter()
+            .map(|query| query.into_proofs_with_stats())
+            .collect())
+    }
+
+    /// Store precomputed similarities between each source and each target predicate in the similarity cache.
+    /// similarities must be a float64 matrix of shape (len(sources), len(targets))
+    pub fn cache_predicate_similarities(
+        &self,
+        py: Python<'_>,
+        sources: Vec<Predicate>,
+        targets: Vec<Predicate>,
+        similarities: &PyAny,
+    ) -> PyResult<()> {
+        let sources = self.identify_items(sources, |source| source.by_content(py));
+        let targets = self.identify_items(targets, |target| target.by_content(py));
+        cache_similarity_matrix(
+            py,
+            self.similarity_cache()?,
+            &sources,
+            &targets,
+            similarities,
+            self.config.symmetric_similarity,
+        )
+    }
+
+    /// Store precomputed similarities between each source and each target constant in the similarity cache.
+    /// similarities must be a float64 matrix of shape (len(sources), len(targets))
+    pub fn cache_constant_similarities(
+        &self,
+        py: Python<'_>,
+        sources: Vec<Constant>,
+        targets: Vec<Constant>,
+        similarities: &PyAny,
+    ) -> PyResult<()> {
+        let sources = self.identify_items(sources, |source| source.by_content(py));
+        let targets = self.identify_items(targets, |target| target.by_content(py));
+        cache_similarity_matrix(
+            py,
+            self.similarity_cache()?,
+            &sources,
+            &targets,
+            similarities,
+            self.config.symmetric_similarity,
+        )
+    }
+
+    pub fn purge_similarity_cache(&mut self) {
+        if let Some(similarity_cache) = self.similarity_cache.as_mut() {
+            *similarity_cache = Arc::new(
+                SimilarityCache::new(similarity_cache.capacity())
+                    .with_stable_ids(similarity_cache.tracks_stable_ids()),
+            );
+        }
+    }
+
+    /// Serialize every cached similarity, along with any similarities loaded from disk, into the format read by
+    /// load_similarity_cache. Similarities between items whose embeddings can't be read are left out
+    pub fn export_similarity_cache(&self, py: Python<'_>) -> PyResult<PyObject> {
+        let similarity_cache = self.persistable_similarity_cache()?;
+        if !self.persist_similarity_cache {
+            return Err(PyValueError::new_err(
+                "Saving similarities requires persist_similarity_cache=True",
+            ));
+        }
+        // similarities in memory come first, so they take precedence over any loaded from disk
+        let similarities = similarity_cache.stable_similarities(self.config.symmetric_similarity);
+        let persistent_similarity_cache = self.persistent_similarity_cache.as_deref();
+        let bytes = py.allow_threads(|| {
+            let persisted_similarities = persistent_similarity_cache
+                .into_iter()
+                .flat_map(|persistent| persistent.iter());
+            serialize_similarities(
+                similarities.into_iter().chain(persisted_similarities),
+                self.config.symmetric_similarity,
+                self.similarity_fingerprint,
+            )
+        });
+        Ok(PyBytes::new(py, &bytes).into())
+    }
+
+    /// Look up similarities which aren't in the similarity cache in data produced by export_similarity_cache,
+    /// before calculating them. The data must be a read-only buffer, such as a read-only mmap of a saved file,
+    /// which is borrowed rather than copied. This replaces any similarities loaded previously
+    pub fn load_similarity_cache(&mut self, data: &PyAny) -> PyResult<()> {
+        self.persistable_similarity_cache()?;
+        self.persistent_similarity_cache = Some(Arc::new(PersistentSimilarityCache::load(
+            data,
+            self.similarity_fingerprint,
+        )?));
+        Ok(())
+    }
+
+    /// Stats on the similarity cache since it was created or last purged, or None if caching is disabled
+    pub fn similarity_cache_stats(&self) -> Option<SimilarityCacheStats> {
+        self.similarity_cache
+            .as_ref()
+            .map(|similarity_cache| similarity_cache.stats())
+    }
+
+    pub fn reset(&mut self) {
+        self.base_knowledge = BTreeSet::new();
+        self.knowledge_index = Arc::new(KnowledgeIndex::new(vec![], self.predicate_matching));
+        self.embeddings = Arc::new(EmbeddingTable::default());
+        self.purge_similarity_cache();
+        self.persistent_similarity_cache = None;
+    }
+}
+impl ResolutionProverBackend {
+    /// Set up everything needed to search for proofs of a single goal, while we still hold the GIL
+    fn prepare_query(
+        &self,
+        py: Python<'_>,
+        inverted_goals: BTreeSet<CNFDisjunction>,
+        extra_knowledge: BTreeSet<CNFDisjunction>,
+        options: &QueryOptions,
+    ) -> PyResult<Query> {
+        let inverted_goals = self.identify_embeddings(py, inverted_goals);
+        let extra_knowledge = self.identify_embeddings(py, extra_knowledge);
+        let similarity_fn =
+            self.build_similarity_fn(py, inverted_goals.iter().chain(extra_knowledge.iter()))?;
+        let arc_inverted_goals = knowledge_to_arc(inverted_goals);
+        // only the clauses specific to this query are indexed here, the base knowledge index is shared as-is
+        let mut query_knowledge = knowledge_to_arc(extra_knowledge);
+        query_knowledge.extend(arc_inverted_goals.iter().cloned());
+        query_knowledge.retain(|clause| !self.base_knowledge.contains(clause));
+        let knowledge = LayeredKnowledgeIndex::new(
+            self.knowledge_index.clone(),
+            KnowledgeIndex::new(query_knowledge, self.predicate_matching),
+        );
         let ctx = SharedProofContext::new(
             self.min_similarity_threshold,
-            max_proofs,
-            skip_seen_resolvents.unwrap_or(self.config.skip_seen_resolvents),
+            options.max_proofs,
+            options
+                .skip_seen_resolvents
+                .unwrap_or(self.config.skip_seen_resolvents),
             self.similarity_cache.clone(),
-            self.py_similarity_fn.clone(),
-        );
+            similarity_fn,
+        )
+        .with_deadline(options.deadline)
+        .with_cancellation_token(options.cancellation_token.clone())
+        .with_cancellation_token(options.internal_cancellation_token.clone())
+        .with_proof_sender(options.proof_sender.clone())
+        .with_max_seen_resolvents(self.config.max_seen_resolvents)
+        .with_symmetric_similarity(self.config.symmetric_similarity)
+        .with_persistent_similarity_cache(self.persistent_similarity_cache.clone());
+        Ok(Query {
+            inverted_goals: arc_inverted_goals,
+            knowledge,
+            ctx,
+            max_proofs: options.max_proofs,
+        })
+    }
 
-        let threadpool = rayon::ThreadPoolBuilder::new()
-            .num_threads(self.num_workers)
-            .build()
-            .unwrap();
+    /// Search for proofs of all the queries concurrently, with the GIL released
+    fn run_queries(&self, py: Python<'_>, queries: &[Query]) {
+        py.allow_threads(|| search_queries(&self.threadpool, &self.config, queries));
+    }
 
-        py.allow_threads(|| {
-            threadpool.scope(|scope| {
-                let batch = arc_inverted_goals
-                    .into_iter()
-                    .map(|inverted_goal| (inverted_goal, None))
+    fn similarity_cache(&self) -> PyResult<&SimilarityCache> {
+        self.similarity_cache.as_deref().ok_or_else(|| {
+            PyValueError::new_err("Precomputing similarities requires cache_similarity=True")
+        })
+    }
+
+    /// Re-identify the embeddings in the clauses by content, if that's how this prover identifies embeddings.
+    /// Embeddings are always identified by object when they're created
+    fn identify_embeddings(
+        &self,
+        py: Python<'_>,
+        clauses: BTreeSet<CNFDisjunction>,
+    ) -> BTreeSet<CNFDisjunction> {
+        match self.embedding_identity {
+            EmbeddingIdentity::Object => clauses,
+            EmbeddingIdentity::Content => clauses
+                .into_iter()
+                .map(|clause| clause.by_content(py))
+                .collect(),
+        }
+    }
+
+    fn identify_items<T>(&self, items: Vec<T>, by_content: impl Fn(&T) -> T) -> Vec<T> {
+        match self.embedding_identity {
+            EmbeddingIdentity::Object => items,
+            EmbeddingIdentity::Content => items.iter().map(by_content).collect(),
+        }
+    }
+
+    fn persistable_similarity_cache(&self) -> PyResult<&SimilarityCache> {
+        self.similarity_cache.as_deref().ok_or_else(|| {
+            PyValueError::new_err("Saving and loading similarities requires cache_similarity=True")
+        })
+    }
+
+    fn uses_native_embeddings(&self) -> bool {
+        self.native_similarity
+            .as_ref()
+            .map_or(false, |native_similarity| {
+                native_similarity.uses_embeddings()
+            })
+    }
+
+    /// Pick the similarity function for a single query.
+    /// For native similarities, this takes views of any embeddings which only appear in the query clauses
+    fn build_similarity_fn<'a, I>(&self, py: Python<'_>, query_clauses: I) -> PyResult<SimilarityFn>
+    where
+        I: IntoIterator<Item = &'a CNFDisjunction>,
+    {
+        if let Some(native_similarity) = &self.native_similarity {
+            let mut query_embeddings = EmbeddingTable::default();
+            if native_similarity.uses_embeddings() {
+                query_embeddings.ingest(py, query_clauses, Some(&self.embeddings))?;
+            }
+            let embeddings = EmbeddingLookup::new(self.embeddings.clone(), query_embeddings);
+            return Ok(SimilarityFn::Native(native_similarity.clone(), embeddings));
+        }
+        Ok(
+            match (&self.py_batch_similarity_fn, &self.py_similarity_fn) {
+                (Some(py_batch_similarity_fn), _) => {
+                    SimilarityFn::PythonBatch(py_batch_similarity_fn.clone_ref(py))
+                }
+                (None, Some(py_similarity_fn)) => {
+                    SimilarityFn::Python(py_similarity_fn.clone_ref(py))
+                }
+                (None, None) => SimilarityFn::SymbolCompare,
+            },
+        )
+    }
+}
+
+/// Search for proofs of all the queries concurrently on the thread pool, blocking until they're all done
+fn search_queries(
+    threadpool: &rayon::ThreadPool,
+    config: &ResolutionProverConfig,
+    queries: &[Query],
+) {
+    let num_workers = threadpool.current_num_threads();
+    let frontiers = queries
+        .iter()
+        .map(|query| match config.search_strategy {
+            SearchStrategy::BestFirst => {
+                Some(Frontier::new(query.inverted_goals.iter().map(
+                    |inverted_goal| FrontierNode::new(inverted_goal.clone(), None),
+                )))
+            }
+            SearchStrategy::BreadthFirst
+            | SearchStrategy::Beam(_)
+            | SearchStrategy::IterativeDeepening => None,
+        })
+        .collect::<Vec<_>>();
+    threadpool.scope(|scope| {
+        for (query, frontier) in queries.iter().zip(frontiers.iter()) {
+            if let Some(frontier) = frontier {
+                for _ in 0..num_workers {
+                    scope.spawn(move |_| {
+                        let worker_ctx = LocalProofContext::new(&query.ctx);
+                        search_for_proofs_best_first(
+                            frontier,
+                            config,
+                            &query.knowledge,
+                            worker_ctx,
+                        );
+                    });
+                }
+                continue;
+            }
+            if config.search_strategy == SearchStrategy::IterativeDeepening {
+                scope.spawn(move |_| {
+                    search_for_proofs_iterative_deepening(query, config);
+                });
+                continue;
+            }
+            if let SearchStrategy::Beam(beam_width) = config.search_strategy {
+                scope.spawn(move |_| {
+                    search_for_proofs_beam(query, config, beam_width, num_workers);
+                });
+                continue;
+            }
+            scope.spawn(move |scope| {
+                let batch = query
+                    .inverted_goals
+                    .iter()
+                    .map(|inverted_goal| (inverted_goal.clone(), None))
                     .collect::<VecDeque<_>>();
-                let worker_ctx = LocalProofContext::new(&ctx);
-                search_for_proofs_batch(batch, &self.config, &knowledge, worker_ctx, scope);
+                let worker_ctx = LocalProofContext::new(&query.ctx);
+                search_for_proofs_batch(batch, config, &query.knowledge, worker_ctx, scope);
             });
-        });
+        }
+    });
+}
+
+fn panic_message(err: &Box<dyn Any + Send>) -> String {
+    if let Some(message) = err.downcast_ref::<&str>() {
+        message.to_string()
+    } else if let Some(message) = err.downcast_ref::<String>() {
+        message.clone()
+    } else {
+        "Proof search panicked".to_string()
+    }
+}
+
+/// Settings for a single call to prove, on top of the prover's config
+struct QueryOptions {
+    max_proofs: Option<usize>,
+    skip_seen_resolvents: Option<bool>,
+    deadline: Option<Instant>,
+    cancellation_token: Option<CancellationToken>,
+    // the search's own token, set when the proofs are streamed or awaited. It's cancelled once the stream is
+    // cancelled or dropped, or the awaiting task is cancelled, so the caller's token is never cancelled for them
+    internal_cancellation_token: Option<CancellationToken>,
+    proof_sender: Option<ProofSender>,
+}
 
-        let frozen_stats = ctx.stats.copy_and_freeze();
-        for (leaf_proof_step, leaf_proof_stats) in ctx.leaf_proof_steps_with_stats() {
+fn deadline_from_timeout(timeout: Option<f64>) -> PyResult<Option<Instant>> {
+    match timeout {
+        None => Ok(None),
+        Some(timeout) if timeout.is_nan() || timeout < 0.0 => Err(PyValueError::new_err(
+            "timeout must be a non-negative number of seconds",
+        )),
+        // a timeout too long to represent is the same as no timeout, including an infinite timeout
+        Some(timeout) => Ok(Duration::try_from_secs_f64(timeout)
+            .ok()
+            .and_then(|timeout| Instant::now().checked_add(timeout))),
+    }
+}
+
+/// The state of the proof search for a single goal
+struct Query {
+    inverted_goals: BTreeSet<PyArcItem<CNFDisjunction>>,
+    knowledge: LayeredKnowledgeIndex,
+    ctx: SharedProofContext,
+    max_proofs: Option<usize>,
+}
+impl Query {
+    fn into_proofs_with_stats(self) -> (Vec<Proof>, LocalProofStats) {
+        let frozen_stats = self.ctx.stats.copy_and_freeze();
+        let mut proofs = vec![];
+        for (leaf_proof_step, leaf_proof_stats) in self.ctx.leaf_proof_steps_with_stats() {
             proofs.push(Proof::new(
                 leaf_proof_step.running_similarity,
                 leaf_proof_stats,
@@ -121,34 +714,25 @@ impl ResolutionProverBackend {
         }
 
         proofs.sort_by(|a, b| b.similarity.partial_cmp(&a.similarity).unwrap());
-        if let Some(max_proofs) = max_proofs {
+        if let Some(max_proofs) = self.max_proofs {
             proofs.truncate(max_proofs);
         }
-
         (proofs, frozen_stats)
     }
-
-    pub fn purge_similarity_cache(&mut self) {
-        if let Some(_) = self.similarity_cache.as_mut() {
-            self.similarity_cache = Some(SimilarityCache::default());
-        }
-    }
-
-    pub fn reset(&mut self) {
-        self.base_knowledge = BTreeSet::new();
-        self.purge_similarity_cache();
-    }
 }
 
 fn search_for_proofs_batch<'a>(
     batch: VecDeque<(PyArcItem<CNFDisjunction>, Option<ProofStepNode>)>,
     config: &'a ResolutionProverConfig,
-    knowledge: &'a BTreeSet<PyArcItem<CNFDisjunction>>,
+    knowledge: &'a LayeredKnowledgeIndex,
     mut ctx: LocalProofContext<'a>,
     scope: &rayon::Scope<'a>,
 ) {
     let mut next_batch = batch;
     loop {
+        if ctx.shared.prefetches_similarities() {
+            prefetch_similarities(&next_batch, config, knowledge, &ctx);
+        }
         let mut results_accumulator = VecDeque::new();
         for (goal, parent_state) in next_batch {
             search_proof_step(
@@ -177,10 +761,322 @@ fn search_for_proofs_batch<'a>(
     }
 }
 
+/// Beam search, expanding one depth at a time and keeping only the best beam_width resolvents at each depth.
+/// Each depth is split into chunks which are expanded in parallel
+fn search_for_proofs_beam(
+    query: &Query,
+    config: &ResolutionProverConfig,
+    beam_width: usize,
+    num_workers: usize,
+) {
+    let mut beam = query
+        .inverted_goals
+        .iter()
+        .map(|inverted_goal| (inverted_goal.clone(), None))
+        .collect::<Vec<_>>();
+    while !beam.is_empty() {
+        let chunk_size = (beam.len() + num_workers - 1) / num_workers;
+        let mut chunk_results = vec![VecDeque::new(); (beam.len() + chunk_size - 1) / chunk_size];
+        rayon::scope(|scope| {
+            for (chunk, results_accumulator) in
+                beam.chunks(chunk_size).zip(chunk_results.iter_mut())
+            {
+                scope.spawn(move |_| {
+                    let mut ctx = LocalProofContext::new(&query.ctx);
+                    let batch = chunk.iter().cloned().collect::<VecDeque<_>>();
+                    if ctx.shared.prefetches_similarities() {
+                        prefetch_similarities(&batch, config, &query.knowledge, &ctx);
+                    }
+                    for (goal, parent_state) in batch {
+                        search_proof_step(
+                            goal,
+                            config,
+                            &query.knowledge,
+                            &mut ctx,
+                            parent_state,
+                            results_accumulator,
+                        );
+                    }
+                    ctx.sync_with_shared_ctx();
+                });
+            }
+        });
+        beam = chunk_results.into_iter().flatten().collect();
+        if beam.len() > beam_width {
+            // prefer the most similar resolvents, then the narrowest ones, which are closest to being a proof
+            beam.select_nth_unstable_by(beam_width - 1, |(_, a), (_, b)| {
+                let (a, b) = (&a.as_ref().unwrap().inner, &b.as_ref().unwrap().inner);
+                b.running_similarity
+                    .total_cmp(&a.running_similarity)
+                    .then_with(|| {
+                        a.resolvent
+                            .item
+                            .literals
+                            .len()
+                            .cmp(&b.resolvent.item.literals.len())
+                    })
+            });
+            beam.truncate(beam_width);
+        }
+    }
+}
+
+/// Iterative deepening search, running a parallel depth-first search with a depth limit of 1, 2, ... max_proof_depth.
+/// Seen resolvents are cleared before each pass, since every resolvent has more depth remaining than in the previous pass,
+/// so the previous pass's entries can't prune it. Local contexts, and their similarity caches, are reused across passes.
+/// Stops early once an iteration doesn't hit the depth limit, since deeper searches won't find anything new
+fn search_for_proofs_iterative_deepening(query: &Query, config: &ResolutionProverConfig) {
+    let ctx_pool = LocalProofContextPool::new(&query.ctx);
+    let mut depth_limit = config.max_proof_depth.min(1);
+    loop {
+        let iteration_config = ResolutionProverConfig {
+            max_proof_depth: depth_limit,
+            min_leaf_proof_depth: if depth_limit <= 1 {
+                0
+            } else {
+                max_leaf_proof_depth(depth_limit - 1) + 1
+            },
+            ..config.clone()
+        };
+        let iteration_config = &iteration_config;
+        let ctx_pool = &ctx_pool;
+        rayon::scope(|scope| {
+            for inverted_goal in query.inverted_goals.iter() {
+                scope.spawn(move |scope| {
+                    search_for_proofs_depth_first(
+                        (inverted_goal.clone(), None),
+                        iteration_config,
+                        &query.knowledge,
+                        ctx_pool,
+                        scope,
+                    );
+                });
+            }
+        });
+        let stats = &query.ctx.stats;
+        let hit_depth_limit = stats.max_depth_seen.load(Relaxed) >= depth_limit;
+        let hit_max_resolution_attempts =
+            config
+                .max_resolution_attempts
+                .map_or(false, |max_resolution_attempts| {
+                    stats.attempted_resolutions.load(Relaxed) >= max_resolution_attempts
+                });
+        let stopped = query.ctx.should_stop();
+        let found_enough_proofs = !config.find_highest_similarity_proofs
+            && query.max_proofs.map_or(false, |max_proofs| {
+                query.ctx.total_leaf_proofs() >= max_proofs
+            });
+        if depth_limit >= config.max_proof_depth
+            || !hit_depth_limit
+            || hit_max_resolution_attempts
+            || found_enough_proofs
+            || stopped
+        {
+            return;
+        }
+        query.ctx.clear_seen_resolvents();
+        ctx_pool.clear_seen_resolvents();
+        depth_limit += 1;
+    }
+}
+
+/// Local contexts of finished depth-first tasks, handed to the tasks spawned after them.
+/// At most one context per worker is in use at a time, so this creates about as many contexts as there are workers,
+/// rather than one per spawned sibling
+struct LocalProofContextPool<'a> {
+    shared: &'a SharedProofContext,
+    contexts: Mutex<Vec<LocalProofContext<'a>>>,
+}
+
+impl<'a> LocalProofContextPool<'a> {
+    fn new(shared: &'a SharedProofContext) -> Self {
+        Self {
+            shared,
+            contexts: Mutex::new(Vec::new()),
+        }
+    }
+
+    fn take(&self) -> LocalProofContext<'a> {
+        let ctx = self
+            .contexts
+            .lock()
+            .unwrap_or_else(|poisoned| poisoned.into_inner())
+            .pop();
+        ctx.unwrap_or_else(|| LocalProofContext::new(self.shared))
+    }
+
+    fn put_back(&self, ctx: LocalProofContext<'a>) {
+        self.contexts
+            .lock()
+            .unwrap_or_else(|poisoned| poisoned.into_inner())
+            .push(ctx);
+    }
+
+    fn clear_seen_resolvents(&self) {
+        let mut contexts = self
+            .contexts
+            .lock()
+            .unwrap_or_else(|poisoned| poisoned.into_inner());
+        for ctx in contexts.iter_mut() {
+            ctx.clear_seen_resolvents();
+        }
+    }
+}
+
+// the deepest leaf proof step a search with the given max_proof_depth can find.
+// resolving the inverted goals themselves happens at depth 0 without counting towards the limit
+fn max_leaf_proof_depth(max_proof_depth: usize) -> usize {
+    if max_proof_depth <= 1 {
+        0
+    } else {
+        max_proof_depth
+    }
+}
+
+/// Depth-first search from a single resolvent. The first child is searched next on this thread,
+/// and its siblings are spawned onto the rayon scope. Rayon runs spawned jobs on the same thread last-in-first-out,
+/// so the search stays depth-first, while idle workers steal the oldest (shallowest) subtrees.
+fn search_for_proofs_depth_first<'a, 'p: 'a>(
+    start: (PyArcItem<CNFDisjunction>, Option<ProofStepNode>),
+    config: &'a ResolutionProverConfig,
+    knowledge: &'a LayeredKnowledgeIndex,
+    ctx_pool: &'a LocalProofContextPool<'p>,
+    scope: &rayon::Scope<'a>,
+) {
+    let mut ctx = ctx_pool.take();
+    let mut next = Some(start);
+    while let Some(next_step) = next.take() {
+        let batch = VecDeque::from([next_step]);
+        if ctx.shared.prefetches_similarities() {
+            prefetch_similarities(&batch, config, knowledge, &ctx);
+        }
+        let mut results_accumulator = VecDeque::new();
+        for (goal, parent_state) in batch {
+            search_proof_step(
+                goal,
+                config,
+                knowledge,
+                &mut ctx,
+                parent_state,
+                &mut results_accumulator,
+            );
+        }
+        ctx.sync_with_shared_ctx();
+        let mut results = results_accumulator.into_iter();
+        next = results.next();
+        for sibling in results {
+            scope.spawn(move |scope| {
+                search_for_proofs_depth_first(sibling, config, knowledge, ctx_pool, scope);
+            });
+        }
+    }
+    ctx_pool.put_back(ctx);
+}
+
+/// A resolvent waiting to be expanded in a best-first search.
+/// Resolvents with higher running similarity come first, then shallower resolvents
+struct FrontierNode {
+    running_similarity: f64,
+    depth: usize,
+    goal: PyArcItem<CNFDisjunction>,
+    parent_state: Option<ProofStepNode>,
+}
+impl FrontierNode {
+    fn new(goal: PyArcItem<CNFDisjunction>, parent_state: Option<ProofStepNode>) -> Self {
+        let (running_similarity, depth) = match &parent_state {
+            Some(parent_state) => (
+                parent_state.inner.running_similarity,
+                parent_state.inner.depth,
+            ),
+            None => (f64::INFINITY, 0),
+        };
+        Self {
+            running_similarity,
+            depth,
+            goal,
+            parent_state,
+        }
+    }
+}
+impl PartialEq for FrontierNode {
+    fn eq(&self, other: &Self) -> bool {
+        self.cmp(other) == Ordering::Equal
+    }
+}
+impl Eq for FrontierNode {}
+impl PartialOrd for FrontierNode {
+    fn partial_cmp(&self, other: &Self) -> Option<Ordering> {
+        Some(self.cmp(other))
+    }
+}
+impl Ord for FrontierNode {
+    fn cmp(&self, other: &Self) -> Ordering {
+        self.running_similarity
+            .total_cmp(&other.running_similarity)
+            .then_with(|| other.depth.cmp(&self.depth))
+    }
+}
+
+// best-first workers sync their stats with the shared context every this many nodes,
+// rather than after every node, so expanding a node doesn't always contend on the shared atomics
+const BEST_FIRST_SYNC_INTERVAL: usize = 64;
+
+/// Worker loop for best-first search. Each worker repeatedly expands the best resolvent in the shared frontier,
+/// skipping any resolvent which can no longer lead to a better proof than the ones already found
+fn search_for_proofs_best_first(
+    frontier: &Frontier<FrontierNode>,
+    config: &ResolutionProverConfig,
+    knowledge: &LayeredKnowledgeIndex,
+    mut ctx: LocalProofContext,
+) {
+    let mut nodes_since_sync = 0;
+    // if search_proof_step panics, dropping the popped item still marks it as done,
+    // so the other workers don't wait on it forever
+    while let Some(mut item) = frontier.pop() {
+        if item.parent_state.is_some()
+            && !ctx
+                .shared
+                .could_improve_proofs(item.running_similarity, item.depth)
+        {
+            item.complete(vec![]);
+            continue;
+        }
+        let node = item.take();
+        let batch = VecDeque::from([(node.goal, node.parent_state)]);
+        if ctx.shared.prefetches_similarities() {
+            prefetch_similarities(&batch, config, knowledge, &ctx);
+        }
+        let mut results_accumulator = VecDeque::new();
+        for (goal, parent_state) in batch {
+            search_proof_step(
+                goal,
+                config,
+                knowledge,
+                &mut ctx,
+                parent_state,
+                &mut results_accumulator,
+            );
+        }
+        nodes_since_sync += 1;
+        // max_resolution_attempts is checked against the shared stats, so they need to stay up to date
+        if nodes_since_sync >= BEST_FIRST_SYNC_INTERVAL || config.max_resolution_attempts.is_some()
+        {
+            ctx.sync_with_shared_ctx();
+            nodes_since_sync = 0;
+        }
+        item.complete(
+            results_accumulator
+                .into_iter()
+                .map(|(goal, parent_state)| FrontierNode::new(goal, parent_state)),
+        );
+    }
+    ctx.sync_with_shared_ctx();
+}
+
 fn search_proof_step<'a>(
     goal: PyArcItem<CNFDisjunction>,
     config: &ResolutionProverConfig,
-    knowledge: &BTreeSet<PyArcItem<CNFDisjunction>>,
+    knowledge: &LayeredKnowledgeIndex,
     ctx: &mut LocalProofContext,
     parent_state: Option<ProofStepNode>,
     results_accumulator: &mut VecDeque<(PyArcItem<CNFDisjunction>, Option<ProofStepNode>)>,
@@ -189,6 +1085,9 @@ fn search_proof_step<'a>(
     if parent_state.is_some() && depth >= config.max_proof_depth {
         return;
     }
+    if ctx.shared.should_stop() {
+        return;
+    }
     if let Some(max_resolution_attempts) = config.max_resolution_attempts {
         if ctx.shared.stats.attempted_resolutions.load(Relaxed) >= max_resolution_attempts {
             return;
@@ -203,7 +1102,11 @@ fn search_proof_step<'a>(
         ctx.stats.max_depth_seen = depth + 1;
     }
     let mut num_sucessful_resolutions = 0;
-    for clause in knowledge {
+    // only clauses with a literal that can possibly resolve with the goal's first literal need to be checked
+    let goal_literal = goal.item.literals.iter().next().unwrap();
+    let candidates = knowledge.candidates(&goal_literal.item);
+    for clause_index in candidates.iter() {
+        let clause = knowledge.clause(clause_index);
         // resolution always ends up removing a literal from the clause and the goal, and combining the remaining literals
         // so we know what the length of the resolvent will be before we even try to resolve
         if let Some(max_resolvent_width) = config.max_resolvent_width {
@@ -211,19 +1114,21 @@ fn search_proof_step<'a>(
                 continue;
             }
         }
-        let next_steps = resolve(&goal, &clause, ctx, parent_state.as_ref());
+        let next_steps = resolve(&goal, clause, ctx, parent_state.as_ref());
         if next_steps.len() > 0 {
             num_sucessful_resolutions += 1;
         }
         let min_similarity_threshold = ctx.shared.min_similarity_threshold.load(Relaxed);
         for next_step in next_steps {
             if next_step.inner.resolvent.item.literals.is_empty() {
-                ctx.shared.record_leaf_proof(next_step);
+                if next_step.inner.depth >= config.min_leaf_proof_depth {
+                    ctx.shared.record_leaf_proof(next_step);
+                }
             } else if depth + 1 < config.max_proof_depth {
                 if next_step.inner.running_similarity <= min_similarity_threshold {
                     continue;
                 }
-                if !ctx.check_resolvent(&next_step.inner) {
+                if !ctx.check_resolvent(&next_step.inner, config.max_proof_depth) {
                     continue;
                 }
                 let resolvent_width = next_step.inner.resolvent.item.literals.len();
@@ -236,13 +1141,68 @@ fn search_proof_step<'a>(
     }
     // update stats at the end in bulk, doing this in the loop dramatically slows down multi-threaded performance
     // it may even be worth it to do this less often then every eval step
-    ctx.stats.attempted_resolutions += knowledge.len();
+    ctx.stats.attempted_resolutions += candidates.len();
     ctx.stats.successful_resolutions += num_sucessful_resolutions;
 }
 
+/// Calculate the similarities needed to resolve the goals in the batch in bulk,
+/// so the similarity function is called a handful of times per batch instead of once per pair.
+/// Predicates are prefetched first, so constants are only prefetched for literals whose predicates are similar enough
+fn prefetch_similarities(
+    batch: &VecDeque<(PyArcItem<CNFDisjunction>, Option<ProofStepNode>)>,
+    config: &ResolutionProverConfig,
+    knowledge: &LayeredKnowledgeIndex,
+    ctx: &LocalProofContext,
+) {
+    if ctx.shared.should_stop() {
+        return;
+    }
+    let mut literal_pairs = Vec::new();
+    for (goal, parent_state) in batch.iter() {
+        if let Some(parent_state) = parent_state {
+            if parent_state.inner.depth >= config.max_proof_depth {
+                continue;
+            }
+        }
+        let goal_literal = &goal.item.literals.iter().next().unwrap().item;
+        for clause_index in knowledge.candidates(goal_literal).iter() {
+            for literal in knowledge.clause(clause_index).item.literals.iter() {
+                if literal.item.polarity != goal_literal.polarity
+                    && literal.item.atom.terms.len() == goal_literal.atom.terms.len()
+                {
+                    literal_pairs.push((&goal_literal.atom, &literal.item.atom));
+                }
+            }
+        }
+    }
+    let predicate_pairs = literal_pairs
+        .iter()
+        .map(|(source, target)| (&source.predicate, &target.predicate))
+        .collect::<Vec<_>>();
+    ctx.shared.prefetch_similarities(&predicate_pairs);
+
+    let min_similarity_threshold = ctx.min_similarity_threshold();
+    let mut constant_pairs = Vec::new();
+    for (source, target) in literal_pairs {
+        let predicate_similarity = ctx
+            .shared
+            .cached_similarity(&source.predicate, &target.predicate);
+        if predicate_similarity.map_or(true, |similarity| similarity <= min_similarity_threshold) {
+            continue;
+        }
+        for (source_term, target_term) in source.terms.iter().zip(target.terms.iter()) {
+            if let (Term::Constant(source_const), Term::Constant(target_const)) =
+                (source_term, target_term)
+            {
+                if source_const != target_const {
+                    constant_pairs.push((source_const, target_const));
+                }
+            }
+        }
+    }
+    ctx.shared.prefetch_similarities(&constant_pairs);
+}
+
 fn knowledge_to_arc(knowledge: BTreeSet<CNFDisjunction>) -> BTreeSet<PyArcItem<CNFDisjunction>> {
-    knowledge
-        .into_iter()
-        .map(|x| PyArcItem::new(x.clone()))
-        .collect()
+    knowledge.into_iter().map(PyArcItem::new).collect()
 }
@@ -0,0 +1,25 @@
+/// The order in which the proof search explores resolvents
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum SearchStrategy {
+    /// Expand all resolvents at each depth in batches, before moving on to the next depth
+    BreadthFirst,
+    /// Always expand the resolvent with the highest running similarity next, so the best proofs are found early
+    /// and the rest of the search can be pruned
+    BestFirst,
+    /// Breadth-first search, but only the given number of resolvents with the highest running similarity
+    /// are kept at each depth. This bounds the time and memory used, but may miss proofs
+    Beam(usize),
+    /// Repeated depth-first searches with an increasing depth limit, so memory use is proportional
+    /// to the depth of the search times its branching factor, rather than the size of a whole depth layer
+    IterativeDeepening,
+}
+impl SearchStrategy {
+    pub fn parse(value: &str) -> Option<Self> {
+        match value {
+            "breadth_first" => Some(SearchStrategy::BreadthFirst),
+            "best_first" => Some(SearchStrategy::BestFirst),
+            "iterative_deepening" => Some(SearchStrategy::IterativeDeepening),
+            _ => None,
+        }
+    }
+}
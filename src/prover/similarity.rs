@@ -0,0 +1,446 @@
+use std::fmt;
+use std::sync::Arc;
+
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+use rustc_hash::FxHashMap;
+
+use crate::types::{CNFDisjunction, Embedding, SimilarityComparable, SimilarityKind, Term};
+use crate::util::{EmbeddingView, StableHasher};
+
+#[derive(Clone, Debug)]
+enum NativeSimilarityKind {
+    Cosine,
+    SymbolCompare,
+    Max(Vec<NativeSimilarity>),
+}
+
+/// A similarity function implemented natively in Rust, so it can be run by the worker threads
+/// without ever needing to acquire the GIL
+#[pyclass(name = "RsNativeSimilarity")]
+#[derive(Clone, Debug)]
+pub struct NativeSimilarity {
+    kind: NativeSimilarityKind,
+}
+#[pymethods]
+impl NativeSimilarity {
+    #[new]
+    pub fn new(kind: &str, funcs: Vec<NativeSimilarity>) -> PyResult<Self> {
+        let kind = match kind {
+            "cosine" => NativeSimilarityKind::Cosine,
+            "symbol_compare" => NativeSimilarityKind::SymbolCompare,
+            "max" if !funcs.is_empty() => NativeSimilarityKind::Max(funcs),
+            "max" => {
+                return Err(PyValueError::new_err(
+                    "max similarity requires at least 1 similarity function",
+                ))
+            }
+            _ => {
+                return Err(PyValueError::new_err(format!(
+                    "Unknown native similarity: {}",
+                    kind
+                )))
+            }
+        };
+        Ok(Self { kind })
+    }
+}
+impl NativeSimilarity {
+    /// Whether this similarity function needs to read embeddings at all
+    pub fn uses_embeddings(&self) -> bool {
+        match &self.kind {
+            NativeSimilarityKind::Cosine => true,
+            NativeSimilarityKind::SymbolCompare => false,
+            NativeSimilarityKind::Max(funcs) => funcs.iter().any(|func| func.uses_embeddings()),
+        }
+    }
+
+    /// Describes the function, including any functions it combines
+    pub fn name(&self) -> String {
+        match &self.kind {
+            NativeSimilarityKind::Cosine => "cosine".to_string(),
+            NativeSimilarityKind::SymbolCompare => "symbol_compare".to_string(),
+            NativeSimilarityKind::Max(funcs) => {
+                let names = funcs.iter().map(|func| func.name()).collect::<Vec<_>>();
+                format!("max({})", names.join(", "))
+            }
+        }
+    }
+
+    fn calc<T>(&self, embeddings: &EmbeddingLookup, src: &T, tgt: &T) -> f64
+    where
+        T: SimilarityComparable,
+    {
+        match &self.kind {
+            NativeSimilarityKind::SymbolCompare => symbol_compare(src, tgt),
+            NativeSimilarityKind::Cosine => {
+                match (src.embedding_id(), tgt.embedding_id()) {
+                    (Some(src_id), Some(tgt_id)) => {
+                        embeddings.get(src_id).cosine(embeddings.get(tgt_id))
+                    }
+                    // fall back to symbol comparison if either item is missing an embedding
+                    _ => symbol_compare(src, tgt),
+                }
+            }
+            NativeSimilarityKind::Max(funcs) => funcs
+                .iter()
+                .map(|func| func.calc(embeddings, src, tgt))
+                .fold(f64::NEG_INFINITY, f64::max),
+        }
+    }
+}
+
+/// A view of an embedding's values, borrowed from Python where possible, along with its precomputed norm
+pub struct NativeEmbedding {
+    view: EmbeddingView,
+    norm: f64,
+}
+impl NativeEmbedding {
+    pub fn new(view: EmbeddingView) -> Self {
+        let values = view.values();
+        let norm = values.dot(&values).sqrt();
+        Self { view, norm }
+    }
+
+    pub fn cosine(&self, other: &NativeEmbedding) -> f64 {
+        self.view.values().dot(&other.view.values()) / (self.norm * other.norm)
+    }
+}
+impl fmt::Debug for NativeEmbedding {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        f.debug_struct("NativeEmbedding")
+            .field("norm", &self.norm)
+            .finish()
+    }
+}
+
+/// Native views of the embeddings of predicates and constants, keyed by the embedding id.
+/// Views are taken while ingesting knowledge, when the GIL is already held,
+/// so the search itself never needs to touch Python objects.
+#[derive(Clone, Debug, Default)]
+pub struct EmbeddingTable {
+    embeddings: FxHashMap<isize, Arc<NativeEmbedding>>,
+    // the length of every predicate and every constant embedding, indexed by SimilarityKind
+    dimensions: [Option<usize>; 2],
+}
+impl EmbeddingTable {
+    pub fn get(&self, embedding_id: isize) -> Option<&NativeEmbedding> {
+        self.embeddings
+            .get(&embedding_id)
+            .map(|embedding| &**embedding)
+    }
+
+    /// Copy the embeddings from all the clauses which aren't already in this table or in the optional base table
+    pub fn ingest<'a, I>(
+        &mut self,
+        py: Python<'_>,
+        clauses: I,
+        base: Option<&EmbeddingTable>,
+    ) -> PyResult<()>
+    where
+        I: IntoIterator<Item = &'a CNFDisjunction>,
+    {
+        for clause in clauses {
+            for literal in clause.literals.iter() {
+                let predicate = &literal.item.atom.predicate;
+                self.ingest_embedding(py, SimilarityKind::Predicate, &predicate.embedding, base)?;
+                self.ingest_terms(py, &literal.item.atom.terms, base)?;
+            }
+        }
+        Ok(())
+    }
+
+    fn ingest_terms(
+        &mut self,
+        py: Python<'_>,
+        terms: &[Term],
+        base: Option<&EmbeddingTable>,
+    ) -> PyResult<()> {
+        for term in terms {
+            match term {
+                Term::Constant(constant) => {
+                    self.ingest_embedding(py, SimilarityKind::Constant, &constant.embedding, base)?
+                }
+                Term::BoundFunction(bound_function) => {
+                    self.ingest_terms(py, &bound_function.terms, base)?
+                }
+                Term::Variable(_) => {}
+            }
+        }
+        Ok(())
+    }
+
+    fn ingest_embedding(
+        &mut self,
+        py: Python<'_>,
+        kind: SimilarityKind,
+        embedding: &Option<Arc<Embedding>>,
+        base: Option<&EmbeddingTable>,
+    ) -> PyResult<()> {
+        if let Some(embedding) = embedding {
+            if self.embeddings.contains_key(&embedding.id)
+                || base.map_or(false, |base| base.get(embedding.id).is_some())
+            {
+                return Ok(());
+            }
+            let view = EmbeddingView::new(embedding.object.as_ref(py)).map_err(|_| {
+                PyValueError::new_err(
+                    "Native similarity requires embeddings to be 1D arrays or sequences of floats",
+                )
+            })?;
+            self.check_dimension(kind, view.values().len(), base)?;
+            self.embeddings
+                .insert(embedding.id, Arc::new(NativeEmbedding::new(view)));
+        }
+        Ok(())
+    }
+
+    // cosine similarity of embeddings with different lengths is meaningless, so reject them up front
+    // rather than silently comparing only the shared prefix during the search
+    fn check_dimension(
+        &mut self,
+        kind: SimilarityKind,
+        dimension: usize,
+        base: Option<&EmbeddingTable>,
+    ) -> PyResult<()> {
+        let expected = self.dimensions[kind as usize]
+            .or_else(|| base.and_then(|base| base.dimensions[kind as usize]));
+        match expected {
+            Some(expected) if expected != dimension => Err(PyValueError::new_err(format!(
+                "Native similarity requires all {} embeddings to have the same length, but got lengths {} and {}",
+                kind.name(),
+                expected,
+                dimension
+            ))),
+            _ => {
+                self.dimensions[kind as usize] = Some(dimension);
+                Ok(())
+            }
+        }
+    }
+}
+
+/// Embeddings from the knowledge base, layered with the embeddings that only appear in a single query
+pub struct EmbeddingLookup {
+    base: Arc<EmbeddingTable>,
+    query: EmbeddingTable,
+}
+impl EmbeddingLookup {
+    pub fn new(base: Arc<EmbeddingTable>, query: EmbeddingTable) -> Self {
+        Self { base, query }
+    }
+
+    fn get(&self, embedding_id: isize) -> &NativeEmbedding {
+        self.query
+            .get(embedding_id)
+            .or_else(|| self.base.get(embedding_id))
+            .expect("embedding was not ingested before searching")
+    }
+}
+
+/// The similarity function used during the proof search
+pub enum SimilarityFn {
+    /// plain string equality on symbols, used if no similarity function is provided
+    SymbolCompare,
+    /// a Python callable, which requires acquiring the GIL on every call
+    Python(PyObject),
+    /// a Python callable taking 2 lists of items, returning the similarity of each pair.
+    /// Pending pairs are prefetched in bulk, so this only acquires the GIL a few times per batch
+    PythonBatch(PyObject),
+    Native(NativeSimilarity, EmbeddingLookup),
+}
+impl SimilarityFn {
+    /// perform the actual similarity calculation, ignoring caching
+    pub fn calc<T>(&self, src: &T, tgt: &T) -> f64
+    where
+        T: SimilarityComparable + IntoPy<PyObject> + Clone,
+    {
+        match self {
+            SimilarityFn::SymbolCompare => symbol_compare(src, tgt),
+            SimilarityFn::Python(py_similarity_fn) => {
+                Python::with_gil(|py| {
+                    // TODO: make sure similarity_func is callable, and handle errors better
+                    let py_res = py_similarity_fn
+                        .call1(py, (src.clone(), tgt.clone()))
+                        .unwrap();
+                    py_res.extract::<f64>(py).unwrap()
+                })
+            }
+            SimilarityFn::PythonBatch(_) => self.calc_batch(&[(src, tgt)])[0],
+            SimilarityFn::Native(similarity, embeddings) => similarity.calc(embeddings, src, tgt),
+        }
+    }
+
+    /// Calculate the similarities of all the pairs at once.
+    /// This only acquires the GIL once for batch Python functions, otherwise it's the same as calling calc on each pair
+    pub fn calc_batch<T>(&self, pairs: &[(&T, &T)]) -> Vec<f64>
+    where
+        T: SimilarityComparable + IntoPy<PyObject> + Clone,
+    {
+        match self {
+            SimilarityFn::PythonBatch(py_batch_similarity_fn) => Python::with_gil(|py| {
+                let (items_a, items_b): (Vec<PyObject>, Vec<PyObject>) = pairs
+                    .iter()
+                    .map(|(src, tgt)| ((*src).clone().into_py(py), (*tgt).clone().into_py(py)))
+                    .unzip();
+                let py_res = py_batch_similarity_fn
+                    .call1(py, (items_a, items_b))
+                    .unwrap();
+                let similarities = py_res.extract::<Vec<f64>>(py).unwrap();
+                assert_eq!(
+                    similarities.len(),
+                    pairs.len(),
+                    "batch_similarity_func must return 1 similarity for each pair"
+                );
+                similarities
+            }),
+            _ => pairs
+                .iter()
+                .map(|(src, tgt)| self.calc(*src, *tgt))
+                .collect(),
+        }
+    }
+
+    /// Whether similarities should be prefetched in bulk before they're needed
+    pub fn is_batched(&self) -> bool {
+        matches!(self, SimilarityFn::PythonBatch(_))
+    }
+}
+
+/// A fingerprint of the similarity functions a prover was created with, saved along with its similarities,
+/// so similarities calculated by one function are never loaded into a prover using another.
+/// Python functions are identified by their module and qualified name, so changing a function's code isn't detected
+pub fn similarity_fingerprint(
+    py: Python<'_>,
+    py_similarity_fn: Option<&PyObject>,
+    py_batch_similarity_fn: Option<&PyObject>,
+    native_similarity: Option<&NativeSimilarity>,
+) -> u64 {
+    let mut hasher = StableHasher::new();
+    for py_fn in [py_similarity_fn, py_batch_similarity_fn] {
+        let name = py_fn.map(|py_fn| python_function_name(py_fn.as_ref(py)));
+        hasher.write_bytes(name.unwrap_or_default().as_bytes());
+    }
+    let native_name = native_similarity.map(|native_similarity| native_similarity.name());
+    hasher.write_bytes(native_name.unwrap_or_default().as_bytes());
+    hasher.finish()
+}
+
+// callable objects without a __qualname__ are identified by their class
+fn python_function_name(py_fn: &PyAny) -> String {
+    let module = py_fn
+        .getattr("__module__")
+        .and_then(|module| module.extract::<String>())
+        .unwrap_or_default();
+    let name = py_fn
+        .getattr("__qualname__")
+        .or_else(|_| py_fn.get_type().getattr("__qualname__"))
+        .and_then(|name| name.extract::<String>())
+        .unwrap_or_default();
+    format!("{}.{}", module, name)
+}
+
+fn symbol_compare<T: SimilarityComparable>(src: &T, tgt: &T) -> f64 {
+    if src.symbol() == tgt.symbol() {
+        1.0
+    } else {
+        0.0
+    }
+}
+
+#[cfg(test)]
+mod test {
+    use super::*;
+    use crate::test_utils::test::{const1, const2, pred1, to_numpy_array, x};
+    use crate::types::{CNFLiteral, Constant, Predicate};
+    use crate::util::PyArcItem;
+
+    fn native(kind: &str) -> NativeSimilarity {
+        NativeSimilarity::new(kind, vec![]).unwrap()
+    }
+
+    fn empty_lookup() -> EmbeddingLookup {
+        EmbeddingLookup::new(
+            Arc::new(EmbeddingTable::default()),
+            EmbeddingTable::default(),
+        )
+    }
+
+    #[test]
+    fn test_native_embedding_cosine() {
+        let embedding1 = NativeEmbedding::new(EmbeddingView::Owned(vec![1.0, 0.0, 1.0]));
+        let embedding2 = NativeEmbedding::new(EmbeddingView::Owned(vec![0.0, 1.0, 1.0]));
+        assert!((embedding1.cosine(&embedding2) - 0.5).abs() < 1e-9);
+        assert!((embedding1.cosine(&embedding1) - 1.0).abs() < 1e-9);
+    }
+
+    #[test]
+    fn test_check_dimension_rejects_mismatched_lengths() {
+        let mut base = EmbeddingTable::default();
+        assert!(base
+            .check_dimension(SimilarityKind::Predicate, 3, None)
+            .is_ok());
+        assert!(base
+            .check_dimension(SimilarityKind::Predicate, 3, None)
+            .is_ok());
+        assert!(base
+            .check_dimension(SimilarityKind::Constant, 5, None)
+            .is_ok());
+        let mut query = EmbeddingTable::default();
+        assert!(query
+            .check_dimension(SimilarityKind::Predicate, 3, Some(&base))
+            .is_ok());
+        assert!(query
+            .check_dimension(SimilarityKind::Constant, 3, Some(&base))
+            .is_err());
+    }
+
+    #[test]
+    fn test_native_cosine_falls_back_to_symbol_compare_without_embeddings() {
+        let similarity = SimilarityFn::Native(native("cosine"), empty_lookup());
+        assert_eq!(similarity.calc(&const1(), &const1()), 1.0);
+        assert_eq!(similarity.calc(&const1(), &const2()), 0.0);
+    }
+
+    #[test]
+    fn test_native_max_takes_the_max_of_all_similarities() {
+        let max =
+            NativeSimilarity::new("max", vec![native("symbol_compare"), native("cosine")]).unwrap();
+        assert!(max.uses_embeddings());
+        let similarity = SimilarityFn::Native(max, empty_lookup());
+        assert_eq!(similarity.calc(&const1(), &const1()), 1.0);
+    }
+
+    #[test]
+    fn test_new_rejects_unknown_similarities() {
+        assert!(NativeSimilarity::new("euclidean", vec![]).is_err());
+        assert!(NativeSimilarity::new("max", vec![]).is_err());
+    }
+
+    #[test]
+    fn test_ingest_reads_embeddings_from_predicates_and_nested_constants() {
+        let pred = Predicate::new("embedded_pred", Some(to_numpy_array(vec![1.0, 0.0, 1.0])));
+        let constant = Constant::new("embedded_const", Some(to_numpy_array(vec![0.0, 1.0, 1.0])));
+        let clause = CNFDisjunction::new(
+            vec![PyArcItem::new(CNFLiteral::new(
+                pred.atom(vec![x().into(), constant.clone().into()]),
+                true,
+            ))]
+            .into_iter()
+            .collect(),
+        );
+        let mut table = EmbeddingTable::default();
+        Python::with_gil(|py| table.ingest(py, vec![&clause], None)).unwrap();
+        assert!(table.get(pred.embedding_id().unwrap()).is_some());
+        assert!(table.get(constant.embedding_id().unwrap()).is_some());
+        assert!(table.get(pred1().embedding_id().unwrap_or(0)).is_none());
+
+        let similarity = SimilarityFn::Native(
+            native("cosine"),
+            EmbeddingLookup::new(Arc::new(table), EmbeddingTable::default()),
+        );
+        let const_with_pred_embedding =
+            Python::with_gil(|py| Constant::new("other", pred.py_embedding(py)));
+        assert!((similarity.calc(&constant, &const_with_pred_embedding) - 0.5).abs() < 1e-9);
+    }
+}
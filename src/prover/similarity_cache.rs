@@ -1,7 +1,567 @@
+use std::mem;
+use std::sync::atomic::Ordering::Relaxed;
+use std::sync::atomic::{AtomicBool, AtomicUsize};
+use std::sync::Mutex;
 use std::{collections::HashMap, hash::BuildHasherDefault};
 
 use dashmap::DashMap;
-use rustc_hash::FxHasher;
+use pyo3::buffer::PyBuffer;
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+use rustc_hash::{FxHashSet, FxHasher};
 
-pub type SimilarityCache = DashMap<u64, f64, BuildHasherDefault<FxHasher>>;
-pub type FallthroughSimilarityCache = HashMap<u64, f64, BuildHasherDefault<FxHasher>>;
+use crate::types::{SimilarityComparable, SimilarityId, SimilarityItem, SimilarityKind};
+
+use super::persistent_similarity_cache::StableSimilarityKey;
+
+pub type FallthroughSimilarityCache = HashMap<SimilarityKey, f64, BuildHasherDefault<FxHasher>>;
+
+/// Key for the cached similarity of a source item to a target item
+#[derive(Clone, Copy, Hash, PartialEq, Eq, Debug)]
+pub struct SimilarityKey {
+    kind: SimilarityKind,
+    source: SimilarityId,
+    target: SimilarityId,
+}
+impl SimilarityKey {
+    /// If the similarity function is symmetric, (source, target) and (target, source) share a key,
+    /// so each pair is only calculated and stored once
+    pub fn new<T>(source: &T, target: &T, symmetric: bool) -> Self
+    where
+        T: SimilarityComparable,
+    {
+        let source = source.similarity_id();
+        let target = target.similarity_id();
+        let (source, target) = if symmetric && target < source {
+            (target, source)
+        } else {
+            (source, target)
+        };
+        Self {
+            kind: T::SIMILARITY_KIND,
+            source,
+            target,
+        }
+    }
+}
+
+/// A cached similarity, with a flag set whenever it's read since the last eviction sweep
+struct CachedSimilarity {
+    similarity: f64,
+    referenced: AtomicBool,
+}
+
+/// Identifies an item which appears in the cached similarities
+type ItemKey = (SimilarityKind, SimilarityId);
+
+/// An item which appears in the cached similarities, so the similarities can be saved to disk under stable ids.
+/// Items are only tracked by caches created with_stable_ids, since working out a stable id can take the GIL,
+/// and caches which are never saved shouldn't pay for it. Even then, so rather than doing it while searching, the item is held
+/// until the search finishes, and only its stable id is kept after that
+enum CachedItem {
+    Unresolved(SimilarityItem),
+    Resolved(Option<u64>),
+}
+
+/// Similarities shared between all the queries of a prover.
+/// If a capacity is set, the cache approximates LRU using the CLOCK algorithm:
+/// reading an entry marks it as referenced, and once the cache is over capacity the clock hand sweeps on from
+/// where it last stopped, giving referenced entries a second chance by clearing their flag, while unreferenced entries
+/// are evicted. The hand is a position in the map's iteration order, which shifts slightly as entries are added,
+/// but the hand keeps going round, so every entry gets the same chance to be read before the hand comes back to it
+pub struct SimilarityCache {
+    similarities: DashMap<SimilarityKey, CachedSimilarity, BuildHasherDefault<FxHasher>>,
+    capacity: Option<usize>,
+    // the DashMap's len() locks every shard, so the number of entries is tracked separately
+    len: AtomicUsize,
+    // the position of the clock hand, locked by whichever thread is evicting so other threads don't sweep at the same time
+    eviction: Mutex<usize>,
+    // only set if the similarities will be saved to disk, since tracking their items costs time and memory
+    track_stable_ids: bool,
+    items: DashMap<ItemKey, CachedItem, BuildHasherDefault<FxHasher>>,
+    // items whose stable ids haven't been worked out yet
+    unresolved_items: Mutex<Vec<ItemKey>>,
+    hits: AtomicUsize,
+    misses: AtomicUsize,
+    evictions: AtomicUsize,
+}
+impl Default for SimilarityCache {
+    fn default() -> Self {
+        Self::new(None)
+    }
+}
+impl SimilarityCache {
+    pub fn new(capacity: Option<usize>) -> Self {
+        Self {
+            similarities: DashMap::default(),
+            capacity,
+            len: AtomicUsize::new(0),
+            eviction: Mutex::new(0),
+            track_stable_ids: false,
+            items: DashMap::default(),
+            unresolved_items: Mutex::new(Vec::new()),
+            hits: AtomicUsize::new(0),
+            misses: AtomicUsize::new(0),
+            evictions: AtomicUsize::new(0),
+        }
+    }
+
+    /// Track the items in the cached similarities, so the similarities can be exported by stable_similarities
+    pub fn with_stable_ids(mut self, track_stable_ids: bool) -> Self {
+        self.track_stable_ids = track_stable_ids;
+        self
+    }
+
+    pub fn capacity(&self) -> Option<usize> {
+        self.capacity
+    }
+
+    pub fn tracks_stable_ids(&self) -> bool {
+        self.track_stable_ids
+    }
+
+    pub fn len(&self) -> usize {
+        self.len.load(Relaxed)
+    }
+
+    pub fn get(&self, key: SimilarityKey) -> Option<f64> {
+        self.similarities.get(&key).map(|cached| {
+            // only write if needed, to avoid bouncing the cache line between threads on every read
+            if !cached.referenced.load(Relaxed) {
+                cached.referenced.store(true, Relaxed);
+            }
+            cached.similarity
+        })
+    }
+
+    pub fn contains_key(&self, key: SimilarityKey) -> bool {
+        self.similarities.contains_key(&key)
+    }
+
+    /// Cache the similarity of the source to the target, returning how many entries were evicted to make room for it
+    pub fn insert<T>(&self, key: SimilarityKey, source: &T, target: &T, similarity: f64) -> usize
+    where
+        T: SimilarityComparable,
+    {
+        let evictions = self.insert_similarity(key, similarity);
+        // registered after inserting, so an eviction sweep which forgets unused items sees the similarity first
+        if self.track_stable_ids {
+            self.register_item(source);
+            self.register_item(target);
+        }
+        evictions
+    }
+
+    fn insert_similarity(&self, key: SimilarityKey, similarity: f64) -> usize {
+        // new entries start out referenced, so they survive at least one sweep
+        let cached = CachedSimilarity {
+            similarity,
+            referenced: AtomicBool::new(true),
+        };
+        if self.similarities.insert(key, cached).is_some() {
+            return 0;
+        }
+        let len = self.len.fetch_add(1, Relaxed) + 1;
+        match self.capacity {
+            Some(capacity) if len > capacity => self.evict(capacity),
+            _ => 0,
+        }
+    }
+
+    fn register_item<T>(&self, item: &T)
+    where
+        T: SimilarityComparable,
+    {
+        let item_key = (T::SIMILARITY_KIND, item.similarity_id());
+        // most items are already registered, and checking only takes a read lock
+        if self.items.contains_key(&item_key) {
+            return;
+        }
+        let mut is_new_item = false;
+        self.items.entry(item_key).or_insert_with(|| {
+            is_new_item = true;
+            CachedItem::Unresolved(item.similarity_item())
+        });
+        if is_new_item {
+            self.unresolved_items
+                .lock()
+                .unwrap_or_else(|poisoned| poisoned.into_inner())
+                .push(item_key);
+        }
+    }
+
+    /// Work out the stable ids of the items added since this was last called, and stop holding on to the items.
+    /// This acquires the GIL if any of their embeddings haven't been hashed yet
+    pub fn resolve_stable_ids(&self) {
+        if !self.track_stable_ids {
+            return;
+        }
+        let item_keys = mem::take(
+            &mut *self
+                .unresolved_items
+                .lock()
+                .unwrap_or_else(|poisoned| poisoned.into_inner()),
+        );
+        for item_key in item_keys {
+            // copied out first, so no shard lock is held while waiting for the GIL
+            let item = match self.items.get(&item_key).as_deref() {
+                Some(CachedItem::Unresolved(item)) => item.clone(),
+                _ => continue,
+            };
+            let stable_id = item.stable_similarity_id();
+            if let Some(mut cached_item) = self.items.get_mut(&item_key) {
+                *cached_item = CachedItem::Resolved(stable_id);
+            }
+        }
+    }
+
+    /// All the cached similarities which can be saved to disk, keyed by the stable ids of their items.
+    /// Similarities between items whose embeddings can't be read are left out, as are all of them
+    /// if the cache doesn't track stable ids
+    pub fn stable_similarities(&self, symmetric: bool) -> Vec<(StableSimilarityKey, f64)> {
+        self.resolve_stable_ids();
+        self.similarities
+            .iter()
+            .filter_map(|entry| {
+                let key = entry.key();
+                let source = self.stable_id((key.kind, key.source))?;
+                let target = self.stable_id((key.kind, key.target))?;
+                let stable_key = StableSimilarityKey::from_ids(source, target, symmetric);
+                Some((stable_key, entry.value().similarity))
+            })
+            .collect()
+    }
+
+    fn stable_id(&self, item_key: ItemKey) -> Option<u64> {
+        match self.items.get(&item_key).as_deref() {
+            Some(CachedItem::Resolved(stable_id)) => *stable_id,
+            _ => None,
+        }
+    }
+
+    /// Add the cache hits and misses from a finished query to the totals
+    pub fn record_lookups(&self, hits: usize, misses: usize) {
+        self.hits.fetch_add(hits, Relaxed);
+        self.misses.fetch_add(misses, Relaxed);
+    }
+
+    pub fn stats(&self) -> SimilarityCacheStats {
+        SimilarityCacheStats {
+            size: self.len(),
+            capacity: self.capacity,
+            hits: self.hits.load(Relaxed),
+            misses: self.misses.load(Relaxed),
+            evictions: self.evictions.load(Relaxed),
+        }
+    }
+
+    /// Evict down to 7/8 of the capacity, so sweeps don't happen on every insert once the cache is full
+    fn evict(&self, capacity: usize) -> usize {
+        // if another thread is already evicting, there's no need to wait for it
+        let mut hand = match self.eviction.try_lock() {
+            Ok(hand) => hand,
+            Err(_) => return 0,
+        };
+        let target_len = capacity - capacity / 8;
+        let mut num_evicted = 0;
+        // sweep to the end of the map, then at most twice round from the start.
+        // the first full lap clears the referenced flags it passes, so the second can always evict
+        for _ in 0..3 {
+            let num_to_evict = self.len().saturating_sub(target_len);
+            if num_to_evict == 0 {
+                break;
+            }
+            let (num_swept, stopped_at) = self.sweep(*hand, num_to_evict);
+            self.len.fetch_sub(num_swept, Relaxed);
+            num_evicted += num_swept;
+            // the hand wraps round to the start once it passes the last entry
+            *hand = stopped_at.unwrap_or(0);
+        }
+        // each similarity has at most 2 items, so past that some items only appear in evicted similarities
+        if self.track_stable_ids && self.items.len() > 2 * capacity {
+            self.forget_unused_items();
+        }
+        self.evictions.fetch_add(num_evicted, Relaxed);
+        num_evicted
+    }
+
+    fn forget_unused_items(&self) {
+        let mut used_items = FxHashSet::default();
+        for entry in self.similarities.iter() {
+            let key = entry.key();
+            used_items.insert((key.kind, key.source));
+            used_items.insert((key.kind, key.target));
+        }
+        self.items
+            .retain(|item_key, _| used_items.contains(item_key));
+    }
+
+    /// Move the clock hand from the given position towards the end of the map, until num_to_evict entries are evicted.
+    /// Returns how many entries were evicted, and the hand's position once the evicted entries are gone,
+    /// or None if it reached the end of the map
+    fn sweep(&self, start: usize, num_to_evict: usize) -> (usize, Option<usize>) {
+        let mut position = 0;
+        let mut num_evicted = 0;
+        let mut stopped_at = None;
+        self.similarities.retain(|_, cached| {
+            let before_hand = position < start;
+            position += 1;
+            if before_hand || num_evicted == num_to_evict || cached.referenced.swap(false, Relaxed)
+            {
+                return true;
+            }
+            num_evicted += 1;
+            if num_evicted == num_to_evict {
+                stopped_at = Some(position - num_evicted);
+            }
+            false
+        });
+        (num_evicted, stopped_at)
+    }
+}
+
+/// Stats on the similarity cache, accumulated over every query since the cache was created or purged
+#[pyclass(name = "RsSimilarityCacheStats")]
+#[derive(Clone, Debug)]
+pub struct SimilarityCacheStats {
+    #[pyo3(get)]
+    pub size: usize,
+    #[pyo3(get)]
+    pub capacity: Option<usize>,
+    #[pyo3(get)]
+    pub hits: usize,
+    #[pyo3(get)]
+    pub misses: usize,
+    #[pyo3(get)]
+    pub evictions: usize,
+}
+
+/// Insert a precomputed matrix of similarities between each source and each target into the cache
+pub fn cache_similarity_matrix<T>(
+    py: Python<'_>,
+    cache: &SimilarityCache,
+    sources: &[T],
+    targets: &[T],
+    similarities: &PyAny,
+    symmetric: bool,
+) -> PyResult<()>
+where
+    T: SimilarityComparable,
+{
+    let buffer = PyBuffer::<f64>::get(similarities)?;
+    if buffer.item_count() != sources.len() * targets.len() {
+        return Err(PyValueError::new_err(format!(
+            "Expected {} similarities for {} sources and {} targets, got {}",
+            sources.len() * targets.len(),
+            sources.len(),
+            targets.len(),
+            buffer.item_count()
+        )));
+    }
+    // to_vec always copies out the values in row-major order
+    let values = buffer.to_vec(py)?;
+    for (source, row) in sources.iter().zip(values.chunks(targets.len().max(1))) {
+        for (target, similarity) in targets.iter().zip(row) {
+            let key = SimilarityKey::new(source, target, symmetric);
+            cache.insert(key, source, target, *similarity);
+        }
+    }
+    // while we hold the GIL anyway
+    cache.resolve_stable_ids();
+    Ok(())
+}
+
+#[cfg(test)]
+mod test {
+    use super::*;
+    use crate::test_utils::test::to_numpy_array;
+    use crate::types::{Constant, Predicate};
+
+    fn sim_key(i: u64) -> SimilarityKey {
+        let source = Constant::new(&format!("source{}", i), None);
+        SimilarityKey::new(&source, &Constant::new("target", None), true)
+    }
+
+    fn insert(cache: &SimilarityCache, i: u64, similarity: f64) -> usize {
+        cache.insert_similarity(sim_key(i), similarity)
+    }
+
+    #[test]
+    fn test_similarity_keys_dont_collide_for_self_pairs() {
+        let const1 = Constant::new("const1", None);
+        let const2 = Constant::new("const2", None);
+        assert_ne!(
+            SimilarityKey::new(&const1, &const1, true),
+            SimilarityKey::new(&const2, &const2, true)
+        );
+    }
+
+    #[test]
+    fn test_similarity_keys_are_only_direction_independent_if_symmetric() {
+        let const1 = Constant::new("const1", None);
+        let const2 = Constant::new("const2", None);
+        assert_eq!(
+            SimilarityKey::new(&const1, &const2, true),
+            SimilarityKey::new(&const2, &const1, true)
+        );
+        assert_ne!(
+            SimilarityKey::new(&const1, &const2, false),
+            SimilarityKey::new(&const2, &const1, false)
+        );
+    }
+
+    #[test]
+    fn test_similarity_keys_distinguish_predicates_constants_and_embeddings() {
+        let const1 = Constant::new("item", None);
+        let const2 = Constant::new("other", None);
+        let pred1 = Predicate::new("item", None);
+        let pred2 = Predicate::new("other", None);
+        assert_ne!(
+            SimilarityKey::new(&const1, &const2, true),
+            SimilarityKey::new(&pred1, &pred2, true)
+        );
+        let embedded = Constant::new("item", Some(to_numpy_array(vec![1.0, 0.0])));
+        assert_ne!(
+            SimilarityKey::new(&const1, &const2, true),
+            SimilarityKey::new(&embedded, &const2, true)
+        );
+    }
+
+    #[test]
+    fn test_unbounded_cache_never_evicts() {
+        let cache = SimilarityCache::default();
+        for key in 0..100 {
+            assert_eq!(insert(&cache, key, 0.5), 0);
+        }
+        assert_eq!(cache.len(), 100);
+        assert_eq!(cache.get(sim_key(42)), Some(0.5));
+        assert_eq!(cache.stats().evictions, 0);
+    }
+
+    #[test]
+    fn test_bounded_cache_evicts_unreferenced_entries_first() {
+        let cache = SimilarityCache::new(Some(8));
+        for key in 0..8 {
+            insert(&cache, key, key as f64);
+        }
+        // as if a sweep had just passed, so entries are only referenced again once they're read
+        for cached in cache.similarities.iter() {
+            cached.referenced.store(false, Relaxed);
+        }
+        for key in 0..4 {
+            assert_eq!(cache.get(sim_key(key)), Some(key as f64));
+        }
+        // going over capacity evicts down to 7 entries, keeping the entries which were read
+        assert_eq!(insert(&cache, 8, 8.0), 2);
+        assert_eq!(cache.len(), 7);
+        for key in 0..4 {
+            assert!(cache.contains_key(sim_key(key)));
+        }
+        assert!(cache.contains_key(sim_key(8)));
+        assert_eq!(cache.stats().evictions, 2);
+    }
+
+    #[test]
+    fn test_bounded_cache_evicts_even_if_every_entry_was_referenced() {
+        let cache = SimilarityCache::new(Some(4));
+        for key in 0..4 {
+            insert(&cache, key, 0.5);
+            cache.get(sim_key(key));
+        }
+        insert(&cache, 4, 0.5);
+        assert_eq!(cache.len(), 4);
+        assert_eq!(cache.stats().evictions, 1);
+    }
+
+    #[test]
+    fn test_bounded_cache_sweeps_on_from_where_the_last_sweep_stopped() {
+        let cache = SimilarityCache::default();
+        for key in 0..8 {
+            insert(&cache, key, 0.5);
+        }
+        // nothing is inserted from here on, so the iteration order only changes by removing entries
+        let order = cache
+            .similarities
+            .iter()
+            .map(|entry| *entry.key())
+            .collect::<Vec<_>>();
+        // every entry starts out referenced, so the hand goes all the way round before evicting the first entry
+        assert_eq!(cache.evict(8), 1);
+        assert!(!cache.contains_key(order[0]));
+
+        // the hand gives the next entry a second chance, and evicts the one after it
+        cache.get(order[1]);
+        assert_eq!(cache.evict(6), 1);
+        assert!(!cache.contains_key(order[2]));
+
+        // the next sweep carries on from there, rather than evicting the entry which just had its second chance
+        assert_eq!(cache.evict(5), 1);
+        assert!(cache.contains_key(order[1]));
+        assert!(!cache.contains_key(order[3]));
+        assert_eq!(cache.len(), 5);
+    }
+
+    #[test]
+    fn test_stable_similarities_are_keyed_by_the_stable_ids_of_their_items() {
+        let cache = SimilarityCache::new(Some(8)).with_stable_ids(true);
+        let source = Constant::new("source", None);
+        let target = Constant::new("target", None);
+        cache.insert(
+            SimilarityKey::new(&source, &target, false),
+            &source,
+            &target,
+            0.5,
+        );
+        cache.insert(
+            SimilarityKey::new(&target, &source, false),
+            &target,
+            &source,
+            0.25,
+        );
+        let mut similarities = cache.stable_similarities(false);
+        similarities.sort_by(|(_, a), (_, b)| a.total_cmp(b));
+        assert_eq!(
+            similarities,
+            vec![
+                (
+                    StableSimilarityKey::new(&target, &source, false).unwrap(),
+                    0.25
+                ),
+                (
+                    StableSimilarityKey::new(&source, &target, false).unwrap(),
+                    0.5
+                ),
+            ]
+        );
+    }
+
+    #[test]
+    fn test_items_are_only_tracked_if_stable_ids_are_needed() {
+        let cache = SimilarityCache::new(Some(8));
+        let source = Constant::new("source", None);
+        let target = Constant::new("target", None);
+        cache.insert(
+            SimilarityKey::new(&source, &target, false),
+            &source,
+            &target,
+            0.5,
+        );
+        cache.resolve_stable_ids();
+        assert_eq!(cache.items.len(), 0);
+        assert_eq!(cache.stable_similarities(false), vec![]);
+        assert_eq!(
+            cache.get(SimilarityKey::new(&source, &target, false)),
+            Some(0.5)
+        );
+    }
+
+    #[test]
+    fn test_stats_accumulate_recorded_lookups() {
+        let cache = SimilarityCache::new(Some(10));
+        cache.record_lookups(3, 2);
+        cache.record_lookups(1, 0);
+        let stats = cache.stats();
+        assert_eq!((stats.hits, stats.misses), (4, 2));
+        assert_eq!(stats.capacity, Some(10));
+    }
+}
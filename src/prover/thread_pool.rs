@@ -0,0 +1,58 @@
+use std::sync::{Arc, Mutex, Weak};
+
+use pyo3::exceptions::PyRuntimeError;
+use pyo3::prelude::*;
+use rayon::{ThreadPool, ThreadPoolBuilder};
+use rustc_hash::FxHashMap;
+
+lazy_static! {
+    // only weak references are kept here, so a shared pool shuts down once no prover is using it
+    static ref SHARED_THREAD_POOLS: Mutex<FxHashMap<usize, Weak<ThreadPool>>> =
+        Mutex::new(FxHashMap::default());
+}
+
+/// Get a thread pool with the given number of workers.
+/// If shared is true, every prover asking for a shared pool of the same size gets the same pool,
+/// otherwise a new pool is built which is owned by the caller.
+pub fn get_thread_pool(num_workers: usize, shared: bool) -> PyResult<Arc<ThreadPool>> {
+    if !shared {
+        return build_thread_pool(num_workers);
+    }
+    let mut shared_pools = SHARED_THREAD_POOLS.lock().unwrap();
+    if let Some(threadpool) = shared_pools.get(&num_workers).and_then(Weak::upgrade) {
+        return Ok(threadpool);
+    }
+    let threadpool = build_thread_pool(num_workers)?;
+    shared_pools.retain(|_, pool| pool.strong_count() > 0);
+    shared_pools.insert(num_workers, Arc::downgrade(&threadpool));
+    Ok(threadpool)
+}
+
+fn build_thread_pool(num_workers: usize) -> PyResult<Arc<ThreadPool>> {
+    ThreadPoolBuilder::new()
+        .num_threads(num_workers)
+        .build()
+        .map(Arc::new)
+        .map_err(|err| PyRuntimeError::new_err(format!("Failed to start thread pool: {}", err)))
+}
+
+#[cfg(test)]
+mod test {
+    use super::*;
+
+    #[test]
+    fn test_shared_thread_pools_are_reused_for_the_same_size() {
+        let pool = get_thread_pool(3, true).unwrap();
+        assert!(Arc::ptr_eq(&pool, &get_thread_pool(3, true).unwrap()));
+        assert!(!Arc::ptr_eq(&pool, &get_thread_pool(2, true).unwrap()));
+        assert!(!Arc::ptr_eq(&pool, &get_thread_pool(3, false).unwrap()));
+    }
+
+    #[test]
+    fn test_shared_thread_pools_are_dropped_when_unused() {
+        let pool = get_thread_pool(5, true).unwrap();
+        let weak_pool = Arc::downgrade(&pool);
+        drop(pool);
+        assert!(weak_pool.upgrade().is_none());
+    }
+}
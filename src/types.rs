@@ -5,48 +5,201 @@ use std::cmp::Ordering;
 use std::collections::BTreeSet;
 use std::hash::Hash;
 use std::hash::Hasher;
+use std::sync::atomic::{AtomicU64, Ordering::Relaxed};
+use std::sync::Arc;
 
-use crate::util::PyArcItem;
+use crate::util::{EmbeddingView, PyArcItem, StableHasher, Symbol};
 
-// based on https://stackoverflow.com/a/75135403/245362
-fn extract_embedding_ptr(embedding: &Option<Py<PyAny>>) -> Option<isize> {
-    if let Some(ref embedding_ref) = embedding {
-        Some(embedding_ref.as_ptr() as isize)
-    } else {
-        None
+/// An embedding object passed in from Python.
+/// Symbols share this behind an Arc, so copying a symbol never touches Python refcounts
+#[derive(Debug)]
+pub struct Embedding {
+    pub object: Py<PyAny>,
+    // identifies the embedding for equality, hashing and caching. By default this is the address of the Python object,
+    // based on https://stackoverflow.com/a/75135403/245362, or a hash of its values if identified by content
+    pub id: isize,
+    // stable hash of the embedding's values, calculated the first time it's needed
+    content_hash: AtomicU64,
+}
+impl Embedding {
+    const UNHASHED: u64 = 0;
+    const UNHASHABLE: u64 = 1;
+
+    fn wrap(embedding: Option<Py<PyAny>>) -> Option<Arc<Embedding>> {
+        embedding.map(|object| {
+            let id = object.as_ptr() as isize;
+            Arc::new(Embedding {
+                object,
+                id,
+                content_hash: AtomicU64::new(Self::UNHASHED),
+            })
+        })
+    }
+
+    /// A copy of this embedding which is identified by the hash of its values rather than by the Python object,
+    /// so embeddings with equal values are treated as the same embedding.
+    /// Embeddings whose values can't be read keep their object identity
+    pub fn by_content(self: &Arc<Self>, py: Python<'_>) -> Arc<Embedding> {
+        match self.content_hash() {
+            Some(content_hash) if self.id != content_hash as isize => Arc::new(Embedding {
+                object: self.object.clone_ref(py),
+                id: content_hash as isize,
+                content_hash: AtomicU64::new(content_hash),
+            }),
+            _ => self.clone(),
+        }
+    }
+
+    /// A hash of the embedding's values which is the same in every process,
+    /// or None if the values can't be read. This acquires the GIL the first time it's called
+    pub fn content_hash(&self) -> Option<u64> {
+        match self.content_hash.load(Relaxed) {
+            Self::UNHASHED => {}
+            Self::UNHASHABLE => return None,
+            content_hash => return Some(content_hash),
+        }
+        let content_hash = Python::with_gil(|py| {
+            let view = EmbeddingView::new(self.object.as_ref(py)).ok()?;
+            let values = view.values();
+            let mut hasher = StableHasher::new();
+            hasher.write_u64(values.len() as u64);
+            for value in values.iter() {
+                hasher.write_u64(value.to_bits());
+            }
+            // keep clear of the sentinel values
+            Some(hasher.finish().max(Self::UNHASHABLE + 1))
+        });
+        self.content_hash
+            .store(content_hash.unwrap_or(Self::UNHASHABLE), Relaxed);
+        content_hash
+    }
+}
+
+/// How embeddings are identified, which decides whether symbols are equal,
+/// and whether they share similarity cache entries
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum EmbeddingIdentity {
+    /// Embeddings are only the same if they're the same Python object
+    Object,
+    /// Embeddings are the same if they hold the same values
+    Content,
+}
+impl EmbeddingIdentity {
+    pub fn parse(value: &str) -> Option<Self> {
+        match value {
+            "object" => Some(EmbeddingIdentity::Object),
+            "content" => Some(EmbeddingIdentity::Content),
+            _ => None,
+        }
+    }
+}
+
+fn embedding_by_content(
+    py: Python<'_>,
+    embedding: &Option<Arc<Embedding>>,
+) -> Option<Arc<Embedding>> {
+    embedding.as_ref().map(|embedding| embedding.by_content(py))
+}
+
+fn embedding_id(embedding: &Option<Arc<Embedding>>) -> Option<isize> {
+    embedding.as_ref().map(|embedding| embedding.id)
+}
+
+fn stable_similarity_id(
+    kind: SimilarityKind,
+    symbol: Symbol,
+    embedding: &Option<Arc<Embedding>>,
+) -> Option<u64> {
+    let mut hasher = StableHasher::new();
+    hasher.write_u64(kind as u64);
+    hasher.write_bytes(symbol.as_str().as_bytes());
+    match embedding {
+        Some(embedding) => hasher.write_u64(embedding.content_hash()?),
+        None => hasher.write_u64(Embedding::UNHASHED),
+    }
+    Some(hasher.finish())
+}
+
+fn hash_symbol(symbol: Symbol, embedding: &Option<Arc<Embedding>>) -> u64 {
+    let mut hasher = FxHasher::default();
+    symbol.hash(&mut hasher);
+    embedding_id(embedding).hash(&mut hasher);
+    hasher.finish()
+}
+
+/// The kinds of items which can be compared by similarity, so predicates and constants never share cache entries.
+/// The values are part of the stable ids saved to disk, so they must never change
+#[derive(Clone, Copy, Hash, PartialEq, Eq, Debug)]
+pub enum SimilarityKind {
+    Predicate = 0,
+    Constant = 1,
+}
+impl SimilarityKind {
+    pub fn name(&self) -> &'static str {
+        match self {
+            SimilarityKind::Predicate => "predicate",
+            SimilarityKind::Constant => "constant",
+        }
+    }
+}
+
+/// Identifies an item for the similarity cache by its symbol and embedding.
+/// Unlike a hash, 2 different items can never have the same id
+#[derive(Clone, Copy, Hash, PartialEq, Eq, PartialOrd, Ord, Debug)]
+pub struct SimilarityId {
+    symbol_id: u32,
+    embedding_id: Option<isize>,
+}
+
+/// The symbol and embedding of an item, so its stable similarity id can be worked out after the item is gone
+#[derive(Clone, Debug)]
+pub struct SimilarityItem {
+    kind: SimilarityKind,
+    symbol: Symbol,
+    embedding: Option<Arc<Embedding>>,
+}
+impl SimilarityItem {
+    /// See SimilarityComparable::stable_similarity_id
+    pub fn stable_similarity_id(&self) -> Option<u64> {
+        stable_similarity_id(self.kind, self.symbol, &self.embedding)
     }
 }
 
 pub trait SimilarityComparable {
-    fn similarity_key(&self) -> u64;
-    fn symbol(&self) -> &String;
+    const SIMILARITY_KIND: SimilarityKind;
+    fn similarity_id(&self) -> SimilarityId;
+    /// Identifies the item by its symbol and the contents of its embedding, so it's the same in every process.
+    /// Returns None if the embedding can't be read. This acquires the GIL if the embedding hasn't been hashed yet
+    fn stable_similarity_id(&self) -> Option<u64>;
+    fn similarity_item(&self) -> SimilarityItem;
+    fn symbol(&self) -> &str;
+    fn embedding_id(&self) -> Option<isize>;
 }
 
 #[pyclass(name = "RsPredicate")]
 #[derive(Clone, Debug)]
 pub struct Predicate {
-    #[pyo3(get)]
-    pub symbol: String,
-    #[pyo3(get)]
-    pub embedding: Option<Py<PyAny>>,
-    pub embedding_ptr: Option<isize>,
+    pub symbol: Symbol,
+    pub embedding: Option<Arc<Embedding>>,
     hash: u64,
 }
 #[pymethods]
 impl Predicate {
     #[new]
     pub fn new(symbol: &str, embedding: Option<Py<PyAny>>) -> Self {
-        let embedding_ptr = extract_embedding_ptr(&embedding);
-        let mut hasher = FxHasher::default();
-        symbol.hash(&mut hasher);
-        embedding_ptr.hash(&mut hasher);
-        let hash = hasher.finish();
-        Self {
-            symbol: symbol.to_string(),
-            embedding,
-            embedding_ptr,
-            hash,
-        }
+        Self::with_embedding(Symbol::intern(symbol), Embedding::wrap(embedding))
+    }
+
+    #[getter(symbol)]
+    pub fn py_symbol(&self) -> &str {
+        self.symbol.as_str()
+    }
+
+    #[getter(embedding)]
+    pub fn py_embedding(&self, py: Python<'_>) -> Option<PyObject> {
+        self.embedding
+            .as_ref()
+            .map(|embedding| embedding.object.clone_ref(py))
     }
 
     pub fn atom(&self, terms: Vec<Term>) -> Atom {
@@ -56,6 +209,21 @@ impl Predicate {
         }
     }
 }
+impl Predicate {
+    fn with_embedding(symbol: Symbol, embedding: Option<Arc<Embedding>>) -> Self {
+        let hash = hash_symbol(symbol, &embedding);
+        Self {
+            symbol,
+            embedding,
+            hash,
+        }
+    }
+
+    /// A copy of this predicate with its embedding identified by content
+    pub fn by_content(&self, py: Python<'_>) -> Self {
+        Self::with_embedding(self.symbol, embedding_by_content(py, &self.embedding))
+    }
+}
 impl Hash for Predicate {
     fn hash<H: Hasher>(&self, state: &mut H) {
         state.write_u64(self.hash);
@@ -64,12 +232,12 @@ impl Hash for Predicate {
 impl Eq for Predicate {}
 impl PartialEq for Predicate {
     fn eq(&self, other: &Self) -> bool {
-        self.symbol == other.symbol && self.embedding_ptr == other.embedding_ptr
+        self.symbol == other.symbol && self.embedding_id() == other.embedding_id()
     }
 }
 impl Ord for Predicate {
     fn cmp(&self, other: &Self) -> Ordering {
-        (&self.symbol, self.embedding_ptr).cmp(&(&other.symbol, other.embedding_ptr))
+        (self.symbol, self.embedding_id()).cmp(&(other.symbol, other.embedding_id()))
     }
 }
 impl PartialOrd for Predicate {
@@ -78,40 +246,71 @@ impl PartialOrd for Predicate {
     }
 }
 impl SimilarityComparable for Predicate {
-    fn similarity_key(&self) -> u64 {
-        self.hash
+    const SIMILARITY_KIND: SimilarityKind = SimilarityKind::Predicate;
+    fn similarity_id(&self) -> SimilarityId {
+        SimilarityId {
+            symbol_id: self.symbol.id(),
+            embedding_id: self.embedding_id(),
+        }
+    }
+    fn stable_similarity_id(&self) -> Option<u64> {
+        stable_similarity_id(Self::SIMILARITY_KIND, self.symbol, &self.embedding)
+    }
+    fn similarity_item(&self) -> SimilarityItem {
+        SimilarityItem {
+            kind: Self::SIMILARITY_KIND,
+            symbol: self.symbol,
+            embedding: self.embedding.clone(),
+        }
+    }
+    fn symbol(&self) -> &str {
+        self.symbol.as_str()
     }
-    fn symbol(&self) -> &String {
-        &self.symbol
+    fn embedding_id(&self) -> Option<isize> {
+        embedding_id(&self.embedding)
     }
 }
 
 #[pyclass(name = "RsConstant")]
 #[derive(Clone, Debug)]
 pub struct Constant {
-    #[pyo3(get)]
-    pub symbol: String,
-    #[pyo3(get)]
-    pub embedding: Option<Py<PyAny>>,
-    pub embedding_ptr: Option<isize>,
+    pub symbol: Symbol,
+    pub embedding: Option<Arc<Embedding>>,
     hash: u64,
 }
 #[pymethods]
 impl Constant {
     #[new]
     pub fn new(symbol: &str, embedding: Option<Py<PyAny>>) -> Self {
-        let embedding_ptr = extract_embedding_ptr(&embedding);
-        let mut hasher = FxHasher::default();
-        symbol.hash(&mut hasher);
-        embedding_ptr.hash(&mut hasher);
-        let hash = hasher.finish();
+        Self::with_embedding(Symbol::intern(symbol), Embedding::wrap(embedding))
+    }
+
+    #[getter(symbol)]
+    pub fn py_symbol(&self) -> &str {
+        self.symbol.as_str()
+    }
+
+    #[getter(embedding)]
+    pub fn py_embedding(&self, py: Python<'_>) -> Option<PyObject> {
+        self.embedding
+            .as_ref()
+            .map(|embedding| embedding.object.clone_ref(py))
+    }
+}
+impl Constant {
+    fn with_embedding(symbol: Symbol, embedding: Option<Arc<Embedding>>) -> Self {
+        let hash = hash_symbol(symbol, &embedding);
         Self {
-            symbol: symbol.to_string(),
+            symbol,
             embedding,
-            embedding_ptr,
             hash,
         }
     }
+
+    /// A copy of this constant with its embedding identified by content
+    pub fn by_content(&self, py: Python<'_>) -> Self {
+        Self::with_embedding(self.symbol, embedding_by_content(py, &self.embedding))
+    }
 }
 impl Hash for Constant {
     fn hash<H: Hasher>(&self, state: &mut H) {
@@ -121,12 +320,12 @@ impl Hash for Constant {
 impl Eq for Constant {}
 impl PartialEq for Constant {
     fn eq(&self, other: &Self) -> bool {
-        self.symbol == other.symbol && self.embedding_ptr == other.embedding_ptr
+        self.symbol == other.symbol && self.embedding_id() == other.embedding_id()
     }
 }
 impl Ord for Constant {
     fn cmp(&self, other: &Self) -> Ordering {
-        (&self.symbol, self.embedding_ptr).cmp(&(&other.symbol, other.embedding_ptr))
+        (self.symbol, self.embedding_id()).cmp(&(other.symbol, other.embedding_id()))
     }
 }
 impl PartialOrd for Constant {
@@ -135,57 +334,72 @@ impl PartialOrd for Constant {
     }
 }
 impl SimilarityComparable for Constant {
-    fn similarity_key(&self) -> u64 {
-        self.hash
+    const SIMILARITY_KIND: SimilarityKind = SimilarityKind::Constant;
+    fn similarity_id(&self) -> SimilarityId {
+        SimilarityId {
+            symbol_id: self.symbol.id(),
+            embedding_id: self.embedding_id(),
+        }
+    }
+    fn stable_similarity_id(&self) -> Option<u64> {
+        stable_similarity_id(Self::SIMILARITY_KIND, self.symbol, &self.embedding)
+    }
+    fn similarity_item(&self) -> SimilarityItem {
+        SimilarityItem {
+            kind: Self::SIMILARITY_KIND,
+            symbol: self.symbol,
+            embedding: self.embedding.clone(),
+        }
+    }
+    fn symbol(&self) -> &str {
+        self.symbol.as_str()
     }
-    fn symbol(&self) -> &String {
-        &self.symbol
+    fn embedding_id(&self) -> Option<isize> {
+        embedding_id(&self.embedding)
     }
 }
 
 #[pyclass(name = "RsVariable")]
-#[derive(Clone, PartialEq, Eq, PartialOrd, Ord, Debug)]
+#[derive(Clone, Copy, Hash, PartialEq, Eq, PartialOrd, Ord, Debug)]
 pub struct Variable {
-    #[pyo3(get)]
-    pub name: String,
-    hash: u64,
+    pub name: Symbol,
 }
 #[pymethods]
 impl Variable {
     #[new]
     pub fn new(name: &str) -> Self {
-        let mut hasher = FxHasher::default();
-        name.hash(&mut hasher);
-        let hash = hasher.finish();
         Self {
-            name: name.to_string(),
-            hash,
+            name: Symbol::intern(name),
         }
     }
-}
-impl Hash for Variable {
-    fn hash<H: Hasher>(&self, state: &mut H) {
-        state.write_u64(self.hash);
+
+    #[getter(name)]
+    pub fn py_name(&self) -> &str {
+        self.name.as_str()
     }
 }
 
 #[pyclass(name = "RsFunction")]
-#[derive(Clone, Hash, PartialEq, Eq, PartialOrd, Ord, Debug)]
+#[derive(Clone, Copy, Hash, PartialEq, Eq, PartialOrd, Ord, Debug)]
 pub struct Function {
-    #[pyo3(get)]
-    pub symbol: String,
+    pub symbol: Symbol,
 }
 #[pymethods]
 impl Function {
     #[new]
     pub fn new(symbol: &str) -> Self {
         Self {
-            symbol: symbol.to_string(),
+            symbol: Symbol::intern(symbol),
         }
     }
 
+    #[getter(symbol)]
+    pub fn py_symbol(&self) -> &str {
+        self.symbol.as_str()
+    }
+
     pub fn bind(&self, terms: Vec<Term>) -> BoundFunction {
-        BoundFunction::new(self.clone(), terms)
+        BoundFunction::new(*self, terms)
     }
 }
 
@@ -225,6 +439,18 @@ pub enum Term {
     Variable(Variable),
     BoundFunction(BoundFunction),
 }
+impl Term {
+    pub fn by_content(&self, py: Python<'_>) -> Self {
+        match self {
+            Term::Constant(constant) => Term::Constant(constant.by_content(py)),
+            Term::Variable(variable) => Term::Variable(*variable),
+            Term::BoundFunction(bound_function) => Term::BoundFunction(BoundFunction::new(
+                bound_function.function,
+                terms_by_content(py, &bound_function.terms),
+            )),
+        }
+    }
+}
 impl IntoPy<PyObject> for Term {
     fn into_py(self, py: Python) -> PyObject {
         match self {
@@ -283,16 +509,54 @@ impl CNFLiteral {
 }
 
 #[pyclass(name = "RsCNFDisjunction")]
-#[derive(Clone, Hash, PartialEq, Eq, PartialOrd, Ord, Debug)]
+#[derive(Clone, PartialEq, Eq, PartialOrd, Ord, Debug)]
 pub struct CNFDisjunction {
     #[pyo3(get)]
     pub literals: BTreeSet<PyArcItem<CNFLiteral>>,
+    hash: u64,
 }
 #[pymethods]
 impl CNFDisjunction {
     #[new]
     pub fn new(literals: BTreeSet<PyArcItem<CNFLiteral>>) -> Self {
-        Self { literals }
+        let mut hasher = FxHasher::default();
+        literals.hash(&mut hasher);
+        let hash = hasher.finish();
+        Self { literals, hash }
+    }
+}
+impl CNFDisjunction {
+    /// The hash of the literals, which is computed once when the disjunction is created
+    pub fn precomputed_hash(&self) -> u64 {
+        self.hash
+    }
+
+    /// A copy of this disjunction with every embedding identified by content
+    pub fn by_content(&self, py: Python<'_>) -> Self {
+        CNFDisjunction::new(
+            self.literals
+                .iter()
+                .map(|literal| {
+                    let atom = &literal.item.atom;
+                    PyArcItem::new(CNFLiteral::new(
+                        Atom::new(
+                            atom.predicate.by_content(py),
+                            terms_by_content(py, &atom.terms),
+                        ),
+                        literal.item.polarity,
+                    ))
+                })
+                .collect(),
+        )
+    }
+}
+
+fn terms_by_content(py: Python<'_>, terms: &[Term]) -> Vec<Term> {
+    terms.iter().map(|term| term.by_content(py)).collect()
+}
+impl Hash for CNFDisjunction {
+    fn hash<H: Hasher>(&self, state: &mut H) {
+        state.write_u64(self.hash);
     }
 }
 
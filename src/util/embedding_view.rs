@@ -0,0 +1,250 @@
+use pyo3::buffer::{Element, PyBuffer};
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+
+/// Read-only view of the values of an embedding.
+/// Read-only contiguous float64 and float32 buffers (NumPy arrays, memoryviews, etc.) are borrowed without copying,
+/// and objects with an __array__ method, like EmbeddingStore rows, are borrowed through the array it returns.
+/// Embeddings from a quantized EmbeddingStore are borrowed as their quantized float16 or int8 values,
+/// which are proportional to the normalized embedding rather than equal to it.
+/// Anything else, including every writable buffer, is copied into an owned vector,
+/// since borrowed values are read without the GIL and a writable buffer could change underneath the search.
+pub enum EmbeddingView {
+    F64(PyBuffer<f64>),
+    F32(PyBuffer<f32>),
+    // the bits of float16 values, since Rust has no float16 type
+    F16(PyBuffer<u16>),
+    I8(PyBuffer<i8>),
+    Owned(Vec<f64>),
+}
+
+/// The values of an EmbeddingView, in whichever type they're stored as
+#[derive(Clone, Copy)]
+pub enum EmbeddingValues<'a> {
+    F64(&'a [f64]),
+    F32(&'a [f32]),
+    F16(&'a [u16]),
+    I8(&'a [i8]),
+}
+
+impl EmbeddingView {
+    pub fn new(embedding: &PyAny) -> PyResult<Self> {
+        if let Some(view) = Self::borrow(embedding)? {
+            return Ok(view);
+        }
+        if let Some(view) = Self::borrow_quantized(embedding)? {
+            return Ok(view);
+        }
+        // e.g. torch tensors, which return a NumPy array sharing their memory
+        if let Ok(array) = embedding.call_method0("__array__") {
+            if let Some(view) = Self::borrow(array)? {
+                return Ok(view);
+            }
+        }
+        embedding
+            .extract::<Vec<f64>>()
+            .map(Self::Owned)
+            .map_err(|_| {
+                PyValueError::new_err("Embeddings must be 1D arrays or sequences of floats")
+            })
+    }
+
+    fn borrow(embedding: &PyAny) -> PyResult<Option<Self>> {
+        if let Ok(buffer) = PyBuffer::<f64>::get(embedding) {
+            return Ok(Some(match borrowable(buffer) {
+                Ok(buffer) => Self::F64(buffer),
+                Err(buffer) => Self::Owned(buffer.to_vec(embedding.py())?),
+            }));
+        }
+        if let Ok(buffer) = PyBuffer::<f32>::get(embedding) {
+            return Ok(Some(match borrowable(buffer) {
+                Ok(buffer) => Self::F32(buffer),
+                Err(buffer) => Self::Owned(
+                    buffer
+                        .to_vec(embedding.py())?
+                        .into_iter()
+                        .map(|value| value as f64)
+                        .collect(),
+                ),
+            }));
+        }
+        Ok(None)
+    }
+
+    // the quantized values of an embedding from a quantized EmbeddingStore, if it is one
+    fn borrow_quantized(embedding: &PyAny) -> PyResult<Option<Self>> {
+        let values = match embedding.getattr("quantized_values") {
+            Ok(values) if !values.is_none() => values,
+            _ => return Ok(None),
+        };
+        if let Ok(buffer) = PyBuffer::<i8>::get(values) {
+            if let Ok(buffer) = borrowable(buffer) {
+                return Ok(Some(Self::I8(buffer)));
+            }
+        }
+        // NumPy float16 arrays have no matching buffer element type, so they're read as their bits
+        if let Ok(bits) = values.call_method1("view", ("uint16",)) {
+            if let Ok(buffer) = PyBuffer::<u16>::get(bits) {
+                if let Ok(buffer) = borrowable(buffer) {
+                    return Ok(Some(Self::F16(buffer)));
+                }
+            }
+        }
+        Ok(None)
+    }
+
+    pub fn values(&self) -> EmbeddingValues<'_> {
+        match self {
+            Self::F64(buffer) => EmbeddingValues::F64(as_slice(buffer)),
+            Self::F32(buffer) => EmbeddingValues::F32(as_slice(buffer)),
+            Self::F16(buffer) => EmbeddingValues::F16(as_slice(buffer)),
+            Self::I8(buffer) => EmbeddingValues::I8(as_slice(buffer)),
+            Self::Owned(values) => EmbeddingValues::F64(values),
+        }
+    }
+}
+
+impl<'a> EmbeddingValues<'a> {
+    pub fn len(&self) -> usize {
+        match self {
+            Self::F64(values) => values.len(),
+            Self::F32(values) => values.len(),
+            Self::F16(values) => values.len(),
+            Self::I8(values) => values.len(),
+        }
+    }
+
+    /// The values as float64s, whatever type they're stored as
+    pub fn iter(&self) -> Box<dyn Iterator<Item = f64> + 'a> {
+        match *self {
+            Self::F64(values) => Box::new(values.iter().copied()),
+            Self::F32(values) => Box::new(values.iter().map(|&value| value as f64)),
+            Self::F16(values) => Box::new(values.iter().map(|&bits| f16_to_f32(bits) as f64)),
+            Self::I8(values) => Box::new(values.iter().map(|&value| value as f64)),
+        }
+    }
+
+    pub fn dot(&self, other: &EmbeddingValues<'_>) -> f64 {
+        match (*self, *other) {
+            (Self::F64(a), EmbeddingValues::F64(b)) => dot(a, b),
+            (Self::F64(a), EmbeddingValues::F32(b)) => dot(a, b),
+            (Self::F32(a), EmbeddingValues::F64(b)) => dot(a, b),
+            (Self::F32(a), EmbeddingValues::F32(b)) => dot(a, b),
+            (Self::I8(a), EmbeddingValues::I8(b)) => dot_i8(a, b),
+            // the product of 2 float16s is always exact as a float32
+            (Self::F16(a), EmbeddingValues::F16(b)) => a
+                .iter()
+                .zip(b.iter())
+                .map(|(&x, &y)| (f16_to_f32(x) * f16_to_f32(y)) as f64)
+                .sum(),
+            // mixing quantized and unquantized embeddings is rare, so it can take the slow path
+            _ => self.iter().zip(other.iter()).map(|(x, y)| x * y).sum(),
+        }
+    }
+}
+
+// accumulate in f64 whatever the input types are, to match calculating cosine similarity with NumPy
+fn dot<A, B>(a: &[A], b: &[B]) -> f64
+where
+    A: Copy + Into<f64>,
+    B: Copy + Into<f64>,
+{
+    a.iter()
+        .zip(b.iter())
+        .map(|(&x, &y)| x.into() * y.into())
+        .sum()
+}
+
+// int8 products are summed exactly as integers, in chunks small enough that the sum can't overflow an i32
+fn dot_i8(a: &[i8], b: &[i8]) -> f64 {
+    const CHUNK_SIZE: usize = 1 << 16;
+    a.chunks(CHUNK_SIZE)
+        .zip(b.chunks(CHUNK_SIZE))
+        .map(|(a, b)| {
+            a.iter()
+                .zip(b.iter())
+                .map(|(&x, &y)| x as i32 * y as i32)
+                .sum::<i32>() as i64
+        })
+        .sum::<i64>() as f64
+}
+
+// converts the bits of an IEEE 754 half precision float, which is exact since every float16 is a valid float32
+fn f16_to_f32(bits: u16) -> f32 {
+    let sign = (bits as u32 & 0x8000) << 16;
+    let exponent = (bits as u32 >> 10) & 0x1f;
+    let mantissa = bits as u32 & 0x3ff;
+    match exponent {
+        // zero or subnormal
+        0 => {
+            let magnitude = mantissa as f32 * f32::powi(2.0, -24);
+            if sign == 0 {
+                magnitude
+            } else {
+                -magnitude
+            }
+        }
+        // infinity or nan
+        0x1f => f32::from_bits(sign | 0x7f80_0000 | (mantissa << 13)),
+        _ => f32::from_bits(sign | ((exponent + 112) << 23) | (mantissa << 13)),
+    }
+}
+
+// buffers can only be borrowed as a slice if they're read-only, contiguous and aligned, otherwise they have to be copied
+fn borrowable<T: Element>(buffer: PyBuffer<T>) -> Result<PyBuffer<T>, PyBuffer<T>> {
+    let aligned = buffer.buf_ptr() as usize % std::mem::align_of::<T>() == 0;
+    if buffer.readonly() && buffer.is_c_contiguous() && aligned && buffer.item_count() > 0 {
+        Ok(buffer)
+    } else {
+        Err(buffer)
+    }
+}
+
+fn as_slice<T: Element>(buffer: &PyBuffer<T>) -> &[T] {
+    // safe since the buffer was checked to be read-only, contiguous, aligned and non-empty,
+    // and its memory stays valid until it's released on drop
+    unsafe { std::slice::from_raw_parts(buffer.buf_ptr() as *const T, buffer.item_count()) }
+}
+
+#[cfg(test)]
+mod test {
+    use super::*;
+
+    #[test]
+    fn test_dot_mixes_float_types() {
+        let a = EmbeddingValues::F64(&[1.0, 2.0, 3.0]);
+        let b = EmbeddingValues::F32(&[0.5, 0.5, 1.0]);
+        assert_eq!(a.dot(&b), 4.5);
+        assert_eq!(b.dot(&a), 4.5);
+        assert_eq!(b.iter().collect::<Vec<_>>(), vec![0.5, 0.5, 1.0]);
+        assert_eq!(b.len(), 3);
+    }
+
+    #[test]
+    fn test_dot_of_quantized_values() {
+        let a = EmbeddingValues::I8(&[127, -64, 0]);
+        let b = EmbeddingValues::I8(&[127, 127, -128]);
+        assert_eq!(a.dot(&b), (127 * 127 - 64 * 127) as f64);
+        assert_eq!(a.dot(&EmbeddingValues::F64(&[1.0, 1.0, 1.0])), 63.0);
+        // 1.0, -2.0 and 0.5 as float16 bits
+        let c = EmbeddingValues::F16(&[0x3c00, 0xc000, 0x3800]);
+        assert_eq!(c.iter().collect::<Vec<_>>(), vec![1.0, -2.0, 0.5]);
+        assert_eq!(c.dot(&c), 5.25);
+    }
+
+    #[test]
+    fn test_f16_to_f32_handles_special_values() {
+        assert_eq!(f16_to_f32(0x0000), 0.0);
+        assert!(f16_to_f32(0x8000).is_sign_negative());
+        assert_eq!(f16_to_f32(0x0001), f32::powi(2.0, -24));
+        assert_eq!(f16_to_f32(0x7bff), 65504.0);
+        assert_eq!(f16_to_f32(0x7c00), f32::INFINITY);
+        assert!(f16_to_f32(0x7e00).is_nan());
+    }
+
+    #[test]
+    fn test_owned_views_read_their_own_values() {
+        let view = EmbeddingView::Owned(vec![1.0, 2.0]);
+        assert_eq!(view.values().dot(&view.values()), 5.0);
+    }
+}
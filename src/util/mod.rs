@@ -1,5 +1,11 @@
+mod embedding_view;
 mod find_variables_in_terms;
 mod py_arc_item;
+mod stable_hasher;
+mod symbol;
 
+pub use embedding_view::EmbeddingView;
 pub use find_variables_in_terms::find_variables_in_terms;
 pub use py_arc_item::PyArcItem;
+pub use stable_hasher::StableHasher;
+pub use symbol::Symbol;
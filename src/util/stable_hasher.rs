@@ -0,0 +1,86 @@
+/// A hasher whose output only depends on the bytes written to it, so hashes are the same
+/// in every process, on every platform and in every build. This makes the hashes safe to store on disk,
+/// unlike FxHasher or the default SipHasher, whose outputs aren't guaranteed to be stable.
+/// Based on FNV-1a, but mixing in 64-bit words at a time, with a murmur3 finalizer on each word.
+pub struct StableHasher {
+    hash: u64,
+}
+impl Default for StableHasher {
+    fn default() -> Self {
+        Self::new()
+    }
+}
+impl StableHasher {
+    const OFFSET_BASIS: u64 = 0xcbf2_9ce4_8422_2325;
+    const PRIME: u64 = 0x0000_0100_0000_01b3;
+
+    pub fn new() -> Self {
+        Self {
+            hash: Self::OFFSET_BASIS,
+        }
+    }
+
+    pub fn write_u64(&mut self, value: u64) {
+        self.hash = (self.hash ^ mix(value)).wrapping_mul(Self::PRIME);
+    }
+
+    /// Write a byte string, prefixed by its length so consecutive strings can't run together
+    pub fn write_bytes(&mut self, bytes: &[u8]) {
+        self.write_u64(bytes.len() as u64);
+        let mut chunks = bytes.chunks_exact(8);
+        for chunk in &mut chunks {
+            self.write_u64(u64::from_le_bytes(chunk.try_into().unwrap()));
+        }
+        let remainder = chunks.remainder();
+        if !remainder.is_empty() {
+            let mut last = [0u8; 8];
+            last[..remainder.len()].copy_from_slice(remainder);
+            self.write_u64(u64::from_le_bytes(last));
+        }
+    }
+
+    pub fn finish(&self) -> u64 {
+        mix(self.hash)
+    }
+}
+
+// the murmur3 64-bit finalizer, so every input bit affects every output bit
+fn mix(mut value: u64) -> u64 {
+    value ^= value >> 33;
+    value = value.wrapping_mul(0xff51_afd7_ed55_8ccd);
+    value ^= value >> 33;
+    value = value.wrapping_mul(0xc4ce_b9fe_1a85_ec53);
+    value ^= value >> 33;
+    value
+}
+
+#[cfg(test)]
+mod test {
+    use super::*;
+
+    fn hash_bytes(bytes: &[u8]) -> u64 {
+        let mut hasher = StableHasher::new();
+        hasher.write_bytes(bytes);
+        hasher.finish()
+    }
+
+    #[test]
+    fn test_hashes_are_stable() {
+        // if this changes, every similarity cache saved to disk is silently invalidated
+        let mut hasher = StableHasher::new();
+        hasher.write_u64(0);
+        assert_eq!(hasher.finish(), 0xb903_4ad3_7056_f5fb);
+    }
+
+    #[test]
+    fn test_strings_dont_run_together() {
+        let mut hasher1 = StableHasher::new();
+        hasher1.write_bytes(b"ab");
+        hasher1.write_bytes(b"c");
+        let mut hasher2 = StableHasher::new();
+        hasher2.write_bytes(b"a");
+        hasher2.write_bytes(b"bc");
+        assert_ne!(hasher1.finish(), hasher2.finish());
+        assert_ne!(hash_bytes(b"a"), hash_bytes(b"a\0"));
+    }
+}
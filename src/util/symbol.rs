@@ -0,0 +1,101 @@
+use dashmap::DashMap;
+use rustc_hash::FxHasher;
+use std::cmp::Ordering;
+use std::fmt;
+use std::hash::{BuildHasherDefault, Hash, Hasher};
+use std::sync::atomic::{AtomicU32, Ordering::Relaxed};
+
+lazy_static! {
+    static ref SYMBOL_TABLE: DashMap<&'static str, Symbol, BuildHasherDefault<FxHasher>> =
+        DashMap::default();
+    static ref NEXT_SYMBOL_ID: AtomicU32 = AtomicU32::new(0);
+}
+
+/// An interned string, used for the names of predicates, constants, functions and variables.
+/// Each distinct string is stored once in a global table for the life of the process,
+/// so symbols are Copy, and are compared and hashed by id without touching the string.
+/// Interned strings are never freed, so names shouldn't be generated per query:
+/// the Python side numbers the skolem functions of each query from 1 again, so they reuse the same names.
+#[derive(Clone, Copy)]
+pub struct Symbol {
+    id: u32,
+    name: &'static str,
+}
+impl Symbol {
+    pub fn intern(name: &str) -> Self {
+        if let Some(symbol) = SYMBOL_TABLE.get(name) {
+            return *symbol;
+        }
+        // if 2 threads race to intern the same new string, one leaked copy goes unused, which is harmless
+        let name: &'static str = Box::leak(name.into());
+        *SYMBOL_TABLE.entry(name).or_insert_with(|| Symbol {
+            id: NEXT_SYMBOL_ID.fetch_add(1, Relaxed),
+            name,
+        })
+    }
+
+    pub fn as_str(&self) -> &'static str {
+        self.name
+    }
+
+    /// A unique id for this symbol, which depends on the order symbols were interned in
+    pub fn id(&self) -> u32 {
+        self.id
+    }
+}
+impl PartialEq for Symbol {
+    fn eq(&self, other: &Self) -> bool {
+        self.id == other.id
+    }
+}
+impl Eq for Symbol {}
+impl Hash for Symbol {
+    fn hash<H: Hasher>(&self, state: &mut H) {
+        state.write_u32(self.id);
+    }
+}
+// symbols are ordered by their strings rather than their ids, so ordering doesn't depend on interning order
+impl Ord for Symbol {
+    fn cmp(&self, other: &Self) -> Ordering {
+        if self.id == other.id {
+            Ordering::Equal
+        } else {
+            self.name.cmp(other.name)
+        }
+    }
+}
+impl PartialOrd for Symbol {
+    fn partial_cmp(&self, other: &Self) -> Option<Ordering> {
+        Some(self.cmp(other))
+    }
+}
+impl fmt::Debug for Symbol {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        fmt::Debug::fmt(self.name, f)
+    }
+}
+impl fmt::Display for Symbol {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        f.write_str(self.name)
+    }
+}
+
+#[cfg(test)]
+mod test {
+    use super::Symbol;
+
+    #[test]
+    fn test_intern_returns_the_same_symbol_for_the_same_string() {
+        let symbol = Symbol::intern("interned");
+        assert_eq!(symbol, Symbol::intern("interned"));
+        assert_ne!(symbol, Symbol::intern("interned_2"));
+        assert_eq!(symbol.as_str(), "interned");
+    }
+
+    #[test]
+    fn test_symbols_are_ordered_by_string() {
+        let b = Symbol::intern("ordered_b");
+        let a = Symbol::intern("ordered_a");
+        assert!(a < b);
+    }
+}
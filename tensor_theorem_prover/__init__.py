@@ -1,6 +1,13 @@
 __version__ = "0.14.0"
 
-from .prover import ResolutionProver, Proof, ProofStep, ProofStats
+from .prover import (
+    CancellationToken,
+    ResolutionProver,
+    Proof,
+    ProofStep,
+    ProofStats,
+    SimilarityCacheStats,
+)
 
 from .types import (
     Atom,
@@ -18,12 +25,19 @@ from .types import (
 )
 
 from .similarity import (
+    batch_cosine_similarity,
     cosine_similarity,
     symbol_compare,
     max_similarity,
+    native_cosine_similarity,
+    native_symbol_compare,
+    NativeSimilarityFunc,
     SimilarityFunc,
+    BatchSimilarityFunc,
 )
 
+from .embedding_store import EmbeddingStore, StoredEmbedding
+
 __all__ = (
     "ResolutionProver",
     "Atom",
@@ -38,11 +52,20 @@ __all__ = (
     "All",
     "Clause",
     "Function",
+    "batch_cosine_similarity",
     "cosine_similarity",
     "symbol_compare",
     "max_similarity",
+    "native_cosine_similarity",
+    "native_symbol_compare",
+    "NativeSimilarityFunc",
     "SimilarityFunc",
+    "BatchSimilarityFunc",
+    "EmbeddingStore",
+    "StoredEmbedding",
     "Proof",
     "ProofStep",
     "ProofStats",
+    "CancellationToken",
+    "SimilarityCacheStats",
 )
@@ -1,8 +1,8 @@
 from __future__ import annotations
 
-from typing import Any, Optional, Union
+from typing import Any, Callable, Optional, Union
 
-from tensor_theorem_prover.similarity import SimilarityFunc
+from tensor_theorem_prover.similarity import BatchSimilarityFunc, SimilarityFunc
 
 # The _rust module is just a flat module, since submodules using pyO3 seems finicky.
 
@@ -71,6 +71,18 @@ class RsProofStats:
     max_resolvent_width_seen: int
     max_depth_seen: int
     discarded_proofs: int
+    evicted_resolvents: int
+    similarity_cache_hits: int
+    similarity_cache_misses: int
+    similarity_cache_evictions: int
+    truncated: bool
+
+class RsSimilarityCacheStats:
+    size: int
+    capacity: Optional[int]
+    hits: int
+    misses: int
+    evictions: int
 
 class RsProof:
     goal: RsCNFDisjunction
@@ -81,6 +93,19 @@ class RsProof:
     depth: int
     proof_steps: list[RsProofStep]
 
+class RsNativeSimilarity:
+    def __init__(self, kind: str, funcs: list[RsNativeSimilarity]) -> None: ...
+
+class RsCancellationToken:
+    is_cancelled: bool
+    def __init__(self) -> None: ...
+    def cancel(self) -> None: ...
+
+class RsProofStream:
+    def __iter__(self) -> RsProofStream: ...
+    def __next__(self) -> RsProof: ...
+    def cancel(self) -> None: ...
+
 class RsResolutionProverBackend:
     max_proof_depth: int
     max_resolution_attempts: Optional[int]
@@ -93,6 +118,7 @@ class RsResolutionProverBackend:
     base_knowledge: set[RsCNFDisjunction]
     num_workers: int
     eval_batch_size: int
+    predicate_matching: str
 
     def __init__(
         self,
@@ -107,14 +133,73 @@ class RsResolutionProverBackend:
         base_knowledge: set[RsCNFDisjunction],
         num_workers: int,
         eval_batch_size: int,
+        predicate_matching: str,
+        native_similarity: Optional[RsNativeSimilarity],
+        py_batch_similarity_fn: Optional[BatchSimilarityFunc],
+        share_thread_pool: bool,
+        search_strategy: str,
+        beam_width: Optional[int],
+        max_seen_resolvents: Optional[int],
+        similarity_cache_size: Optional[int],
+        symmetric_similarity: bool,
+        embedding_identity: str,
+        persist_similarity_cache: bool,
     ) -> None: ...
     def extend_knowledge(self, knowledge: set[RsCNFDisjunction]) -> None: ...
+    def set_num_workers(self, num_workers: int) -> None: ...
     def prove_all_with_stats(
         self,
         inverted_goals: set[RsCNFDisjunction],
         extra_knowledge: Optional[set[RsCNFDisjunction]],
         max_proofs: Optional[int],
         skip_seen_resolvents: Optional[bool],
+        timeout: Optional[float],
+        cancellation_token: Optional[RsCancellationToken],
     ) -> tuple[list[RsProof], RsProofStats]: ...
+    def prove_all_with_stats_async(
+        self,
+        inverted_goals: set[RsCNFDisjunction],
+        extra_knowledge: Optional[set[RsCNFDisjunction]],
+        max_proofs: Optional[int],
+        skip_seen_resolvents: Optional[bool],
+        timeout: Optional[float],
+        cancellation_token: Optional[RsCancellationToken],
+        callback: Callable[
+            [Optional[tuple[list[RsProof], RsProofStats]], Optional[str]], None
+        ],
+    ) -> RsCancellationToken: ...
+    def iter_proofs(
+        self,
+        inverted_goals: set[RsCNFDisjunction],
+        extra_knowledge: Optional[set[RsCNFDisjunction]],
+        skip_seen_resolvents: Optional[bool],
+        timeout: Optional[float],
+        cancellation_token: Optional[RsCancellationToken],
+        buffer_size: int,
+    ) -> RsProofStream: ...
+    def prove_all_batch_with_stats(
+        self,
+        inverted_goals_batch: list[set[RsCNFDisjunction]],
+        extra_knowledge: Optional[set[RsCNFDisjunction]],
+        max_proofs: Optional[int],
+        skip_seen_resolvents: Optional[bool],
+        timeout: Optional[float],
+        cancellation_token: Optional[RsCancellationToken],
+    ) -> list[tuple[list[RsProof], RsProofStats]]: ...
+    def cache_predicate_similarities(
+        self,
+        sources: list[RsPredicate],
+        targets: list[RsPredicate],
+        similarities: Any,
+    ) -> None: ...
+    def cache_constant_similarities(
+        self,
+        sources: list[RsConstant],
+        targets: list[RsConstant],
+        similarities: Any,
+    ) -> None: ...
     def reset(self) -> None: ...
     def purge_similarity_cache(self) -> None: ...
+    def similarity_cache_stats(self) -> Optional[RsSimilarityCacheStats]: ...
+    def export_similarity_cache(self) -> bytes: ...
+    def load_similarity_cache(self, data: Any) -> None: ...
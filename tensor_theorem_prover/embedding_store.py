@@ -0,0 +1,290 @@
+from __future__ import annotations
+import os
+from typing import Any, Literal, Optional, Sequence, Union
+
+# optional dependency numpy
+try:
+    import numpy as np
+
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+from tensor_theorem_prover.types.Constant import Constant
+from tensor_theorem_prover.types.Predicate import Predicate
+
+Quantization = Literal["float16", "int8"]
+
+# how many values are quantized at once, so quantizing a memory-mapped matrix only reads part of it into memory at a time
+_QUANTIZATION_CHUNK_VALUES = 1 << 20
+
+
+class StoredEmbedding:
+    """
+    A reference to a single row of an EmbeddingStore, used as the embedding of a symbol.
+    The store hands out the same object for a row every time, so the row identifies the embedding
+    for the similarity cache. Converts to a read-only NumPy view of the row without copying it,
+    or to a dequantized copy of the row if the store is quantized.
+    The views are read-only so native similarity can borrow them rather than copying them
+    """
+
+    __slots__ = ("store", "row")
+
+    store: EmbeddingStore
+    row: int
+
+    def __init__(self, store: EmbeddingStore, row: int) -> None:
+        self.store = store
+        self.row = row
+
+    @property
+    def quantized_values(self) -> Optional[Any]:
+        """
+        The quantized values of the row, without dequantizing them, or None if the store isn't quantized.
+        These are proportional to the normalized embedding, so they give the same cosine similarity
+        as the dequantized values. Native similarity reads these directly
+        """
+        if self.store.scales is None:
+            return None
+        return _read_only(self.store.matrix[self.row])
+
+    def __array__(self, dtype: Any = None, copy: Optional[bool] = None) -> Any:
+        # copy=True always returns a new array, and copy=False raises a ValueError if a copy is needed
+        if self.store.scales is not None:
+            if copy is False:
+                raise ValueError("Dequantizing a quantized embedding requires a copy")
+            values = self.store.matrix[self.row] * self.store.scales[self.row]
+            return values if dtype is None else values.astype(dtype, copy=False)
+        values = self.store.matrix[self.row]
+        if dtype is not None and values.dtype != np.dtype(dtype):
+            if copy is False:
+                raise ValueError(
+                    f"Converting a {values.dtype} embedding to {np.dtype(dtype)} requires a copy"
+                )
+            return values.astype(dtype)
+        if copy:
+            return values.copy()
+        return _read_only(values)
+
+    def __len__(self) -> int:
+        return int(self.store.matrix.shape[1])
+
+    def __reduce__(self) -> tuple[Any, tuple[EmbeddingStore, int]]:
+        # rebuilt through the store, so unpickled symbols still share one object per row
+        return (_stored_embedding, (self.store, self.row))
+
+    def __repr__(self) -> str:
+        return f"StoredEmbedding(row={self.row})"
+
+
+class EmbeddingStore:
+    """
+    Holds the embeddings of many symbols in a single contiguous matrix, with one row per symbol.
+    Symbols created with `constant()` and `predicate()` reference their row instead of each holding an array,
+    so they're cheap to create and pickle, and similarities can be computed for many rows at once.
+
+    If `quantization` is given, each embedding is normalized and stored as float16 values,
+    or as int8 values with a scale for each row, which cuts the memory needed by 4x or 8x compared to float64.
+    Cosine similarities of quantized embeddings differ from cosine_similarity of the original embeddings
+    by at most `4 * quantization_error`, where quantization_error is the largest distance between
+    a normalized embedding and its dequantized values. The bound usually works out to around 0.001 for float16
+    and 0.04 for int8, and in practice the error is several times smaller than the bound.
+    """
+
+    matrix: Any
+    symbols: tuple[str, ...]
+    path: Optional[str]
+    quantization: Optional[Quantization]
+    # the scale of each quantized row, or None if the store isn't quantized
+    scales: Optional[Any]
+    quantization_error: float
+    _rows: dict[str, int]
+    _embeddings: dict[int, StoredEmbedding]
+
+    def __init__(
+        self,
+        matrix: Any,
+        symbols: Sequence[str],
+        quantization: Optional[Quantization] = None,
+    ) -> None:
+        """
+        Create a store from a 2D matrix of embeddings, where row i is the embedding of symbols[i].
+        The matrix is used directly without copying if it's already a contiguous NumPy array and isn't quantized
+        """
+        if not has_numpy:
+            raise ImportError("EmbeddingStore requires numpy, but it is not installed")
+        self._init(matrix, symbols, None, quantization)
+
+    @classmethod
+    def load(
+        cls,
+        path: Union[str, os.PathLike[str]],
+        symbols: Sequence[str],
+        mmap: bool = True,
+        quantization: Optional[Quantization] = None,
+    ) -> EmbeddingStore:
+        """
+        Load the matrix from a `.npy` file. By default the file is memory-mapped read-only,
+        so the embeddings are only read from disk as they're used, and processes loading the same file share it.
+        Pickling a memory-mapped store only saves the path to the file, not the embeddings.
+        Quantized stores hold their quantized embeddings in memory. The file is still memory-mapped while quantizing,
+        so only a chunk of its rows is read into memory at a time
+        """
+        if not has_numpy:
+            raise ImportError("EmbeddingStore requires numpy, but it is not installed")
+        store = cls.__new__(cls)
+        matrix = np.load(path, mmap_mode="r" if mmap else None)
+        # quantized stores don't use the file once they're loaded, so they're pickled with their quantized embeddings
+        store_path = os.fspath(path) if mmap and quantization is None else None
+        store._init(matrix, symbols, store_path, quantization)
+        return store
+
+    def _init(
+        self,
+        matrix: Any,
+        symbols: Sequence[str],
+        path: Optional[str],
+        quantization: Optional[Quantization],
+        scales: Optional[Any] = None,
+        quantization_error: float = 0.0,
+    ) -> None:
+        matrix = np.asanyarray(matrix)
+        if matrix.ndim != 2:
+            raise ValueError("The embeddings matrix must be 2D")
+        if len(symbols) != matrix.shape[0]:
+            raise ValueError(
+                f"Got {len(symbols)} symbols for {matrix.shape[0]} rows of embeddings"
+            )
+        if quantization is not None and scales is None:
+            matrix, scales, quantization_error = _quantize(matrix, quantization)
+        self.matrix = matrix if path is not None else np.ascontiguousarray(matrix)
+        self.symbols = tuple(symbols)
+        self.path = path
+        self.quantization = quantization
+        self.scales = scales
+        self.quantization_error = quantization_error
+        self._rows = {symbol: row for row, symbol in enumerate(self.symbols)}
+        if len(self._rows) != len(self.symbols):
+            raise ValueError("Every row of the store must have a different symbol")
+        self._embeddings = {}
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+    def __contains__(self, symbol: object) -> bool:
+        return symbol in self._rows
+
+    def row(self, symbol: str) -> int:
+        """The row of the matrix holding the embedding for the symbol"""
+        try:
+            return self._rows[symbol]
+        except KeyError:
+            raise KeyError(f"No embedding for symbol {symbol!r}") from None
+
+    def embedding(self, symbol: str) -> StoredEmbedding:
+        """The embedding for the symbol. The same object is returned every time for the same symbol"""
+        return self._embedding_at(self.row(symbol))
+
+    def constant(self, symbol: str) -> Constant:
+        """Create a constant whose embedding is the symbol's row of the store"""
+        return Constant(symbol, self.embedding(symbol))
+
+    def predicate(self, symbol: str) -> Predicate:
+        """Create a predicate whose embedding is the symbol's row of the store"""
+        return Predicate(symbol, self.embedding(symbol))
+
+    def _embedding_at(self, row: int) -> StoredEmbedding:
+        embedding = self._embeddings.get(row)
+        if embedding is None:
+            embedding = self._embeddings.setdefault(row, StoredEmbedding(self, row))
+        return embedding
+
+    def _gather(self, rows: list[int]) -> Any:
+        """The dequantized embeddings in the given rows, as a float64 matrix"""
+        values = self.matrix[rows]
+        if self.scales is not None:
+            values = values * self.scales[rows, np.newaxis]
+        return np.asarray(values, dtype=np.float64)
+
+    def __getstate__(self) -> dict[str, Any]:
+        # memory-mapped stores are reloaded from their file rather than copying every embedding into the pickle
+        matrix = None if self.path is not None else self.matrix
+        return {
+            "matrix": matrix,
+            "symbols": self.symbols,
+            "path": self.path,
+            "quantization": self.quantization,
+            "scales": self.scales,
+            "quantization_error": self.quantization_error,
+        }
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        matrix = state["matrix"]
+        if matrix is None:
+            matrix = np.load(state["path"], mmap_mode="r")
+        self._init(
+            matrix,
+            state["symbols"],
+            state["path"],
+            state["quantization"],
+            state["scales"],
+            state["quantization_error"],
+        )
+
+
+def stack_embeddings(embeddings: Sequence[Any]) -> Any:
+    """
+    Stack embeddings into a float64 matrix, with one row per embedding.
+    Embeddings which all come from the same EmbeddingStore are gathered from its matrix in a single step
+    """
+    first = embeddings[0] if embeddings else None
+    if isinstance(first, StoredEmbedding) and all(
+        isinstance(embedding, StoredEmbedding) and embedding.store is first.store
+        for embedding in embeddings
+    ):
+        return first.store._gather([embedding.row for embedding in embeddings])
+    return np.stack(
+        [np.asarray(embedding, dtype=np.float64) for embedding in embeddings]
+    )
+
+
+def _stored_embedding(store: EmbeddingStore, row: int) -> StoredEmbedding:
+    return store._embedding_at(row)
+
+
+def _read_only(values: Any) -> Any:
+    """A read-only view of the values, leaving the array itself writable"""
+    view = values.view()
+    view.flags.writeable = False
+    return view
+
+
+def _quantize(matrix: Any, quantization: Quantization) -> tuple[Any, Any, float]:
+    """
+    Normalize each row and quantize it. Returns the quantized rows, the scale to dequantize each row,
+    and the largest distance between a normalized row and its dequantized values.
+    Rows are converted to float64 a chunk at a time, so a memory-mapped matrix is never read into memory all at once
+    """
+    if quantization not in ("float16", "int8"):
+        raise ValueError(f"Unknown quantization {quantization!r}")
+    num_rows, num_columns = matrix.shape
+    values = np.empty((num_rows, num_columns), dtype=quantization)
+    scales = np.ones(num_rows)
+    max_error = 0.0
+    chunk_rows = max(1, _QUANTIZATION_CHUNK_VALUES // max(1, num_columns))
+    for start in range(0, num_rows, chunk_rows):
+        rows = slice(start, min(start + chunk_rows, num_rows))
+        chunk = np.asarray(matrix[rows], dtype=np.float64)
+        norms = np.linalg.norm(chunk, axis=1, keepdims=True)
+        # zero embeddings stay zero, so their similarities are nan, same as cosine_similarity
+        normalized = chunk / np.where(norms == 0, 1.0, norms)
+        if quantization == "int8":
+            max_values = np.abs(normalized).max(axis=1, initial=0.0)
+            scales[rows] = np.where(max_values == 0, 1.0, max_values / 127)
+            values[rows] = np.rint(normalized / scales[rows, np.newaxis])
+        else:
+            values[rows] = normalized
+        dequantized = values[rows] * scales[rows, np.newaxis]
+        errors = np.linalg.norm(dequantized - normalized, axis=1)
+        max_error = max(max_error, float(errors.max(initial=0.0)))
+    return values, scales, max_error
@@ -7,8 +7,12 @@ class Skolemizer:
     """Helper class to generate unique skolem function names during conversion to CNF"""
 
     counter: int = 0
+    prefix: str
+
+    def __init__(self, prefix: str = "_SK_") -> None:
+        self.prefix = prefix
 
     def __call__(self, *terms: Term) -> BoundFunction:
         self.counter += 1
-        func = Function(f"_SK_{self.counter}")
+        func = Function(f"{self.prefix}{self.counter}")
         return func(*terms)
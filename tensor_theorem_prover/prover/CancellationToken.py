@@ -0,0 +1,28 @@
+from __future__ import annotations
+
+from tensor_theorem_prover._rust import RsCancellationToken
+
+
+class CancellationToken:
+    """
+    Token which can be passed to the prove methods of a ResolutionProver to stop the search early.
+    Calling cancel() from any thread, or from an asyncio task, stops the search as soon as possible,
+    and the prove method returns whatever proofs it found so far.
+    """
+
+    _rust_token: RsCancellationToken
+
+    def __init__(self) -> None:
+        self._rust_token = RsCancellationToken()
+
+    def cancel(self) -> None:
+        """Stop any proof search using this token"""
+        self._rust_token.cancel()
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether cancel() has been called"""
+        return self._rust_token.is_cancelled
+
+    def to_rust(self) -> RsCancellationToken:
+        return self._rust_token
@@ -13,6 +13,14 @@ class ProofStats:
     max_resolvent_width_seen: int = 0
     max_depth_seen: int = 0
     discarded_proofs: int = 0
+    # seen resolvents which were forgotten to stay within max_seen_resolvents
+    evicted_resolvents: int = 0
+    similarity_cache_hits: int = 0
+    similarity_cache_misses: int = 0
+    # similarities evicted from the similarity cache to make room for this search's similarities
+    similarity_cache_evictions: int = 0
+    # True if the search was stopped before it finished, e.g. because it timed out
+    truncated: bool = False
 
     @classmethod
     def from_rust(cls, rust_proof_stats: RsProofStats) -> ProofStats:
@@ -22,4 +30,9 @@ class ProofStats:
             max_resolvent_width_seen=rust_proof_stats.max_resolvent_width_seen,
             max_depth_seen=rust_proof_stats.max_depth_seen,
             discarded_proofs=rust_proof_stats.discarded_proofs,
+            evicted_resolvents=rust_proof_stats.evicted_resolvents,
+            similarity_cache_hits=rust_proof_stats.similarity_cache_hits,
+            similarity_cache_misses=rust_proof_stats.similarity_cache_misses,
+            similarity_cache_evictions=rust_proof_stats.similarity_cache_evictions,
+            truncated=rust_proof_stats.truncated,
         )
@@ -1,21 +1,48 @@
 from __future__ import annotations
+import asyncio
+import mmap
 import multiprocessing
+import os
 
-from typing import Iterable, Optional
+from typing import Iterable, Iterator, Literal, Optional, Sequence, Union
 
 from tensor_theorem_prover.normalize import (
+    CNFDisjunction,
     Skolemizer,
     to_cnf,
 )
+from tensor_theorem_prover.prover.CancellationToken import CancellationToken
 from tensor_theorem_prover.prover.Proof import Proof
 from tensor_theorem_prover.prover.ProofStats import ProofStats
+from tensor_theorem_prover.prover.SimilarityCacheStats import SimilarityCacheStats
+from tensor_theorem_prover.prover.SimilarityPrecomputer import SimilarityPrecomputer
 from tensor_theorem_prover.similarity import (
+    BatchSimilarityFunc,
+    NativeSimilarityFunc,
     SimilarityFunc,
+    batch_cosine_similarity,
     cosine_similarity,
+    native_cosine_similarity,
+    native_symbol_compare,
+    symbol_compare,
 )
 from tensor_theorem_prover.types import Clause, Not
 
-from tensor_theorem_prover._rust import RsCNFDisjunction, RsResolutionProverBackend
+from tensor_theorem_prover._rust import (
+    RsCNFDisjunction,
+    RsProof,
+    RsProofStats,
+    RsProofStream,
+    RsResolutionProverBackend,
+)
+
+# skolem functions in goals and extra knowledge only need to be unique within a single call,
+# so each call starts counting from 1 again. Otherwise every query would create new symbol names,
+# which are interned for the life of the process
+QUERY_SKOLEM_PREFIX = "_SKQ_"
+
+SearchStrategy = Literal["breadth_first", "best_first", "iterative_deepening"]
+EmbeddingIdentity = Literal["object", "content"]
 
 
 class ResolutionProver:
@@ -25,6 +52,7 @@ class ResolutionProver:
 
     skolemizer: Skolemizer
     backend: RsResolutionProverBackend
+    similarity_precomputer: Optional[SimilarityPrecomputer]
 
     def __init__(
         self,
@@ -39,43 +67,126 @@ class ResolutionProver:
         find_highest_similarity_proofs: bool = True,
         num_workers: Optional[int] = None,
         eval_batch_size: int = 5000,
+        precompute_similarity: bool = False,
+        batch_similarity_func: Optional[BatchSimilarityFunc] = None,
+        share_thread_pool: bool = False,
+        search_strategy: SearchStrategy = "breadth_first",
+        beam_width: Optional[int] = None,
+        max_seen_resolvents: Optional[int] = None,
+        similarity_cache_size: Optional[int] = None,
+        symmetric_similarity: Optional[bool] = None,
+        embedding_identity: EmbeddingIdentity = "object",
+        persist_similarity_cache: bool = False,
     ) -> None:
+        if batch_similarity_func is not None and not cache_similarity:
+            raise ValueError("batch_similarity_func requires cache_similarity=True")
+        if persist_similarity_cache and not cache_similarity:
+            raise ValueError("persist_similarity_cache requires cache_similarity=True")
+        if precompute_similarity:
+            if (
+                similarity_func not in (cosine_similarity, native_cosine_similarity)
+                or batch_similarity_func is not None
+            ):
+                raise ValueError("precompute_similarity requires cosine similarity")
+            if not cache_similarity:
+                raise ValueError("precompute_similarity requires cache_similarity=True")
         self.skolemizer = Skolemizer()
-        # contention gets pretty bad after 6 threads, so default to a max of 6 for now
-        auto_num_workers = max(6, multiprocessing.cpu_count())
+        # native similarity funcs run directly in Rust, so they're never passed as a Python callback
+        native_similarity = None
+        py_similarity_func = similarity_func
+        if isinstance(similarity_func, NativeSimilarityFunc):
+            native_similarity = similarity_func.to_rust()
+            py_similarity_func = None
         self.backend = RsResolutionProverBackend(
             max_proof_depth,
             max_resolvent_width,
             max_resolution_attempts,
-            similarity_func,
+            py_similarity_func,
             min_similarity_threshold,
             cache_similarity,
             skip_seen_resolvents,
             find_highest_similarity_proofs,
             set(),
-            max(1, num_workers or auto_num_workers),
+            _resolve_num_workers(num_workers),
             eval_batch_size,
+            _predicate_matching(
+                batch_similarity_func or similarity_func, min_similarity_threshold
+            ),
+            native_similarity,
+            batch_similarity_func,
+            share_thread_pool,
+            search_strategy,
+            beam_width,
+            max_seen_resolvents,
+            similarity_cache_size,
+            _resolve_symmetric_similarity(
+                symmetric_similarity, similarity_func, batch_similarity_func
+            ),
+            embedding_identity,
+            persist_similarity_cache,
+        )
+        self.similarity_precomputer = (
+            SimilarityPrecomputer(self.backend) if precompute_similarity else None
         )
         if knowledge is not None:
             self.extend_knowledge(knowledge)
 
     def extend_knowledge(self, knowledge: Iterable[Clause]) -> None:
         """Add more knowledge to the prover"""
-        self.backend.extend_knowledge(self._parse_knowledge(knowledge))
+        parsed_knowledge = self._parse_cnf(knowledge)
+        if self.similarity_precomputer is not None:
+            self.similarity_precomputer.add_clauses(parsed_knowledge)
+        self.backend.extend_knowledge(set(cnf.to_rust() for cnf in parsed_knowledge))
 
-    def _parse_knowledge(self, knowledge: Iterable[Clause]) -> set[RsCNFDisjunction]:
-        """Parse the knowledge into CNF form"""
+    def _parse_cnf(
+        self, knowledge: Iterable[Clause], skolemizer: Optional[Skolemizer] = None
+    ) -> set[CNFDisjunction]:
         parsed_knowledge = set()
         for clause in knowledge:
-            parsed_knowledge.update(to_cnf(clause, self.skolemizer))
+            parsed_knowledge.update(to_cnf(clause, skolemizer or self.skolemizer))
+        return parsed_knowledge
+
+    def _parse_knowledge(
+        self, knowledge: Iterable[Clause], skolemizer: Skolemizer
+    ) -> set[RsCNFDisjunction]:
+        """Parse the extra knowledge for a single query into CNF form"""
+        parsed_knowledge = self._parse_cnf(knowledge, skolemizer)
+        if self.similarity_precomputer is not None:
+            self.similarity_precomputer.add_query_clauses(parsed_knowledge)
         return set(cnf.to_rust() for cnf in parsed_knowledge)
 
+    def set_num_workers(self, num_workers: Optional[int]) -> None:
+        """Change the number of worker threads used for proof search"""
+        self.backend.set_num_workers(_resolve_num_workers(num_workers))
+
+    def _parse_goal(
+        self, goal: Clause, skolemizer: Skolemizer
+    ) -> set[RsCNFDisjunction]:
+        """Invert the goal and parse it into CNF form"""
+        cnf_inverted_goals = to_cnf(Not(goal), skolemizer)
+        if self.similarity_precomputer is not None:
+            self.similarity_precomputer.add_query_clauses(cnf_inverted_goals)
+        return set(cnf.to_rust() for cnf in cnf_inverted_goals)
+
     def prove(
-        self, goal: Clause, extra_knowledge: Optional[Iterable[Clause]] = None
+        self,
+        goal: Clause,
+        extra_knowledge: Optional[Iterable[Clause]] = None,
+        timeout: Optional[float] = None,
+        cancellation_token: Optional[CancellationToken] = None,
     ) -> Optional[Proof]:
-        """Find the proof for the given goal with highest similarity score"""
+        """
+        Find the proof for the given goal with highest similarity score.
+        If timeout (in seconds) is given, the search stops when it runs out and returns the best proof found so far.
+        Likewise, the search stops if the cancellation_token is cancelled.
+        """
         proofs = self.prove_all(
-            goal, extra_knowledge, max_proofs=1, skip_seen_resolvents=True
+            goal,
+            extra_knowledge,
+            max_proofs=1,
+            skip_seen_resolvents=True,
+            timeout=timeout,
+            cancellation_token=cancellation_token,
         )
         if proofs:
             return proofs[0]
@@ -87,6 +198,8 @@ class ResolutionProver:
         extra_knowledge: Optional[Iterable[Clause]] = None,
         max_proofs: Optional[int] = None,
         skip_seen_resolvents: Optional[bool] = None,
+        timeout: Optional[float] = None,
+        cancellation_token: Optional[CancellationToken] = None,
     ) -> list[Proof]:
         """Find all possible proofs for the given goal, sorted by similarity score"""
         proofs, _ = self.prove_all_with_stats(
@@ -94,6 +207,8 @@ class ResolutionProver:
             extra_knowledge,
             max_proofs=max_proofs,
             skip_seen_resolvents=skip_seen_resolvents,
+            timeout=timeout,
+            cancellation_token=cancellation_token,
         )
         return proofs
 
@@ -103,25 +218,349 @@ class ResolutionProver:
         extra_knowledge: Optional[Iterable[Clause]] = None,
         max_proofs: Optional[int] = None,
         skip_seen_resolvents: Optional[bool] = None,
+        timeout: Optional[float] = None,
+        cancellation_token: Optional[CancellationToken] = None,
     ) -> tuple[list[Proof], ProofStats]:
         """
         Find all possible proofs for the given goal, sorted by similarity score.
         Return the proofs and the stats for the proof search.
+        If timeout (in seconds) is given, the search stops when it runs out, returning the proofs found so far,
+        and the stats are marked as truncated. The same happens if the cancellation_token is cancelled.
         """
-        inverted_goals = set(
-            cnf.to_rust() for cnf in to_cnf(Not(goal), self.skolemizer)
+        skolemizer = Skolemizer(QUERY_SKOLEM_PREFIX)
+        inverted_goals = self._parse_goal(goal, skolemizer)
+        parsed_extra_knowledge = self._parse_knowledge(
+            extra_knowledge or [], skolemizer
         )
-        parsed_extra_knowledge = self._parse_knowledge(extra_knowledge or [])
         (rust_proofs, rust_stats) = self.backend.prove_all_with_stats(
-            inverted_goals, parsed_extra_knowledge, max_proofs, skip_seen_resolvents
+            inverted_goals,
+            parsed_extra_knowledge,
+            max_proofs,
+            skip_seen_resolvents,
+            timeout,
+            cancellation_token.to_rust() if cancellation_token else None,
         )
         proofs = [Proof.from_rust(rust_proof) for rust_proof in rust_proofs]
         stats = ProofStats.from_rust(rust_stats)
         return (proofs, stats)
 
+    async def prove_async(
+        self,
+        goal: Clause,
+        extra_knowledge: Optional[Iterable[Clause]] = None,
+        timeout: Optional[float] = None,
+        cancellation_token: Optional[CancellationToken] = None,
+    ) -> Optional[Proof]:
+        """
+        Async version of prove(). The search runs on the prover's worker threads without blocking the event loop,
+        and cancelling the awaiting task cancels the search, but not the cancellation_token passed in.
+        """
+        proofs = await self.prove_all_async(
+            goal,
+            extra_knowledge,
+            max_proofs=1,
+            skip_seen_resolvents=True,
+            timeout=timeout,
+            cancellation_token=cancellation_token,
+        )
+        if proofs:
+            return proofs[0]
+        return None
+
+    async def prove_all_async(
+        self,
+        goal: Clause,
+        extra_knowledge: Optional[Iterable[Clause]] = None,
+        max_proofs: Optional[int] = None,
+        skip_seen_resolvents: Optional[bool] = None,
+        timeout: Optional[float] = None,
+        cancellation_token: Optional[CancellationToken] = None,
+    ) -> list[Proof]:
+        """Async version of prove_all()"""
+        proofs, _ = await self.prove_all_with_stats_async(
+            goal,
+            extra_knowledge,
+            max_proofs=max_proofs,
+            skip_seen_resolvents=skip_seen_resolvents,
+            timeout=timeout,
+            cancellation_token=cancellation_token,
+        )
+        return proofs
+
+    async def prove_all_with_stats_async(
+        self,
+        goal: Clause,
+        extra_knowledge: Optional[Iterable[Clause]] = None,
+        max_proofs: Optional[int] = None,
+        skip_seen_resolvents: Optional[bool] = None,
+        timeout: Optional[float] = None,
+        cancellation_token: Optional[CancellationToken] = None,
+    ) -> tuple[list[Proof], ProofStats]:
+        """Async version of prove_all_with_stats()"""
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[
+            tuple[list[RsProof], RsProofStats]
+        ] = loop.create_future()
+
+        # called from a Rust worker thread once the search is done
+        def on_complete(
+            result: Optional[tuple[list[RsProof], RsProofStats]], error: Optional[str]
+        ) -> None:
+            try:
+                loop.call_soon_threadsafe(_resolve_future, future, result, error)
+            except RuntimeError:
+                # the event loop has already been closed, so nobody is waiting for the result
+                pass
+
+        skolemizer = Skolemizer(QUERY_SKOLEM_PREFIX)
+        # the search's own token stops it if the awaiting task is cancelled, without cancelling the caller's token
+        search_token = self.backend.prove_all_with_stats_async(
+            self._parse_goal(goal, skolemizer),
+            self._parse_knowledge(extra_knowledge or [], skolemizer),
+            max_proofs,
+            skip_seen_resolvents,
+            timeout,
+            cancellation_token.to_rust() if cancellation_token else None,
+            on_complete,
+        )
+        try:
+            rust_proofs, rust_stats = await future
+        except asyncio.CancelledError:
+            search_token.cancel()
+            raise
+        proofs = [Proof.from_rust(rust_proof) for rust_proof in rust_proofs]
+        stats = ProofStats.from_rust(rust_stats)
+        return (proofs, stats)
+
+    def iter_proofs(
+        self,
+        goal: Clause,
+        extra_knowledge: Optional[Iterable[Clause]] = None,
+        skip_seen_resolvents: Optional[bool] = None,
+        timeout: Optional[float] = None,
+        cancellation_token: Optional[CancellationToken] = None,
+        buffer_size: int = 16,
+    ) -> Iterator[Proof]:
+        """
+        Yield proofs as soon as the search finds them, rather than waiting for the whole search to finish.
+        Proofs are yielded in the order they're found, which isn't necessarily the order of their similarity scores.
+        The search runs in the background, and pauses once `buffer_size` proofs are waiting to be consumed.
+        Stopping the iteration early cancels the rest of the search.
+        """
+        if buffer_size < 0:
+            raise ValueError("buffer_size must not be negative")
+        skolemizer = Skolemizer(QUERY_SKOLEM_PREFIX)
+        stream = self.backend.iter_proofs(
+            self._parse_goal(goal, skolemizer),
+            self._parse_knowledge(extra_knowledge or [], skolemizer),
+            skip_seen_resolvents,
+            timeout,
+            cancellation_token.to_rust() if cancellation_token else None,
+            buffer_size,
+        )
+        return _iter_stream(stream)
+
+    def prove_batch(
+        self,
+        goals: Sequence[Clause],
+        extra_knowledge: Optional[Iterable[Clause]] = None,
+        timeout: Optional[float] = None,
+        cancellation_token: Optional[CancellationToken] = None,
+    ) -> list[Optional[Proof]]:
+        """
+        Find the proof with highest similarity score for each of the given goals.
+        All the goals are searched concurrently, so this is faster than calling prove() in a loop.
+        """
+        proofs_batch = self.prove_all_batch(
+            goals,
+            extra_knowledge,
+            max_proofs=1,
+            skip_seen_resolvents=True,
+            timeout=timeout,
+            cancellation_token=cancellation_token,
+        )
+        return [proofs[0] if proofs else None for proofs in proofs_batch]
+
+    def prove_all_batch(
+        self,
+        goals: Sequence[Clause],
+        extra_knowledge: Optional[Iterable[Clause]] = None,
+        max_proofs: Optional[int] = None,
+        skip_seen_resolvents: Optional[bool] = None,
+        timeout: Optional[float] = None,
+        cancellation_token: Optional[CancellationToken] = None,
+    ) -> list[list[Proof]]:
+        """Find all possible proofs for each of the given goals, sorted by similarity score"""
+        results = self.prove_all_batch_with_stats(
+            goals,
+            extra_knowledge,
+            max_proofs=max_proofs,
+            skip_seen_resolvents=skip_seen_resolvents,
+            timeout=timeout,
+            cancellation_token=cancellation_token,
+        )
+        return [proofs for proofs, _ in results]
+
+    def prove_all_batch_with_stats(
+        self,
+        goals: Sequence[Clause],
+        extra_knowledge: Optional[Iterable[Clause]] = None,
+        max_proofs: Optional[int] = None,
+        skip_seen_resolvents: Optional[bool] = None,
+        timeout: Optional[float] = None,
+        cancellation_token: Optional[CancellationToken] = None,
+    ) -> list[tuple[list[Proof], ProofStats]]:
+        """
+        Find all possible proofs for each of the given goals, sorted by similarity score.
+        Return the proofs and the stats for each goal, in the same order as the goals.
+        If timeout (in seconds) or cancellation_token are given, they apply to the whole batch rather than to each goal.
+        """
+        # the goals share the extra knowledge, so they all share a skolemizer with it
+        skolemizer = Skolemizer(QUERY_SKOLEM_PREFIX)
+        inverted_goals_batch = [self._parse_goal(goal, skolemizer) for goal in goals]
+        parsed_extra_knowledge = self._parse_knowledge(
+            extra_knowledge or [], skolemizer
+        )
+        rust_results = self.backend.prove_all_batch_with_stats(
+            inverted_goals_batch,
+            parsed_extra_knowledge,
+            max_proofs,
+            skip_seen_resolvents,
+            timeout,
+            cancellation_token.to_rust() if cancellation_token else None,
+        )
+        return [
+            (
+                [Proof.from_rust(rust_proof) for rust_proof in rust_proofs],
+                ProofStats.from_rust(rust_stats),
+            )
+            for rust_proofs, rust_stats in rust_results
+        ]
+
     def purge_similarity_cache(self) -> None:
+        """Wipe the similarity cache. Precomputed similarities are written back into the fresh cache"""
         self.backend.purge_similarity_cache()
+        if self.similarity_precomputer is not None:
+            self.similarity_precomputer.recache()
+
+    def similarity_cache_stats(self) -> Optional[SimilarityCacheStats]:
+        """Stats on the similarity cache since it was created or last purged, or None if caching is disabled"""
+        rust_stats = self.backend.similarity_cache_stats()
+        if rust_stats is None:
+            return None
+        return SimilarityCacheStats.from_rust(rust_stats)
+
+    def save_similarity_cache(self, path: Union[str, os.PathLike[str]]) -> None:
+        """
+        Save every cached similarity to a file, so it can be loaded with load_similarity_cache by other provers,
+        including in other processes. Any similarities loaded from a file are saved as well.
+        The file is replaced atomically, so processes which already loaded the old file are unaffected.
+        Requires the prover to be created with persist_similarity_cache=True.
+        """
+        data = self.backend.export_similarity_cache()
+        tmp_path = f"{os.fspath(path)}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def load_similarity_cache(self, path: Union[str, os.PathLike[str]]) -> None:
+        """
+        Load similarities saved by save_similarity_cache. The file is memory-mapped read-only,
+        so processes loading the same file share it rather than each holding a copy.
+        Similarities which aren't in the file are calculated and cached in memory as usual.
+        This replaces any file loaded previously. Raises a ValueError if the file was saved
+        by a prover with a different similarity function.
+        """
+        with open(path, "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.backend.load_similarity_cache(data)
 
     def reset(self) -> None:
-        """Clear all knowledge from the prover and wipe the similarity cache"""
+        """
+        Clear all knowledge from the prover and wipe the similarity cache,
+        including any similarities loaded with load_similarity_cache
+        """
         self.backend.reset()
+        if self.similarity_precomputer is not None:
+            self.similarity_precomputer = SimilarityPrecomputer(self.backend)
+
+
+def _iter_stream(stream: RsProofStream) -> Iterator[Proof]:
+    try:
+        for rust_proof in stream:
+            yield Proof.from_rust(rust_proof)
+    finally:
+        # cancels the search if the caller stopped iterating early
+        stream.cancel()
+
+
+def _resolve_future(
+    future: asyncio.Future[tuple[list[RsProof], RsProofStats]],
+    result: Optional[tuple[list[RsProof], RsProofStats]],
+    error: Optional[str],
+) -> None:
+    if future.done():
+        return
+    if result is None:
+        future.set_exception(RuntimeError(error))
+    else:
+        future.set_result(result)
+
+
+def _resolve_num_workers(num_workers: Optional[int]) -> int:
+    # contention gets pretty bad after 6 threads, so default to a max of 6 for now
+    auto_num_workers = max(6, multiprocessing.cpu_count())
+    return max(1, num_workers or auto_num_workers)
+
+
+def _predicate_matching(
+    similarity_func: Optional[Union[SimilarityFunc, BatchSimilarityFunc]],
+    min_similarity_threshold: float,
+) -> str:
+    """
+    Determine which predicates can possibly unify with each other under the given similarity func,
+    so the backend knows how aggressively it can index the knowledge base.
+    Custom similarity functions can match anything, so only polarity and arity can be indexed.
+    """
+    # symbol mismatches score 0.0, which only fails unification if the threshold is non-negative
+    if min_similarity_threshold < 0:
+        return "any"
+    if similarity_func in (None, symbol_compare, native_symbol_compare):
+        return "symbol"
+    if similarity_func in (
+        cosine_similarity,
+        native_cosine_similarity,
+        batch_cosine_similarity,
+    ):
+        return "embedding"
+    if isinstance(similarity_func, NativeSimilarityFunc):
+        # a max of native funcs can only unify whatever its loosest func can unify
+        matchings = {
+            _predicate_matching(func, min_similarity_threshold)
+            for func in similarity_func.funcs
+        }
+        for matching in ("any", "embedding"):
+            if matching in matchings:
+                return matching
+        return "symbol"
+    return "any"
+
+
+def _resolve_symmetric_similarity(
+    symmetric_similarity: Optional[bool],
+    similarity_func: Optional[SimilarityFunc],
+    batch_similarity_func: Optional[BatchSimilarityFunc],
+) -> bool:
+    """
+    Decide whether similarities can be cached regardless of argument order.
+    The built-in similarity funcs are all symmetric, but custom funcs are assumed not to be
+    unless the caller says so.
+    """
+    if symmetric_similarity is not None:
+        return symmetric_similarity
+    return all(
+        func is None
+        or func in (symbol_compare, cosine_similarity, batch_cosine_similarity)
+        or isinstance(func, NativeSimilarityFunc)
+        for func in (similarity_func, batch_similarity_func)
+    )
@@ -0,0 +1,29 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Optional
+
+from tensor_theorem_prover._rust import RsSimilarityCacheStats
+
+
+@dataclass
+class SimilarityCacheStats:
+    """Stats on the prover's similarity cache, since it was created or last purged"""
+
+    size: int = 0
+    # None if the cache is unbounded
+    capacity: Optional[int] = None
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @classmethod
+    def from_rust(
+        cls, rust_similarity_cache_stats: RsSimilarityCacheStats
+    ) -> SimilarityCacheStats:
+        return SimilarityCacheStats(
+            size=rust_similarity_cache_stats.size,
+            capacity=rust_similarity_cache_stats.capacity,
+            hits=rust_similarity_cache_stats.hits,
+            misses=rust_similarity_cache_stats.misses,
+            evictions=rust_similarity_cache_stats.evictions,
+        )
@@ -0,0 +1,217 @@
+from __future__ import annotations
+from typing import Any, Callable, Generic, Iterable, TypeVar
+
+# optional dependency numpy
+try:
+    import numpy as np
+
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+from tensor_theorem_prover.embedding_store import stack_embeddings
+from tensor_theorem_prover.normalize.to_cnf import CNFDisjunction
+from tensor_theorem_prover.types import Constant, Predicate, BoundFunction, Term
+
+from tensor_theorem_prover._rust import RsResolutionProverBackend
+
+SymbolT = TypeVar("SymbolT", Predicate, Constant)
+
+
+class SymbolMatrix(Generic[SymbolT]):
+    """
+    Normalized embeddings for every distinct embedded symbol of a single kind (predicate or constant)
+    in the knowledge base. Symbols which only appear in a query are compared against the matrix without being added,
+    so queries don't grow it
+    """
+
+    seen_keys: set[tuple[str, int]]
+    # the rust symbols also keep the embeddings alive, which matters since the cache is keyed by embedding ids
+    rust_symbols: list[Any]
+    matrix: Any
+
+    def __init__(self) -> None:
+        self.seen_keys = set()
+        self.rust_symbols = []
+        self.matrix = None
+
+    def add(self, symbols: Iterable[SymbolT]) -> tuple[list[Any], Any]:
+        """
+        Add the symbols which haven't been seen yet.
+        Returns the new rust symbols, and their similarity to every symbol seen so far (including themselves)
+        """
+        new_keys, new_rust_symbols, new_matrix = self._new_symbols(symbols)
+        self.seen_keys.update(new_keys)
+        if not new_rust_symbols:
+            return [], None
+        self.rust_symbols.extend(new_rust_symbols)
+        self.matrix = (
+            new_matrix
+            if self.matrix is None
+            else np.concatenate([self.matrix, new_matrix])
+        )
+        return new_rust_symbols, np.ascontiguousarray(new_matrix @ self.matrix.T)
+
+    def compare(self, symbols: Iterable[SymbolT]) -> tuple[list[Any], Any, Any]:
+        """
+        Compare query symbols which aren't in the matrix without adding them.
+        Returns the new rust symbols, their similarity to every symbol in the matrix,
+        and their similarity to each other
+        """
+        _, new_rust_symbols, new_matrix = self._new_symbols(symbols)
+        if not new_rust_symbols:
+            return [], None, None
+        matrix_similarities = (
+            None
+            if self.matrix is None
+            else np.ascontiguousarray(new_matrix @ self.matrix.T)
+        )
+        return (
+            new_rust_symbols,
+            matrix_similarities,
+            np.ascontiguousarray(new_matrix @ new_matrix.T),
+        )
+
+    def all_similarities(self) -> Any:
+        return np.ascontiguousarray(self.matrix @ self.matrix.T)
+
+    def _new_symbols(
+        self, symbols: Iterable[SymbolT]
+    ) -> tuple[set[tuple[str, int]], list[Any], Any]:
+        """
+        The keys of the distinct symbols which aren't in the matrix yet, and their rust symbols and normalized embeddings.
+        Symbols with zero embeddings are left out, since their cosine similarity is undefined,
+        so they're handled by the similarity func during the search like any uncached symbol
+        """
+        new_symbols: list[SymbolT] = []
+        new_keys: set[tuple[str, int]] = set()
+        for symbol in symbols:
+            key = (symbol.symbol, id(symbol.embedding))
+            if key not in self.seen_keys and key not in new_keys:
+                new_keys.add(key)
+                new_symbols.append(symbol)
+        if not new_symbols:
+            return new_keys, [], None
+        matrix, nonzero = _normalize([symbol.embedding for symbol in new_symbols])
+        rust_symbols = [
+            symbol.to_rust()
+            for symbol, is_nonzero in zip(new_symbols, nonzero)
+            if is_nonzero
+        ]
+        return new_keys, rust_symbols, matrix[nonzero]
+
+
+class SimilarityPrecomputer:
+    """
+    Precomputes the cosine similarity between every pair of embedded predicates and every pair of
+    embedded constants, so unification during the proof search is just a cache lookup.
+    Each batch of new symbols is compared against all symbols seen so far with a single matrix multiply.
+    """
+
+    backend: RsResolutionProverBackend
+    predicates: SymbolMatrix[Predicate]
+    constants: SymbolMatrix[Constant]
+
+    def __init__(self, backend: RsResolutionProverBackend) -> None:
+        if not has_numpy:
+            raise ImportError(
+                "precompute_similarity requires numpy, but it is not installed"
+            )
+        self.backend = backend
+        self.predicates = SymbolMatrix()
+        self.constants = SymbolMatrix()
+
+    def add_clauses(self, clauses: Iterable[CNFDisjunction]) -> None:
+        """Precompute similarities for any new symbols in knowledge base clauses"""
+        predicates, constants = _collect_symbols(clauses)
+        new_predicates, predicate_similarities = self.predicates.add(predicates)
+        if new_predicates:
+            self.backend.cache_predicate_similarities(
+                new_predicates, self.predicates.rust_symbols, predicate_similarities
+            )
+        new_constants, constant_similarities = self.constants.add(constants)
+        if new_constants:
+            self.backend.cache_constant_similarities(
+                new_constants, self.constants.rust_symbols, constant_similarities
+            )
+
+    def add_query_clauses(self, clauses: Iterable[CNFDisjunction]) -> None:
+        """
+        Precompute similarities for any new symbols in the goal or extra knowledge of a single query.
+        These are compared against the knowledge base, but not kept, so later queries don't pay for them
+        """
+        predicates, constants = _collect_symbols(clauses)
+        self._cache_query_similarities(
+            self.predicates,
+            predicates,
+            self.backend.cache_predicate_similarities,
+        )
+        self._cache_query_similarities(
+            self.constants,
+            constants,
+            self.backend.cache_constant_similarities,
+        )
+
+    def _cache_query_similarities(
+        self,
+        symbol_matrix: SymbolMatrix[SymbolT],
+        symbols: Iterable[SymbolT],
+        cache_similarities: Callable[[list[Any], list[Any], Any], None],
+    ) -> None:
+        new_symbols, matrix_similarities, query_similarities = symbol_matrix.compare(
+            symbols
+        )
+        if not new_symbols:
+            return
+        if matrix_similarities is not None:
+            cache_similarities(
+                new_symbols, symbol_matrix.rust_symbols, matrix_similarities
+            )
+        cache_similarities(new_symbols, new_symbols, query_similarities)
+
+    def recache(self) -> None:
+        """Write all the similarities back into the backend's cache, e.g. after the cache is purged"""
+        if self.predicates.rust_symbols:
+            self.backend.cache_predicate_similarities(
+                self.predicates.rust_symbols,
+                self.predicates.rust_symbols,
+                self.predicates.all_similarities(),
+            )
+        if self.constants.rust_symbols:
+            self.backend.cache_constant_similarities(
+                self.constants.rust_symbols,
+                self.constants.rust_symbols,
+                self.constants.all_similarities(),
+            )
+
+
+def _collect_symbols(
+    clauses: Iterable[CNFDisjunction],
+) -> tuple[list[Predicate], list[Constant]]:
+    predicates: list[Predicate] = []
+    constants: list[Constant] = []
+    for clause in clauses:
+        for literal in clause.literals:
+            if literal.atom.predicate.embedding is not None:
+                predicates.append(literal.atom.predicate)
+            _collect_constants(literal.atom.terms, constants)
+    return predicates, constants
+
+
+def _collect_constants(terms: Iterable[Term], constants: list[Constant]) -> None:
+    for term in terms:
+        if isinstance(term, Constant) and term.embedding is not None:
+            constants.append(term)
+        elif isinstance(term, BoundFunction):
+            _collect_constants(term.terms, constants)
+
+
+def _normalize(embeddings: list[Any]) -> tuple[Any, Any]:
+    """
+    Normalize the embeddings into a matrix with a row for each embedding.
+    Also returns a mask of the embeddings with a non-zero norm, since zero embeddings can't be normalized
+    """
+    matrix = stack_embeddings(embeddings)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    nonzero = norms[:, 0] > 0
+    return matrix / np.where(nonzero[:, np.newaxis], norms, 1.0), nonzero
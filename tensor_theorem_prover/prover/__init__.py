@@ -1,6 +1,15 @@
+from .CancellationToken import CancellationToken
 from .Proof import Proof
 from .ProofStep import ProofStep
 from .ProofStats import ProofStats
 from .ResolutionProver import ResolutionProver
+from .SimilarityCacheStats import SimilarityCacheStats
 
-__all__ = ("ResolutionProver", "Proof", "ProofStep", "ProofStats")
+__all__ = (
+    "CancellationToken",
+    "ResolutionProver",
+    "Proof",
+    "ProofStep",
+    "ProofStats",
+    "SimilarityCacheStats",
+)
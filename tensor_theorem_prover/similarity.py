@@ -1,5 +1,6 @@
 from __future__ import annotations
-from typing import Callable, Iterable, Union
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Literal, Sequence, Union
 
 # optional dependency numpy
 try:
@@ -11,14 +12,25 @@ except ImportError:
     has_numpy = False
 
 
+from tensor_theorem_prover.embedding_store import stack_embeddings
 from tensor_theorem_prover.types.Constant import Constant
 from tensor_theorem_prover.types.Predicate import Predicate
+from tensor_theorem_prover._rust import RsNativeSimilarity
 
 
 SimilarityFunc = Callable[
     [Union[Constant, Predicate], Union[Constant, Predicate]], float
 ]
 
+BatchSimilarityFunc = Callable[
+    [Sequence[Union[Constant, Predicate]], Sequence[Union[Constant, Predicate]]],
+    Any,
+]
+"""
+Takes 2 equal-length lists of items, and returns a sequence or 1D array containing
+the similarity of each pair (items_a[i], items_b[i])
+"""
+
 
 def symbol_compare(item1: Constant | Predicate, item2: Constant | Predicate) -> float:
     """
@@ -43,8 +55,83 @@ def cosine_similarity(
     )
 
 
+def batch_cosine_similarity(
+    items_a: Sequence[Constant | Predicate], items_b: Sequence[Constant | Predicate]
+) -> Any:
+    """
+    vectorized version of cosine_similarity, for use as a batch_similarity_func.
+    falls back to symbol comparison for any pair where either item is missing a embedding
+    """
+    if not has_numpy:
+        raise ImportError(
+            "batch_cosine_similarity requires numpy, but it is not installed"
+        )
+    similarities = np.array(
+        [symbol_compare(item1, item2) for item1, item2 in zip(items_a, items_b)],
+        dtype=np.float64,
+    )
+    embedded_indices = []
+    embeddings_a = []
+    embeddings_b = []
+    for i, (item1, item2) in enumerate(zip(items_a, items_b)):
+        if item1.embedding is not None and item2.embedding is not None:
+            embedded_indices.append(i)
+            embeddings_a.append(item1.embedding)
+            embeddings_b.append(item2.embedding)
+    if embedded_indices:
+        matrix_a = stack_embeddings(embeddings_a)
+        matrix_b = stack_embeddings(embeddings_b)
+        similarities[embedded_indices] = np.sum(matrix_a * matrix_b, axis=1) / (
+            norm(matrix_a, axis=1) * norm(matrix_b, axis=1)
+        )
+    return similarities
+
+
+@dataclass(frozen=True)
+class NativeSimilarityFunc:
+    """
+    A similarity function which the prover runs natively in Rust, without calling back into Python.
+    This lets all worker threads calculate similarities in parallel without waiting on the GIL.
+    Can still be called directly from Python like any other similarity function.
+    """
+
+    kind: Literal["cosine", "symbol_compare", "max"]
+    funcs: tuple[NativeSimilarityFunc, ...] = ()
+
+    def __call__(
+        self, item1: Constant | Predicate, item2: Constant | Predicate
+    ) -> float:
+        if self.kind == "cosine":
+            return cosine_similarity(item1, item2)
+        if self.kind == "symbol_compare":
+            return symbol_compare(item1, item2)
+        return max(func(item1, item2) for func in self.funcs)
+
+    def to_rust(self) -> RsNativeSimilarity:
+        return RsNativeSimilarity(self.kind, [func.to_rust() for func in self.funcs])
+
+
+native_cosine_similarity = NativeSimilarityFunc("cosine")
+"""
+Same as cosine_similarity, but calculated natively in Rust.
+Embeddings must be 1D arrays or sequences of floats.
+Embeddings from a quantized EmbeddingStore are compared using their quantized values, so the similarity
+differs from cosine_similarity of the original embeddings by at most `4 * store.quantization_error`.
+"""
+
+native_symbol_compare = NativeSimilarityFunc("symbol_compare")
+"""Same as symbol_compare, but calculated natively in Rust"""
+
+
 def max_similarity(funcs: Iterable[SimilarityFunc]) -> SimilarityFunc:
     """
-    returns a function that calls all the given functions and returns the maximum similarity score
+    returns a function that calls all the given functions and returns the maximum similarity score.
+    If all the given functions are native, the combined function is native too.
     """
-    return lambda item1, item2: max(func(item1, item2) for func in funcs)
+    funcs_list = list(funcs)
+    native_funcs = tuple(
+        func for func in funcs_list if isinstance(func, NativeSimilarityFunc)
+    )
+    if funcs_list and len(native_funcs) == len(funcs_list):
+        return NativeSimilarityFunc("max", native_funcs)
+    return lambda item1, item2: max(func(item1, item2) for func in funcs_list)
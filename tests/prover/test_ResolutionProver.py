@@ -1,10 +1,32 @@
 from __future__ import annotations
 
+import asyncio
 import pytest
+import threading
+import time
 from textwrap import dedent
+from typing import Any, Optional, Sequence
 import numpy as np
 
-from tensor_theorem_prover.prover.ResolutionProver import ResolutionProver
+from tensor_theorem_prover.embedding_store import EmbeddingStore, Quantization
+from tensor_theorem_prover.prover.CancellationToken import CancellationToken
+from tensor_theorem_prover.prover.Proof import Proof
+from tensor_theorem_prover.prover.ResolutionProver import (
+    EmbeddingIdentity,
+    ResolutionProver,
+    SearchStrategy,
+    _resolve_symmetric_similarity,
+)
+from tensor_theorem_prover.prover.SimilarityCacheStats import SimilarityCacheStats
+from tensor_theorem_prover.similarity import (
+    SimilarityFunc,
+    batch_cosine_similarity,
+    cosine_similarity,
+    max_similarity,
+    native_cosine_similarity,
+    native_symbol_compare,
+    symbol_compare,
+)
 from tensor_theorem_prover.types import (
     Variable,
     Predicate,
@@ -12,6 +34,8 @@ from tensor_theorem_prover.types import (
     Implies,
     And,
     Not,
+    All,
+    Exists,
     Clause,
 )
 from tests.helpers import to_disj
@@ -83,6 +107,67 @@ grandma_of_def = Implies(
     grandma_of(X, Y),
 )
 
+# embedded predicates, where dad_of is similar but not identical to father_of
+father_of_embed = Predicate("father_of", np.array([0.99, 0.25, 1.17]))
+dad_of_embed = Predicate("dad_of", np.array([1.0, 0.0, 1.0]))
+grandpa_of_def_embed = Implies(
+    And(father_of_embed(X, Z), father_of_embed(Z, Y)),
+    grandpa_of(X, Y),
+)
+# 4 proofs of grandpa_of(abe, bart), one for each combo of dad_of/father_of
+embed_knowledge: list[Clause] = [
+    father_of_embed(homer, bart),
+    dad_of_embed(homer, bart),
+    father_of_embed(abe, homer),
+    dad_of_embed(abe, homer),
+    grandpa_of_def_embed,
+]
+
+# these rules loop forever without ever proving parent_of, so the search tree doubles every 2 steps
+looping_knowledge: list[Clause] = [
+    Implies(parent_of(X, Y), father_of(X, Y)),
+    Implies(father_of(X, Y), parent_of(X, Y)),
+    Implies(parent_of(X, Y), mother_of(X, Y)),
+    Implies(mother_of(X, Y), parent_of(X, Y)),
+]
+
+
+def build_looping_prover(
+    knowledge: Sequence[Clause] = (), **options: Any
+) -> ResolutionProver:
+    return ResolutionProver(
+        knowledge=[*knowledge, *looping_knowledge],
+        max_proof_depth=100,
+        max_resolution_attempts=100_000_000,
+        **options,
+    )
+
+
+class CountingSimilarity:
+    """cosine_similarity, counting how many times it's called"""
+
+    num_calls: int
+
+    def __init__(self) -> None:
+        self.num_calls = 0
+
+    def __call__(
+        self, item1: Constant | Predicate, item2: Constant | Predicate
+    ) -> float:
+        self.num_calls += 1
+        return cosine_similarity(item1, item2)
+
+
+def build_parent_of_prover(**options: Any) -> ResolutionProver:
+    # fresh embedding arrays each time, as if the prover was rebuilt in another process
+    parent_of_embed = Predicate("parent_of", np.array([1.0, 0.0, 0.2]))
+    return ResolutionProver(knowledge=[parent_of_embed(homer, bart)], **options)
+
+
+def ancestor_of_goal() -> Clause:
+    # a fresh embedding array each time, as if the goal was rebuilt for each request
+    return Predicate("ancestor_of", np.array([0.9, 0.1, 0.2]))(X, bart)
+
 
 def test_single_step_proof() -> None:
     knowledge: list[Clause] = [
@@ -334,6 +419,17 @@ def test_prove_all_can_abort_early_if_best_proof_is_not_needed() -> None:
         assert proof.substitutions == {X: abe}
 
 
+def test_queries_dont_use_up_knowledge_skolem_functions() -> None:
+    prover = ResolutionProver(knowledge=[Exists(X, parent_of(X, bart))])
+    assert prover.skolemizer.counter == 1
+    goal = All(X, Implies(father_of(X, bart), parent_of(X, bart)))
+    for _ in range(3):
+        prover.prove(goal)
+        prover.prove_batch([goal, goal], extra_knowledge=[Exists(Y, father_of(Y, Y))])
+    # query skolem functions are numbered from 1 again in each call, so queries don't keep creating new symbols
+    assert prover.skolemizer.counter == 1
+
+
 def test_prove_all_can_abort_early_by_setting_max_resolution_attempts() -> None:
     father_of_embed = Predicate("father_of", np.array([0.99, 0.25, 1.17]))
     dad_of_embed = Predicate("dad_of", np.array([1.0, 0.0, 1.0]))
@@ -362,6 +458,775 @@ def test_prove_all_can_abort_early_by_setting_max_resolution_attempts() -> None:
     assert stats.attempted_resolutions < 25
 
 
+def test_prove_only_attempts_resolutions_against_clauses_with_matching_predicates() -> None:
+    knowledge: list[Clause] = [
+        parent_of(homer, bart),
+        father_of(abe, homer),
+        *[Predicate(f"unrelated_{i}")(homer, bart) for i in range(100)],
+    ]
+    prover = ResolutionProver(knowledge=knowledge)
+
+    proofs, stats = prover.prove_all_with_stats(father_of(X, homer))
+    assert len(proofs) == 1
+    assert proofs[0].substitutions == {X: abe}
+    assert stats.attempted_resolutions == 1
+
+
+def test_prove_with_custom_similarity_func_can_unify_different_predicate_symbols() -> None:
+    dad_of = Predicate("dad_of")
+
+    def dad_is_father(
+        item1: Constant | Predicate, item2: Constant | Predicate
+    ) -> float:
+        symbols = {item1.symbol, item2.symbol}
+        return 1.0 if len(symbols) == 1 or symbols == {"dad_of", "father_of"} else 0.0
+
+    prover = ResolutionProver(
+        knowledge=[dad_of(abe, homer)], similarity_func=dad_is_father
+    )
+    proof = prover.prove(father_of(X, homer))
+
+    assert proof is not None
+    assert proof.substitutions == {X: abe}
+
+
+def test_prove_all_with_native_similarity_matches_python_similarity() -> None:
+    knowledge: list[Clause] = [
+        father_of_embed(homer, bart),
+        father_of_embed(abe, homer),
+        grandpa_of_def_embed,
+    ]
+    # the dad_of facts are only passed in as extra knowledge, so their embeddings are read per-query
+    extra_knowledge: list[Clause] = [
+        dad_of_embed(homer, bart),
+        dad_of_embed(abe, homer),
+    ]
+    goal = grandpa_of(X, bart)
+
+    py_prover = ResolutionProver(knowledge=knowledge, similarity_func=cosine_similarity)
+    native_prover = ResolutionProver(
+        knowledge=knowledge,
+        similarity_func=native_cosine_similarity,
+        num_workers=4,
+        eval_batch_size=1,
+    )
+    py_proofs = py_prover.prove_all(goal, extra_knowledge)
+    native_proofs = native_prover.prove_all(goal, extra_knowledge)
+
+    assert len(native_proofs) == len(py_proofs) == 4
+    for native_proof, py_proof in zip(native_proofs, py_proofs):
+        assert native_proof.similarity == pytest.approx(py_proof.similarity)
+        assert native_proof.substitutions == {X: abe}
+
+
+def test_prove_with_native_max_similarity() -> None:
+    similarity_func = max_similarity([native_symbol_compare, native_cosine_similarity])
+    prover = ResolutionProver(
+        knowledge=[father_of(abe, homer)], similarity_func=similarity_func
+    )
+    proof = prover.prove(father_of(X, homer))
+
+    assert proof is not None
+    assert proof.substitutions == {X: abe}
+
+
+@pytest.mark.parametrize(
+    "embedding",
+    [
+        np.array([1.0, 0.0, 1.0], dtype=np.float32),
+        np.array([1.0, 0.0, 1.0]).data,
+        np.array([1.0, 9.0, 0.0, 9.0, 1.0, 9.0])[::2],
+        [1.0, 0.0, 1.0],
+    ],
+    ids=["float32", "memoryview", "non_contiguous", "list"],
+)
+def test_native_similarity_reads_any_float_embedding(embedding: Any) -> None:
+    dad_of_embed = Predicate("dad_of", embedding)
+    knowledge: list[Clause] = [dad_of_embed(abe, homer)]
+    goal = father_of_embed(X, homer)
+
+    py_proof = ResolutionProver(
+        knowledge=knowledge, similarity_func=cosine_similarity
+    ).prove(goal)
+    native_proof = ResolutionProver(
+        knowledge=knowledge, similarity_func=native_cosine_similarity
+    ).prove(goal)
+
+    assert py_proof is not None and native_proof is not None
+    assert native_proof.similarity == pytest.approx(py_proof.similarity)
+
+
+def test_native_similarity_rejects_unreadable_embeddings() -> None:
+    weird_pred = Predicate("weird", "not an embedding")
+    prover = ResolutionProver(similarity_func=native_cosine_similarity)
+    with pytest.raises(ValueError):
+        prover.extend_knowledge([weird_pred(abe)])
+
+
+def test_native_similarity_rejects_embeddings_with_mismatched_lengths() -> None:
+    prover = ResolutionProver(
+        knowledge=[Predicate("father_of", np.array([1.0, 0.0, 1.0]))(abe, homer)],
+        similarity_func=native_cosine_similarity,
+    )
+    with pytest.raises(ValueError):
+        prover.prove(Predicate("dad_of", np.array([1.0, 0.0]))(abe, homer))
+
+
+def test_native_similarity_copies_writable_embeddings() -> None:
+    embedding = np.array([1.0, 0.0])
+    prover = ResolutionProver(
+        knowledge=[Predicate("father_of", embedding)(abe, homer)],
+        similarity_func=native_cosine_similarity,
+    )
+    # the prover copied the array when the knowledge was added, so it doesn't see this change
+    embedding[:] = [0.0, 1.0]
+    dad_of = Predicate("dad_of", np.array([1.0, 0.0]))
+    assert prover.prove(dad_of(abe, homer)) is not None
+
+
+@pytest.mark.parametrize(
+    "similarity_func", [cosine_similarity, native_cosine_similarity]
+)
+def test_prove_all_with_precomputed_similarity(similarity_func: SimilarityFunc) -> None:
+    homer_embed = Constant("homer", np.array([1.0, 1.0]))
+    knowledge: list[Clause] = [
+        father_of_embed(homer_embed, bart),
+        dad_of_embed(abe, homer_embed),
+        grandpa_of_def_embed,
+    ]
+    goal = grandpa_of(X, bart)
+
+    prover = ResolutionProver(knowledge=knowledge, similarity_func=similarity_func)
+    precomputed_prover = ResolutionProver(
+        knowledge=knowledge,
+        similarity_func=similarity_func,
+        precompute_similarity=True,
+    )
+    proofs = prover.prove_all(goal)
+    precomputed_proofs = precomputed_prover.prove_all(goal)
+    assert len(precomputed_proofs) == len(proofs) == 1
+    assert precomputed_proofs[0].similarity == pytest.approx(proofs[0].similarity)
+
+    # precomputed similarities are restored after purging the cache
+    precomputed_prover.purge_similarity_cache()
+    precomputed_proofs = precomputed_prover.prove_all(goal)
+    assert precomputed_proofs[0].similarity == pytest.approx(proofs[0].similarity)
+
+
+def test_precomputed_similarity_doesnt_keep_query_symbols() -> None:
+    parent_of_embed = Predicate("parent_of", np.array([1.0, 0.0, 0.2]))
+    zero_embed = Predicate("zero", np.zeros(3))
+    prover = ResolutionProver(
+        knowledge=[parent_of_embed(homer, bart), zero_embed(abe, homer)],
+        similarity_func=native_cosine_similarity,
+        precompute_similarity=True,
+    )
+    precomputer = prover.similarity_precomputer
+    assert precomputer is not None
+    # zero embeddings can't be normalized, so they're left to the similarity func
+    assert len(precomputer.predicates.rust_symbols) == 1
+    assert not np.isnan(precomputer.predicates.matrix).any()
+
+    for _ in range(3):
+        goal = Predicate("ancestor_of", np.array([0.9, 0.1, 0.2]))(X, bart)
+        proof = prover.prove(goal)
+        assert proof is not None
+    assert len(precomputer.predicates.rust_symbols) == 1
+    assert precomputer.predicates.matrix.shape == (1, 3)
+
+
+def test_precompute_similarity_requires_cosine_similarity_and_caching() -> None:
+    with pytest.raises(ValueError):
+        ResolutionProver(similarity_func=symbol_compare, precompute_similarity=True)
+    with pytest.raises(ValueError):
+        ResolutionProver(cache_similarity=False, precompute_similarity=True)
+
+
+def test_prove_all_with_batch_similarity_func_matches_python_similarity() -> None:
+    goal = grandpa_of(X, bart)
+
+    batch_sizes: list[int] = []
+
+    def tracked_batch_cosine_similarity(
+        items_a: Sequence[Constant | Predicate], items_b: Sequence[Constant | Predicate]
+    ) -> Any:
+        batch_sizes.append(len(items_a))
+        return batch_cosine_similarity(items_a, items_b)
+
+    prover = ResolutionProver(knowledge=embed_knowledge)
+    batch_prover = ResolutionProver(
+        knowledge=embed_knowledge, batch_similarity_func=tracked_batch_cosine_similarity
+    )
+    proofs = prover.prove_all(goal)
+    batch_proofs = batch_prover.prove_all(goal)
+
+    assert len(batch_proofs) == len(proofs) == 4
+    for batch_proof, proof in zip(batch_proofs, proofs):
+        assert batch_proof.similarity == pytest.approx(proof.similarity)
+    # similarities are prefetched in bulk, rather than 1 pair at a time
+    assert max(batch_sizes) > 1
+
+
+def test_batch_similarity_func_requires_cache_similarity() -> None:
+    with pytest.raises(ValueError):
+        ResolutionProver(
+            batch_similarity_func=batch_cosine_similarity, cache_similarity=False
+        )
+
+
+def test_prove_with_shared_thread_pool_and_resized_workers() -> None:
+    knowledge: list[Clause] = [
+        parent_of(homer, bart),
+        father_of(abe, homer),
+        grandpa_of_def,
+    ]
+    prover1 = ResolutionProver(knowledge=knowledge, share_thread_pool=True)
+    prover2 = ResolutionProver(knowledge=knowledge, share_thread_pool=True)
+    goal = grandpa_of(X, bart)
+
+    for prover in [prover1, prover2]:
+        for num_workers in [1, 3, 3]:
+            prover.set_num_workers(num_workers)
+            proof = prover.prove(goal)
+            assert proof is not None
+            assert proof.substitutions == {X: abe}
+
+
+def test_prove_batch_matches_proving_goals_one_at_a_time() -> None:
+    knowledge: list[Clause] = [
+        parent_of(homer, bart),
+        father_of(abe, homer),
+        grandpa_of_def,
+    ]
+    prover = ResolutionProver(knowledge=knowledge, num_workers=4, eval_batch_size=1)
+    goals: list[Clause] = [grandpa_of(X, bart), grandpa_of(bart, X), parent_of(X, bart)]
+
+    batch_proofs = prover.prove_batch(goals)
+
+    assert len(batch_proofs) == len(goals)
+    assert batch_proofs[1] is None
+    for goal, batch_proof in zip(goals, batch_proofs):
+        proof = prover.prove(goal)
+        if proof is None:
+            assert batch_proof is None
+        else:
+            assert batch_proof is not None
+            assert batch_proof.substitutions == proof.substitutions
+            assert batch_proof.similarity == pytest.approx(proof.similarity)
+
+
+def test_prove_all_batch_with_stats_returns_stats_per_goal() -> None:
+    prover = ResolutionProver(knowledge=[parent_of(homer, bart), grandpa_of_def])
+    results = prover.prove_all_batch_with_stats(
+        [parent_of(X, bart), grandpa_of(X, bart)]
+    )
+
+    assert [len(proofs) for proofs, _ in results] == [1, 0]
+    for _, stats in results:
+        assert stats.attempted_resolutions > 0
+
+
+@pytest.mark.parametrize("search_strategy", ["best_first", "iterative_deepening"])
+@pytest.mark.parametrize("max_proofs", [1, 2, None])
+def test_search_strategies_find_the_same_best_proofs_as_breadth_first_search(
+    search_strategy: SearchStrategy, max_proofs: Optional[int]
+) -> None:
+    breadth_first_prover = ResolutionProver(knowledge=embed_knowledge)
+    prover = ResolutionProver(
+        knowledge=embed_knowledge, search_strategy=search_strategy
+    )
+    goal = grandpa_of(X, bart)
+
+    breadth_first_proofs = breadth_first_prover.prove_all(goal, max_proofs=max_proofs)
+    proofs = prover.prove_all(goal, max_proofs=max_proofs)
+
+    assert len(proofs) == len(breadth_first_proofs)
+    for proof, breadth_first_proof in zip(proofs, breadth_first_proofs):
+        assert proof.similarity == pytest.approx(breadth_first_proof.similarity)
+        assert proof.substitutions == breadth_first_proof.substitutions
+
+
+def test_best_first_search_prunes_branches_that_cant_beat_the_best_proof() -> None:
+    knowledge: list[Clause] = [
+        parent_of(homer, bart),
+        father_of(abe, homer),
+        grandpa_of_def,
+        grandma_of_def,
+    ]
+    prover = ResolutionProver(knowledge=knowledge, search_strategy="best_first")
+    breadth_first_prover = ResolutionProver(knowledge=knowledge)
+    goal = grandpa_of(X, bart)
+
+    _, stats = prover.prove_all_with_stats(goal, max_proofs=1)
+    _, breadth_first_stats = breadth_first_prover.prove_all_with_stats(
+        goal, max_proofs=1
+    )
+
+    assert stats.attempted_resolutions <= breadth_first_stats.attempted_resolutions
+
+
+def test_best_first_search_doesnt_hang_if_the_similarity_func_raises() -> None:
+    def failing_similarity(
+        item1: Constant | Predicate, item2: Constant | Predicate
+    ) -> float:
+        raise RuntimeError("similarity failed")
+
+    knowledge: list[Clause] = [parent_of(homer, bart), grandpa_of_def]
+    prover = ResolutionProver(
+        knowledge=knowledge,
+        similarity_func=failing_similarity,
+        search_strategy="best_first",
+        num_workers=4,
+    )
+    # the failure surfaces as a pyo3 PanicException, which derives from BaseException
+    with pytest.raises(BaseException):
+        prover.prove(grandpa_of(X, bart))
+
+
+def test_unknown_search_strategy_is_rejected() -> None:
+    with pytest.raises(ValueError):
+        ResolutionProver(search_strategy="depth_first")  # type: ignore
+
+
+def test_beam_search_keeps_only_the_best_resolvents_at_each_depth() -> None:
+    prover = ResolutionProver(knowledge=embed_knowledge, beam_width=2)
+    goal = grandpa_of(X, bart)
+
+    proofs = prover.prove_all(goal)
+
+    # the resolvents from unifying father_of with dad_of are less similar, so are dropped from the beam
+    assert len(proofs) == 2
+    assert proofs[0].similarity == pytest.approx(1.0)
+    assert proofs[-1].similarity < 0.99
+    for proof in proofs:
+        assert proof.substitutions == {X: abe}
+
+    wide_beam_prover = ResolutionProver(knowledge=embed_knowledge, beam_width=100)
+    assert len(wide_beam_prover.prove_all(goal)) == 4
+
+
+def test_beam_width_must_be_positive_and_used_with_breadth_first_search() -> None:
+    with pytest.raises(ValueError):
+        ResolutionProver(beam_width=0)
+    with pytest.raises(ValueError):
+        ResolutionProver(beam_width=5, search_strategy="best_first")
+
+
+def test_iterative_deepening_finds_deep_proofs_without_duplicates() -> None:
+    knowledge: list[Clause] = [
+        parent_of(homer, bart),
+        father_of(abe, homer),
+        grandpa_of_def,
+    ]
+    prover = ResolutionProver(
+        knowledge=knowledge,
+        search_strategy="iterative_deepening",
+        skip_seen_resolvents=True,
+    )
+
+    proofs = prover.prove_all(grandpa_of(X, bart))
+
+    assert len(proofs) == 1
+    assert proofs[0].substitutions == {X: abe}
+
+
+def test_max_seen_resolvents_limits_memory_without_losing_proofs() -> None:
+    knowledge: list[Clause] = [
+        parent_of(homer, bart),
+        parent_of(marge, bart),
+        father_of(abe, homer),
+        grandpa_of_def,
+    ]
+    goal = grandpa_of(X, bart)
+    prover = ResolutionProver(knowledge=knowledge, skip_seen_resolvents=True)
+    bounded_prover = ResolutionProver(
+        knowledge=knowledge, skip_seen_resolvents=True, max_seen_resolvents=1
+    )
+
+    proofs, stats = prover.prove_all_with_stats(goal)
+    bounded_proofs, bounded_stats = bounded_prover.prove_all_with_stats(goal)
+
+    assert len(bounded_proofs) == len(proofs) == 1
+    assert bounded_proofs[0].substitutions == proofs[0].substitutions
+    assert stats.evicted_resolvents == 0
+    assert bounded_stats.evicted_resolvents > 0
+
+
+def test_max_seen_resolvents_must_be_positive() -> None:
+    with pytest.raises(ValueError):
+        ResolutionProver(knowledge=[], max_seen_resolvents=0)
+
+
+def test_bounded_similarity_cache_reports_hits_and_misses() -> None:
+    knowledge: list[Clause] = [
+        parent_of(homer, bart),
+        parent_of(marge, bart),
+        father_of(abe, homer),
+        grandpa_of_def,
+    ]
+    goal = grandpa_of(X, bart)
+    prover = ResolutionProver(knowledge=knowledge)
+    bounded_prover = ResolutionProver(knowledge=knowledge, similarity_cache_size=2)
+
+    proof = prover.prove(goal)
+    bounded_proof = bounded_prover.prove(goal)
+    assert proof is not None and bounded_proof is not None
+    assert bounded_proof.substitutions == proof.substitutions
+
+    _, first_stats = bounded_prover.prove_all_with_stats(goal)
+    _, second_stats = bounded_prover.prove_all_with_stats(goal)
+    assert first_stats.similarity_cache_hits + first_stats.similarity_cache_misses > 0
+    assert second_stats.similarity_cache_hits > 0
+
+    cache_stats = bounded_prover.similarity_cache_stats()
+    assert cache_stats is not None
+    assert cache_stats.capacity == 2
+    assert cache_stats.size <= 2
+    assert cache_stats.misses > 0
+    assert cache_stats.hits > 0
+
+    bounded_prover.purge_similarity_cache()
+    assert bounded_prover.similarity_cache_stats() == SimilarityCacheStats(capacity=2)
+
+
+def test_similarity_cache_stats_is_none_without_caching() -> None:
+    prover = ResolutionProver(knowledge=[], cache_similarity=False)
+    assert prover.similarity_cache_stats() is None
+
+
+def test_similarity_cache_size_must_be_positive() -> None:
+    with pytest.raises(ValueError):
+        ResolutionProver(knowledge=[], similarity_cache_size=0)
+
+
+def test_saved_similarity_cache_is_used_by_new_provers(tmp_path: Any) -> None:
+    counting_similarity = CountingSimilarity()
+    prover = build_parent_of_prover(
+        similarity_func=counting_similarity, persist_similarity_cache=True
+    )
+    proof = prover.prove(ancestor_of_goal())
+    assert proof is not None
+    assert counting_similarity.num_calls > 0
+    path = tmp_path / "similarities.bin"
+    prover.save_similarity_cache(path)
+
+    counting_similarity.num_calls = 0
+    new_prover = build_parent_of_prover(similarity_func=counting_similarity)
+    new_prover.load_similarity_cache(path)
+    new_proof = new_prover.prove(ancestor_of_goal())
+    assert new_proof is not None
+    assert new_proof.similarity == proof.similarity
+    assert counting_similarity.num_calls == 0
+
+
+def test_load_similarity_cache_rejects_files_from_other_similarity_funcs(
+    tmp_path: Any,
+) -> None:
+    path = tmp_path / "similarities.bin"
+    prover = ResolutionProver(
+        knowledge=[parent_of(homer, bart)], persist_similarity_cache=True
+    )
+    prover.prove(parent_of(homer, bart))
+    prover.save_similarity_cache(path)
+    ResolutionProver(knowledge=[]).load_similarity_cache(path)
+    with pytest.raises(ValueError):
+        ResolutionProver(
+            knowledge=[], similarity_func=symbol_compare
+        ).load_similarity_cache(path)
+
+
+def test_load_similarity_cache_rejects_invalid_files(tmp_path: Any) -> None:
+    path = tmp_path / "similarities.bin"
+    path.write_bytes(b"not a similarity cache")
+    prover = ResolutionProver(knowledge=[])
+    with pytest.raises(ValueError):
+        prover.load_similarity_cache(path)
+
+
+def test_saving_similarities_requires_caching(tmp_path: Any) -> None:
+    prover = ResolutionProver(knowledge=[], cache_similarity=False)
+    with pytest.raises(ValueError):
+        prover.save_similarity_cache(tmp_path / "similarities.bin")
+
+
+def test_saving_similarities_requires_persist_similarity_cache(tmp_path: Any) -> None:
+    prover = ResolutionProver(knowledge=[parent_of(homer, bart)])
+    prover.prove(parent_of(homer, bart))
+    with pytest.raises(ValueError):
+        prover.save_similarity_cache(tmp_path / "similarities.bin")
+    with pytest.raises(ValueError):
+        ResolutionProver(cache_similarity=False, persist_similarity_cache=True)
+
+
+@pytest.mark.parametrize(
+    "similarity_func,precompute_similarity,quantization",
+    [
+        (cosine_similarity, False, None),
+        (native_cosine_similarity, False, None),
+        (native_cosine_similarity, True, None),
+        (native_cosine_similarity, False, "float16"),
+        (native_cosine_similarity, False, "int8"),
+        (native_cosine_similarity, True, "int8"),
+    ],
+)
+def test_prove_with_symbols_from_an_embedding_store(
+    similarity_func: SimilarityFunc,
+    precompute_similarity: bool,
+    quantization: Optional[Quantization],
+) -> None:
+    store = EmbeddingStore(
+        np.array([[1.0, 0.0, 0.2], [0.9, 0.1, 0.2], [0.0, 1.0, 0.0]]),
+        ["parent_of", "ancestor_of", "homer"],
+        quantization=quantization,
+    )
+    knowledge: list[Clause] = [
+        store.predicate("parent_of")(store.constant("homer"), bart)
+    ]
+    prover = ResolutionProver(
+        knowledge=knowledge,
+        similarity_func=similarity_func,
+        precompute_similarity=precompute_similarity,
+    )
+    proof = prover.prove(store.predicate("ancestor_of")(store.constant("homer"), bart))
+    assert proof is not None
+    exact_similarity = cosine_similarity(
+        Predicate("parent_of", np.array([1.0, 0.0, 0.2])),
+        Predicate("ancestor_of", np.array([0.9, 0.1, 0.2])),
+    )
+    assert proof.similarity == pytest.approx(
+        exact_similarity, abs=4 * store.quantization_error + 1e-9
+    )
+
+
+@pytest.mark.parametrize("embedding_identity", ["object", "content"])
+def test_content_embedding_identity_shares_cache_entries_between_rebuilt_symbols(
+    embedding_identity: EmbeddingIdentity,
+) -> None:
+    counting_similarity = CountingSimilarity()
+    prover = build_parent_of_prover(
+        similarity_func=counting_similarity, embedding_identity=embedding_identity
+    )
+    proof = prover.prove(ancestor_of_goal())
+    assert proof is not None
+    assert counting_similarity.num_calls > 0
+
+    counting_similarity.num_calls = 0
+    rebuilt_proof = prover.prove(ancestor_of_goal())
+    assert rebuilt_proof is not None
+    assert rebuilt_proof.similarity == proof.similarity
+    if embedding_identity == "content":
+        assert counting_similarity.num_calls == 0
+    else:
+        assert counting_similarity.num_calls > 0
+
+
+def test_unknown_embedding_identity_is_rejected() -> None:
+    with pytest.raises(ValueError):
+        ResolutionProver(knowledge=[], embedding_identity="pointer")  # type: ignore
+
+
+def test_asymmetric_similarity_funcs_are_cached_per_direction() -> None:
+    likes = Predicate("likes")
+    loves = Predicate("loves")
+
+    def loves_implies_likes(
+        item1: Constant | Predicate, item2: Constant | Predicate
+    ) -> float:
+        if item1.symbol == item2.symbol:
+            return 1.0
+        return 0.9 if (item1.symbol, item2.symbol) == ("loves", "likes") else 0.0
+
+    knowledge: list[Clause] = [likes(homer, bart), loves(bart, homer)]
+    goals = [loves(homer, bart), likes(bart, homer)]
+    uncached_prover = ResolutionProver(
+        knowledge=knowledge,
+        similarity_func=loves_implies_likes,
+        cache_similarity=False,
+    )
+    cached_prover = ResolutionProver(
+        knowledge=knowledge, similarity_func=loves_implies_likes
+    )
+
+    expected = [uncached_prover.prove(goal) is not None for goal in goals]
+    assert expected in ([True, False], [False, True])
+    assert [cached_prover.prove(goal) is not None for goal in goals] == expected
+
+
+def test_symmetric_similarity_is_detected_for_built_in_similarity_funcs() -> None:
+    def custom_similarity(
+        item1: Constant | Predicate, item2: Constant | Predicate
+    ) -> float:
+        return 1.0
+
+    assert _resolve_symmetric_similarity(None, cosine_similarity, None)
+    assert _resolve_symmetric_similarity(None, native_cosine_similarity, None)
+    assert _resolve_symmetric_similarity(None, symbol_compare, batch_cosine_similarity)
+    assert not _resolve_symmetric_similarity(None, custom_similarity, None)
+    assert not _resolve_symmetric_similarity(False, cosine_similarity, None)
+    assert _resolve_symmetric_similarity(True, custom_similarity, None)
+
+
+def test_prove_all_with_timeout_returns_proofs_found_so_far_and_marks_stats_truncated() -> None:
+    knowledge: list[Clause] = [
+        parent_of(homer, bart),
+        father_of(abe, homer),
+        grandpa_of_def,
+    ]
+    prover = ResolutionProver(knowledge=knowledge)
+    goal = grandpa_of(X, bart)
+
+    proofs, stats = prover.prove_all_with_stats(goal, timeout=0)
+    assert proofs == []
+    assert stats.truncated
+
+    proofs, stats = prover.prove_all_with_stats(goal, timeout=60)
+    assert len(proofs) == 1
+    assert not stats.truncated
+    assert prover.prove(goal, timeout=60) is not None
+
+
+def test_timeout_must_not_be_negative() -> None:
+    prover = ResolutionProver(knowledge=[parent_of(homer, bart)])
+    with pytest.raises(ValueError):
+        prover.prove(parent_of(homer, bart), timeout=-1)
+
+
+def test_timeouts_too_long_to_represent_are_the_same_as_no_timeout() -> None:
+    prover = ResolutionProver(knowledge=[parent_of(homer, bart)])
+    assert prover.prove(parent_of(homer, bart), timeout=1e20) is not None
+    assert prover.prove(parent_of(homer, bart), timeout=float("inf")) is not None
+
+
+def test_prove_all_with_cancelled_token_stops_immediately() -> None:
+    prover = ResolutionProver(knowledge=[parent_of(homer, bart)])
+    token = CancellationToken()
+    token.cancel()
+
+    proofs, stats = prover.prove_all_with_stats(
+        parent_of(homer, bart), cancellation_token=token
+    )
+
+    assert token.cancelled
+    assert proofs == []
+    assert stats.truncated
+
+
+def test_prove_can_be_cancelled_from_another_thread() -> None:
+    prover = build_looping_prover()
+    token = CancellationToken()
+    timer = threading.Timer(0.1, token.cancel)
+    timer.start()
+
+    start = time.time()
+    proofs, stats = prover.prove_all_with_stats(
+        parent_of(homer, bart), cancellation_token=token
+    )
+
+    assert time.time() - start < 5
+    assert proofs == []
+    assert stats.truncated
+
+
+def test_prove_async_matches_prove() -> None:
+    knowledge: list[Clause] = [
+        parent_of(homer, bart),
+        father_of(abe, homer),
+        grandpa_of_def,
+    ]
+    prover = ResolutionProver(knowledge=knowledge)
+    goals: list[Clause] = [grandpa_of(X, bart), grandpa_of(bart, X), parent_of(X, bart)]
+
+    async def prove_goals() -> list[Optional[Proof]]:
+        return await asyncio.gather(*[prover.prove_async(goal) for goal in goals])
+
+    async_proofs = asyncio.run(prove_goals())
+
+    assert async_proofs[1] is None
+    for goal, async_proof in zip(goals, async_proofs):
+        proof = prover.prove(goal)
+        if proof is None:
+            assert async_proof is None
+        else:
+            assert async_proof is not None
+            assert async_proof.substitutions == proof.substitutions
+            assert async_proof.similarity == pytest.approx(proof.similarity)
+
+
+def test_prove_all_with_stats_async_returns_stats() -> None:
+    prover = ResolutionProver(knowledge=[parent_of(homer, bart)])
+    proofs, stats = asyncio.run(
+        prover.prove_all_with_stats_async(parent_of(X, bart), timeout=60)
+    )
+    assert len(proofs) == 1
+    assert stats.attempted_resolutions > 0
+    assert not stats.truncated
+
+
+def test_cancelling_async_prove_cancels_the_search() -> None:
+    # without caching, the similarity func is called for as long as the search keeps running
+    counting_similarity = CountingSimilarity()
+    prover = build_looping_prover(
+        similarity_func=counting_similarity, cache_similarity=False
+    )
+    token = CancellationToken()
+
+    async def prove_and_cancel() -> None:
+        task = asyncio.create_task(
+            prover.prove_async(parent_of(homer, bart), cancellation_token=token)
+        )
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(prove_and_cancel())
+    # give the workers a moment to notice the cancellation
+    time.sleep(0.1)
+    num_calls = counting_similarity.num_calls
+    time.sleep(0.2)
+    assert num_calls > 0
+    assert counting_similarity.num_calls == num_calls
+    # the search is stopped with its own token, so other queries using the caller's token carry on
+    assert not token.cancelled
+
+
+def test_iter_proofs_yields_the_same_proofs_as_prove_all() -> None:
+    knowledge: list[Clause] = [
+        parent_of(homer, bart),
+        parent_of(marge, bart),
+        father_of(abe, homer),
+        grandpa_of_def,
+    ]
+    prover = ResolutionProver(knowledge=knowledge)
+    goal = parent_of(X, bart)
+
+    streamed_proofs = list(prover.iter_proofs(goal, buffer_size=1))
+    proofs = prover.prove_all(goal)
+
+    assert len(streamed_proofs) == len(proofs) == 2
+    assert sorted(str(proof.substitutions[X]) for proof in streamed_proofs) == sorted(
+        str(proof.substitutions[X]) for proof in proofs
+    )
+
+
+def test_stopping_iter_proofs_early_cancels_the_search() -> None:
+    # stop at the first proof, rather than searching the whole looping tree for better ones
+    prover = build_looping_prover(
+        [parent_of(homer, bart)],
+        skip_seen_resolvents=False,
+        find_highest_similarity_proofs=False,
+    )
+    token = CancellationToken()
+
+    for proof in prover.iter_proofs(parent_of(X, bart), cancellation_token=token):
+        assert proof.substitutions[X] == homer
+        break
+
+    # the stream stops the search with its own token, so the caller's token can be reused
+    assert not token.cancelled
+    assert prover.prove(parent_of(homer, bart), cancellation_token=token) is not None
+
+
 # TODO: move these 2 tests to rust
 # def test_purge_similarity_cache() -> None:
 #     prover = ResolutionProver(knowledge=[])
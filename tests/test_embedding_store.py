@@ -0,0 +1,166 @@
+from __future__ import annotations
+import pickle
+from pathlib import Path
+
+import pytest
+import numpy as np
+
+from tensor_theorem_prover import embedding_store
+from tensor_theorem_prover.embedding_store import (
+    EmbeddingStore,
+    Quantization,
+    stack_embeddings,
+)
+from tensor_theorem_prover.similarity import batch_cosine_similarity, cosine_similarity
+from tensor_theorem_prover.types import Constant
+
+
+def build_store() -> EmbeddingStore:
+    matrix = np.array([[1.0, 0.0, 1.0], [0.0, 1.0, 1.0], [1.0, 1.0, 0.0]])
+    return EmbeddingStore(matrix, ["a", "b", "c"])
+
+
+def test_symbols_from_a_store_share_one_embedding_per_row() -> None:
+    store = build_store()
+    assert store.constant("a") == store.constant("a")
+    assert hash(store.constant("a")) == hash(store.constant("a"))
+    assert store.constant("a").embedding is store.predicate("a").embedding
+    assert store.constant("a").embedding is not store.constant("b").embedding
+    assert len(store) == 3
+    assert "c" in store
+    assert "d" not in store
+
+
+def test_stored_embeddings_are_views_of_the_matrix() -> None:
+    store = build_store()
+    embedding = np.asarray(store.embedding("b"))
+    assert np.shares_memory(embedding, store.matrix)
+    assert list(embedding) == [0.0, 1.0, 1.0]
+    # read-only, so native similarity can borrow the row instead of copying it
+    assert not embedding.flags.writeable
+    assert store.matrix.flags.writeable
+
+
+def test_stored_embeddings_only_copy_when_asked_or_needed() -> None:
+    store = build_store()
+    embedding = store.embedding("a")
+    copied = embedding.__array__(copy=True)
+    assert not np.shares_memory(copied, store.matrix)
+    assert copied.flags.writeable
+    assert np.shares_memory(embedding.__array__(copy=False), store.matrix)
+    assert embedding.__array__(np.float32).dtype == np.float32
+    with pytest.raises(ValueError):
+        embedding.__array__(np.float32, copy=False)
+    quantized_store = EmbeddingStore(store.matrix, store.symbols, "int8")
+    with pytest.raises(ValueError):
+        quantized_store.embedding("a").__array__(copy=False)
+
+
+def test_stored_embeddings_work_with_cosine_similarity() -> None:
+    store = build_store()
+    assert cosine_similarity(store.constant("a"), store.constant("b")) == pytest.approx(
+        0.5
+    )
+    similarities = batch_cosine_similarity(
+        [store.constant("a"), store.constant("c"), store.constant("a")],
+        [store.constant("b"), store.constant("c"), Constant("a", np.array([1, 0, 1]))],
+    )
+    assert list(similarities) == pytest.approx([0.5, 1.0, 1.0])
+
+
+def test_stack_embeddings_gathers_rows_from_the_store() -> None:
+    store = build_store()
+    matrix = stack_embeddings([store.embedding("c"), store.embedding("a")])
+    assert matrix.dtype == np.float64
+    assert matrix.tolist() == [[1.0, 1.0, 0.0], [1.0, 0.0, 1.0]]
+
+
+def test_pickled_symbols_share_a_single_copy_of_the_store() -> None:
+    store = build_store()
+    symbols = [store.constant("a"), store.constant("b"), store.constant("a")]
+    unpickled = pickle.loads(pickle.dumps(symbols))
+    assert unpickled[0].embedding is unpickled[2].embedding
+    assert unpickled[0].embedding.store is unpickled[1].embedding.store
+    assert np.asarray(unpickled[1].embedding).tolist() == [0.0, 1.0, 1.0]
+
+
+def test_memory_mapped_stores_pickle_their_path(tmp_path: Path) -> None:
+    path = tmp_path / "embeddings.npy"
+    np.save(path, build_store().matrix)
+    store = EmbeddingStore.load(path, ["a", "b", "c"])
+    assert isinstance(store.matrix, np.memmap)
+    assert store.__getstate__()["matrix"] is None
+    unpickled = pickle.loads(pickle.dumps(store.constant("c")))
+    assert isinstance(unpickled.embedding.store.matrix, np.memmap)
+    assert np.asarray(unpickled.embedding).tolist() == [1.0, 1.0, 0.0]
+
+
+@pytest.mark.parametrize("quantization", ["float16", "int8"])
+def test_quantized_similarities_are_within_the_error_bound(
+    quantization: Quantization,
+) -> None:
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(20, 64))
+    symbols = [f"symbol{i}" for i in range(20)]
+    exact_store = EmbeddingStore(matrix, symbols)
+    store = EmbeddingStore(matrix, symbols, quantization=quantization)
+    assert store.matrix.dtype == np.dtype(quantization)
+    assert 0 < store.quantization_error < 0.05
+    for symbol1 in symbols:
+        for symbol2 in symbols:
+            exact = cosine_similarity(
+                exact_store.constant(symbol1), exact_store.constant(symbol2)
+            )
+            quantized = cosine_similarity(
+                store.constant(symbol1), store.constant(symbol2)
+            )
+            assert abs(quantized - exact) <= 4 * store.quantization_error
+
+
+def test_quantized_stores_expose_their_quantized_values() -> None:
+    store = EmbeddingStore(np.array([[3.0, -4.0], [0.0, 0.0]]), ["a", "b"], "int8")
+    assert build_store().embedding("a").quantized_values is None
+    assert np.asarray(store.embedding("a").quantized_values).tolist() == [95, -127]
+    assert np.asarray(store.embedding("b").quantized_values).tolist() == [0, 0]
+    assert np.asarray(store.embedding("a")) == pytest.approx([0.6, -0.8], abs=0.01)
+    unpickled = pickle.loads(pickle.dumps(store))
+    assert unpickled.quantization == "int8"
+    assert unpickled.matrix.tolist() == store.matrix.tolist()
+    assert store.scales is not None
+    assert unpickled.scales.tolist() == store.scales.tolist()
+
+
+@pytest.mark.parametrize("quantization", ["float16", "int8"])
+def test_quantizing_a_memory_mapped_file_in_chunks_matches_quantizing_in_memory(
+    quantization: Quantization, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(20, 16))
+    matrix[3] = 0.0
+    path = tmp_path / "embeddings.npy"
+    np.save(path, matrix)
+    symbols = [f"symbol{i}" for i in range(20)]
+    expected = EmbeddingStore(matrix, symbols, quantization=quantization)
+    # a few rows at a time
+    monkeypatch.setattr(embedding_store, "_QUANTIZATION_CHUNK_VALUES", 64)
+    store = EmbeddingStore.load(path, symbols, quantization=quantization)
+    assert store.path is None
+    assert not isinstance(store.matrix, np.memmap)
+    assert store.matrix.tolist() == expected.matrix.tolist()
+    assert store.scales is not None and expected.scales is not None
+    assert store.scales.tolist() == expected.scales.tolist()
+    assert store.quantization_error == expected.quantization_error
+
+
+def test_store_rejects_mismatched_symbols() -> None:
+    matrix = np.zeros((2, 3))
+    with pytest.raises(ValueError):
+        EmbeddingStore(matrix, ["a"])
+    with pytest.raises(ValueError):
+        EmbeddingStore(matrix, ["a", "a"])
+    with pytest.raises(ValueError):
+        EmbeddingStore(np.zeros(3), ["a", "b", "c"])
+    with pytest.raises(KeyError):
+        build_store().constant("d")
+    with pytest.raises(ValueError):
+        EmbeddingStore(matrix, ["a", "b"], quantization="int4")  # type: ignore
@@ -88,8 +88,9 @@ def test_performance_with_amr_reasoner_batch() -> None:
             skip_seen_resolvents=True,
             max_resolution_attempts=100_000_000,
         )
-        for goal in sample["goals"]:
-            proofs, proof_stats = prover.prove_all_with_stats(goal, max_proofs=None)
+        for proofs, proof_stats in prover.prove_all_batch_with_stats(
+            sample["goals"], max_proofs=None
+        ):
             stats.append(proof_stats)
             total_proofs += len(proofs)
     summed_stats = ProofStats(
@@ -2,9 +2,13 @@ import pytest
 import numpy as np
 
 from tensor_theorem_prover.similarity import (
+    batch_cosine_similarity,
     cosine_similarity,
     symbol_compare,
     max_similarity,
+    native_cosine_similarity,
+    native_symbol_compare,
+    NativeSimilarityFunc,
 )
 from tensor_theorem_prover.types.Constant import Constant
 
@@ -51,3 +55,42 @@ def test_max_similarity_takes_the_max_of_all_passed_similarity_measures() -> Non
         )
         == 1.0
     )
+
+
+def test_native_similarity_funcs_can_be_called_from_python() -> None:
+    assert native_cosine_similarity(
+        Constant("a", np.array([1, 0, 1])),
+        Constant("b", np.array([0, 1, 1])),
+    ) == pytest.approx(0.5)
+    assert native_symbol_compare(Constant("a"), Constant("a")) == 1.0
+
+
+def test_max_similarity_of_native_funcs_is_native() -> None:
+    combined_similarity = max_similarity(
+        [native_symbol_compare, native_cosine_similarity]
+    )
+    assert isinstance(combined_similarity, NativeSimilarityFunc)
+    assert combined_similarity(
+        Constant("a", np.array([1, 0, 1])),
+        Constant("b", np.array([0, 1, 1])),
+    ) == pytest.approx(0.5)
+    assert not isinstance(
+        max_similarity([native_symbol_compare, cosine_similarity]),
+        NativeSimilarityFunc,
+    )
+
+
+def test_batch_cosine_similarity_calculates_the_similarity_of_each_pair() -> None:
+    similarities = batch_cosine_similarity(
+        [
+            Constant("a", np.array([1, 0, 1])),
+            Constant("b", np.array([1, 0, 1])),
+            Constant("same"),
+        ],
+        [
+            Constant("b", np.array([0, 1, 1])),
+            Constant("b"),
+            Constant("same"),
+        ],
+    )
+    assert list(similarities) == pytest.approx([0.5, 1.0, 1.0])